@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+
+# A stand-in for OptiPassMain.exe, for testing the web app on systems that
+# can't run OptiPass.  It has the same command line interface:
+#
+#    $ optipass_standin.py -f barriers.txt -o output.txt -b budget [-t n -w w1, w2, ...]
+#
+# The output file has the same format as the files written by OptiPass (the
+# single target format if -t is not specified, otherwise the weighted multi-
+# target format).  Gates are selected greedily, in order of weighted benefit
+# per dollar, stopping at the first gate that does not fit in the budget, so
+# the results are plausible but not optimal, and the solution for a budget
+# includes the solutions for all smaller budgets.  Potential habitat
+# is computed the same way as OptiPass, using passabilities of all barriers
+# on the path to the river mouth.
+#
+# Options that are not part of the OptiPass interface can be used to slow the
+# program down or make it fail:
+#
+#    --delay D       sleep for D seconds (or a random time between D1 and D2 if D is "D1:D2")
+#    --fail P        exit with status 1, without writing the output file, with probability P
+#    --no-solution P write a file with STATUS NO_SOLN with probability P
+#
+# To have the app use this program instead of OptiPass, set OPTIPASS_COMMAND:
+#
+#    $ export OPTIPASS_COMMAND="python3 bin/optipass_standin.py --delay 0.5:2"
+
+import argparse
+import csv
+import random
+import sys
+import time
+
+def init_cli():
+    parser = argparse.ArgumentParser(description='OptiPass stand-in')
+    parser.add_argument('-f', metavar='F', required=True, help='barrier file')
+    parser.add_argument('-o', metavar='F', required=True, help='output file')
+    parser.add_argument('-b', metavar='N', type=float, required=True, help='budget')
+    parser.add_argument('-t', metavar='N', type=int, default=1, help='number of targets')
+    parser.add_argument('-w', metavar='W', nargs='+', default=[], help='target weights')
+    parser.add_argument('--delay', metavar='D', default='0', help='artificial latency in seconds')
+    parser.add_argument('--fail', metavar='P', type=float, default=0.0, help='probability of failing')
+    parser.add_argument('--no-solution', metavar='P', type=float, default=0.0, help='probability of reporting no solution')
+    return parser.parse_args()
+
+def number(s):
+    return 0.0 if s in ['', 'NA'] else float(s)
+
+def read_barriers(fn, ntargets):
+    '''
+    Read a barrier file, return a list of dictionaries with the barrier ID,
+    downstream ID, cost, and lists of habitat and passability values.
+    '''
+    barriers = []
+    with open(fn, newline='') as f:
+        for rec in csv.DictReader(f, delimiter='\t'):
+            hab = [k for k in rec if k.startswith('HAB')][:ntargets]
+            pre = [k for k in rec if k.startswith('PRE')][:ntargets]
+            post = [k for k in rec if k.startswith('POST')][:ntargets]
+            barriers.append({
+                'id': rec['ID'],
+                'dsid': None if rec['DSID'] in ['', 'NA'] else rec['DSID'],
+                'nproj': number(rec['NPROJ']),
+                'cost': number(rec['COST']),
+                'hab': [number(rec[k]) for k in hab],
+                'pre': [number(rec[k]) for k in pre],
+                'post': [number(rec[k]) for k in post],
+            })
+    return barriers
+
+def potential_habitat(barriers, selected, ntargets):
+    '''
+    Compute the potential habitat for each target, based on the passabilities
+    of the barriers downstream from each barrier.
+    '''
+    index = { b['id']: b for b in barriers }
+    cumulative = { }
+
+    def passability(x, j):
+        if (x, j) not in cumulative:
+            b = index[x]
+            p = b['post'][j] if x in selected else b['pre'][j]
+            if b['dsid'] in index:
+                p *= passability(b['dsid'], j)
+            cumulative[(x, j)] = p
+        return cumulative[(x, j)]
+
+    sys.setrecursionlimit(max(1000, 2 * len(barriers)))
+    return [sum(b['hab'][j] * passability(b['id'], j) for b in barriers) for j in range(ntargets)]
+
+def solve(barriers, budget, weights):
+    '''
+    Select gates in order of weighted benefit per dollar until the next gate
+    does not fit in the budget.  Gates further down the list that would fit
+    are not used, so solutions for increasing budgets are nested.
+    '''
+    def ratio(b):
+        gain = sum(w * (post - pre) * h for w, h, pre, post in zip(weights, b['hab'], b['pre'], b['post']))
+        return gain / b['cost']
+
+    candidates = [b for b in barriers if b['nproj'] > 0 and b['cost'] > 0]
+    selected = set()
+    spent = 0
+    for b in sorted(candidates, key=ratio, reverse=True):
+        if spent + b['cost'] > budget:
+            break
+        selected.add(b['id'])
+        spent += b['cost']
+    return selected
+
+def write_output(fn, budget, status, barriers, selected, weights, multi):
+    ntargets = len(weights)
+    before = potential_habitat(barriers, set(), ntargets)
+    after = potential_habitat(barriers, selected, ntargets)
+    with open(fn, 'w') as f:
+        print(f'BUDGET:\t{budget:.2f}', file=f)
+        print(f'STATUS:\t{status}', file=f)
+        print('%OPTGAP:\t0.00', file=f)
+        if multi:
+            print('WEIGHTS', file=f)
+            for j, w in enumerate(weights):
+                print(f'TARGET{j+1}:\t{w:.4f}', file=f)
+            print('PTNL_HABITAT', file=f)
+            for j, h in enumerate(after):
+                print(f'TARGET{j+1}:\t{h:.4f}', file=f)
+            wph = sum(w * h for w, h in zip(weights, after))
+            wgain = wph - sum(w * h for w, h in zip(weights, before))
+            print(f'WT_PTNL_HABITAT:\t{wph:.4f}', file=f)
+            print(f'WT_NETGAIN:\t{wgain:.4f}', file=f)
+        else:
+            print(f'PTNL_HABITAT:\t{after[0]:.4f}', file=f)
+            print(f'NETGAIN:\t{after[0] - before[0]:.4f}', file=f)
+        print(file=f)
+        print('BARID\tACTION', file=f)
+        for b in barriers:
+            print(f'{b["id"]}\t{1 if b["id"] in selected else 0}', file=f)
+
+def delay(spec):
+    lo, _, hi = spec.partition(':')
+    t = random.uniform(float(lo), float(hi)) if hi else float(lo)
+    if t > 0:
+        time.sleep(t)
+
+if __name__ == '__main__':
+    args = init_cli()
+    delay(args.delay)
+
+    if random.random() < args.fail:
+        print('optipass_standin: injected failure', file=sys.stderr)
+        exit(1)
+
+    weights = [float(s) for s in ' '.join(args.w).replace(',', ' ').split()] or [1.0] * args.t
+    if len(weights) != args.t:
+        print(f'optipass_standin: expected {args.t} weights', file=sys.stderr)
+        exit(1)
+
+    barriers = read_barriers(args.f, args.t)
+    if random.random() < args.no_solution:
+        write_output(args.o, args.b, 'NO_SOLN', barriers, set(), weights, args.t > 1)
+    else:
+        selected = solve(barriers, args.b, weights)
+        write_output(args.o, args.b, 'OPT', barriers, selected, weights, args.t > 1)
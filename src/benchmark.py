@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+
+from tidegates.targets import DataSet
+from tidegates.project import Project
+from tidegates.optipass import OP
+from tidegates.synthetic import write_workbook, write_outputs
+from tidegates.sensitivity import Sensitivity
+
+desc = '''
+Benchmarks for the hot spots in the optimization pipeline.  Each benchmark is
+run on synthetic barrier networks (see tidegates/synthetic.py) for every
+combination of network size and number of budget levels.  Results are printed
+and can be saved in a JSON file.
+
+If a baseline file (the JSON output of a previous run) is specified the new
+timings are compared to the old ones and the script exits with status 1 if any
+benchmark is slower than the baseline by more than the tolerance.
+'''
+
+epi = '''
+Example:
+
+    $ python3 src/benchmark.py --sizes 500 2000 --budgets 10 50 --output bench.json
+
+        Runs each benchmark on networks with 500 and 2000 barriers, using 10 and
+        50 budget levels, and saves the timings in bench.json.
+
+    $ python3 src/benchmark.py --baseline bench.json
+
+        Runs the benchmarks again and compares the results with the saved timings.
+'''
+
+def init_cli():
+    """
+    Use argparse to create the command line API.
+
+    Returns:
+        a Namespace object with values of the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=desc,
+        epilog=epi,
+    )
+    parser.add_argument('--sizes', metavar='N', type=int, nargs='+', default=[200, 1000], help='number of barriers in each network')
+    parser.add_argument('--budgets', metavar='N', type=int, nargs='+', default=[10, 40], help='number of budget levels')
+    parser.add_argument('--targets', metavar='T', nargs='+', default=['CO','CH','FI'], help='restoration targets')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3, help='number of times to run each benchmark')
+    parser.add_argument('--output', metavar='F', help='save results in a JSON file')
+    parser.add_argument('--baseline', metavar='F', help='compare results with a previous run')
+    parser.add_argument('--tolerance', metavar='X', type=float, default=0.25, help='allowed slowdown relative to the baseline (default 0.25)')
+    return parser.parse_args()
+
+def timed(f, repeat, setup=None):
+    """
+    Call a function several times and record the elapsed time for each call.
+
+    Arguments:
+      f:  the function to time
+      repeat:  the number of calls
+      setup:  optional function to call (untimed) before each call to f
+
+    Returns:
+      a list of times, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = perf_counter()
+        f()
+        times.append(perf_counter() - t0)
+    return times
+
+def make_cases(folder, n, nbudgets, targets):
+    """
+    Create a synthetic network and the objects needed to benchmark the
+    pipeline on that network.
+
+    Arguments:
+      folder:  directory for the workbook, barrier file, and output files
+      n:  number of barriers
+      nbudgets:  number of budget levels (not counting the $0 budget)
+      targets:  list of target IDs
+
+    Returns:
+      a list of tuples with the benchmark name, the function to time, and
+      an optional setup function
+    """
+    wb = write_workbook(os.path.join(folder, f'wb_{n}.csv'), n)
+    project = Project(wb, DataSet.TNC_OR)
+    op = OP(project, project.regions, targets, None, 'Current')
+    op.generate_input_frame()
+
+    delta = max(1, int(op.input_frame.COST.sum()) // (2 * nbudgets))
+    op.budget_max, op.budget_delta = delta * nbudgets, delta
+    budgets = [delta * i for i in range(nbudgets + 1)]
+    op.outputs = write_outputs(op.input_frame, budgets, os.path.join(folder, f'out_{n}_{nbudgets}'))
+    barrier_file = os.path.join(folder, 'barriers.txt')
+
+    op.collect_results()
+    summary, matrix = op.summary, op.matrix
+
+    def parse():
+        cols = { x: [] for x in ['budget', 'habitat', 'gates']}
+        for fn in op.outputs:
+            op._parse_op_output(fn, cols)
+
+    def reset():
+        op.summary = summary[['budget','habitat','gates']].copy()
+        op.matrix = matrix[budgets + ['count']].copy()
+
+    def roi():
+        op.make_roi_curves()
+        op.display_figures
+        op.get_figure(op.figure_names[0], 'png')
+
+    return [
+        ('project_load', lambda: Project(wb, DataSet.TNC_OR), None),
+        ('generate_input_frame', op.generate_input_frame, None),
+        ('write_barrier_file', lambda: op.write_barrier_file(barrier_file), None),
+        ('parse_op_output', parse, None),
+        ('make_paths', op._make_paths, None),
+        ('potential_habitat', lambda: op.potential_habitat(op.targets, False), reset),
+        ('table_view', op.table_view, None),
+        ('make_roi_curves', roi, None),
+        ('sensitivity', lambda: Sensitivity(op, draws=1000, seed=0).run(), None),
+    ]
+
+def run_benchmarks(args):
+    """
+    Run every benchmark for every combination of network size and budget count.
+
+    Returns:
+      a list of dictionaries, one for each benchmark, with the parameters
+      and timings
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for n in args.sizes:
+            for nb in args.budgets:
+                for name, f, setup in make_cases(folder, n, nb, args.targets):
+                    times = timed(f, args.repeat, setup)
+                    res = {
+                        'name': name,
+                        'barriers': n,
+                        'budgets': nb,
+                        'targets': len(args.targets),
+                        'min': min(times),
+                        'median': median(times),
+                        'times': times,
+                    }
+                    print(f'{key(res):50s} {res["median"]*1000:10.1f} ms')
+                    results.append(res)
+    return results
+
+def key(res):
+    """
+    Make a string that identifies a benchmark and its parameters.
+    """
+    return '{name}[n={barriers},b={budgets},t={targets}]'.format(**res)
+
+def compare(results, baseline, tolerance):
+    """
+    Compare median times with the medians in a baseline.  Times under a
+    millisecond are too noisy to compare, so they are never reported as
+    regressions.
+
+    Arguments:
+      results:  list of results from run_benchmarks
+      baseline:  list of results from a previous run
+      tolerance:  fraction of the baseline time a benchmark can increase
+
+    Returns:
+      a list of keys of benchmarks that are slower than the baseline
+    """
+    old = { key(r): r for r in baseline }
+    slower = []
+    print()
+    print(f'{"benchmark":50s} {"baseline":>10s} {"current":>10s} {"ratio":>7s}')
+    for r in results:
+        if (b := old.get(key(r))) is None:
+            continue
+        ratio = r['median'] / b['median'] if b['median'] > 0 else 1.0
+        flag = ''
+        if ratio > 1 + tolerance and r['median'] - b['median'] > 0.001:
+            slower.append(key(r))
+            flag = ' *'
+        print(f'{key(r):50s} {b["median"]*1000:10.1f} {r["median"]*1000:10.1f} {ratio:7.2f}{flag}')
+    return slower
+
+if __name__ == '__main__':
+    args = init_cli()
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if slower := compare(results, baseline, args.tolerance):
+            print(f'\n{len(slower)} benchmark(s) slower than the baseline')
+            sys.exit(1)
@@ -1,11 +1,18 @@
 import argparse
+import atexit
 from glob import glob
+import os
 import re
+import shutil
 import sys
+import tempfile
 
-import panel as pn
+# NOTE:  Panel and the GUI modules are imported by the functions that start
+# the GUI, so the command line actions don't have to wait for them to load
+
+# NOTE:  the same goes for the modules used only by the server, the run
+# history, and the remote solver (prometheus_client, sqlite3, and requests)
 
-from tidegates.widgets import TideGatesApp
 from tidegates.targets import DataSet
 from tidegates.project import Project
 from tidegates.optipass import OP
@@ -22,6 +29,18 @@ based on the values of the remaining options.
   * 'run' will run the optimizer using the parsed options
   * 'parse F' will parse results from a previous run; use it to test the parser,
     using data in files in th temp folder that have names starting with F
+  * 'serve' will start the web app in production mode, with several worker
+    processes (set the number with --workers) and autoreload turned off
+  * 'history' will print a list of runs saved in the run history
+  * 'reload' will display the results of a saved run (specify the run ID with --run)
+  * 'sensitivity' will run a Monte Carlo analysis of a saved run (specify the
+    run ID with --run and the number of samples with --draws) and display the
+    ROI curves with confidence bands
+  * 'pareto' will run OptiPass with a range of weights for the targets and
+    display the trade-offs between targets at each budget level
+  * 'import' will display the results in a summarized OptiPass results file
+    (specify the file name with --output)
+  * 'validate' will check the project file for errors and print them
 '''
 
 epi = '''
@@ -56,41 +75,149 @@ def init_cli():
     # command line arguments, which is how it's run in the Docker container when launching the
     # web app
 
-    parser.add_argument('--action', metavar='A', choices=['generate', 'preview', 'run', 'parse', 'all', 'gui'], help='operation to perform')
+    parser.add_argument('--action', metavar='A', choices=['generate', 'preview', 'run', 'parse', 'all', 'gui', 'serve', 'history', 'reload', 'sensitivity', 'pareto', 'validate', 'import'], help='operation to perform')
     parser.add_argument('--project', metavar='F', default='static/workbook.csv', help='CSV file with barrier data')
     parser.add_argument('--regions', metavar='R', default='all', nargs='+', help='one or more region names')
     parser.add_argument('--targets', metavar='T', nargs='+', default=['CO','FI'], help='one or more restoration targets')
     parser.add_argument('--budget', metavar='N', nargs=2, default=[5000,1000], help='max budget, budget delta')
     parser.add_argument('--climate', metavar='C', choices=['current','future'], default='current', help='climate scenario')
-    parser.add_argument('--output', metavar='F', help='base name of output files (optional)')
+    parser.add_argument('--output', metavar='F', help='base name of output files (optional), or a results file for --action import')
     parser.add_argument('--scaled', action='store_true', help='compute benefit using scaled amounts')
+    parser.add_argument('--optipass', metavar='CMD', help='shell command that runs OptiPass (e.g. the stand-in in bin)')
+    parser.add_argument('--remote', metavar='URL', help='URL of a remote OptiPass service (default: OPTIPASS_URL)')
+    parser.add_argument('--workers', metavar='N', type=int, default=os.cpu_count(), help='number of server processes for --action serve')
+    parser.add_argument('--port', metavar='N', type=int, default=5006, help='server port for --action serve')
+    parser.add_argument('--run', metavar='N', type=int, help='ID of a saved run for --action reload or sensitivity')
+    parser.add_argument('--draws', metavar='N', type=int, default=1000, help='number of samples for --action sensitivity')
 
     return parser.parse_args()
 
-def make_app():
+def new_app():
     """
     Instantiate the top level widget.
 
     Returns:
         a TideGatesApp object
     """
+    from tidegates.widgets import TideGatesApp
+
     return TideGatesApp(
         title='Tide Gate Optimization', 
         sidebar_width=450
     )
 
-def start_app():
+# The pool of apps made in advance, created by start_app
+
+app_pool = None
+
+def make_app():
+    """
+    Called by the server when a new session starts.  Take an app from
+    the pool (if there is one) or make a new one.  If the URL has a token
+    for a saved run (added when the previous page showed results) the app
+    starts with those results.
+
+    The callbacks that track sessions and clean up their workspaces are only
+    installed when there is a server session;  the gui action also calls this
+    function, before the server is started.
+
+    Returns:
+        a TideGatesApp object
+    """
+    import panel as pn
+
+    app = app_pool.get() if app_pool else new_app()
+    doc = pn.state.curdoc
+    if doc is not None and doc.session_context is not None:
+        from tidegates import metrics
+        from tidegates.workspace import workspaces, schedule_sweep
+        metrics.session_started()
+        pn.state.on_session_destroyed(workspaces.session_destroyed)
+        schedule_sweep()
+        app.resume()
+    return app
+
+def integration_app(op: OP):
+    """
+    Make the app displayed by the gui action:  select the regions and targets
+    of an optimization in the Start tab and show its results in the Output tab.
+
+    Args:
+        op:  an OP object with the results of an optimization
     """
-    Launch the Bokeh server.
+    app = make_app()
+    app.title = 'Tide Gate Optimization [Integration Test]'
+    app.optimize_button.disabled = True
+    for b in app.region_boxes.grid:
+        if b.name in op.regions:
+            b.value = True
+    names = [t.long for t in op.targets]
+    for b in app.target_boxes.tabs[0].grid:
+        if b.name in names:
+            b.value = True
+    app.add_output_pane(op)
+    app.tabs.active = 2
+    return app
+
+def start_app(workers: int = 1, port: int = 5006):
+    """
+    Launch the Bokeh server.  In addition to the app and the Panel admin
+    page the server has a page at /metrics with Prometheus metrics.  A task
+    that removes old files from the workspace folder runs every 10 minutes.
+    If the app pool is enabled each worker fills its own pool, on its event
+    loop, after its first session starts.
+
+    With the default settings the server runs in a single process, with
+    autoreload turned on, which is convenient for development.  If more than
+    one worker is requested the server forks that many processes and turns
+    autoreload off.  The project data is loaded before the processes are
+    created, so the workers share one copy of it, and OptiPass results are
+    saved in a cache folder shared by all the workers.
+
+    The Prometheus metrics are kept in files in a folder shared by all the
+    workers, so the /metrics page shows the totals for the whole server.
+    Unless PROMETHEUS_MULTIPROC_DIR names a folder, a temporary folder is
+    made here, and deleted when the server exits.
+
+    Args:
+        workers:  the number of server processes
+        port:  the port the server listens on
     """
+    global app_pool
+
+    # prometheus_client reads the folder name when it is imported, so it has
+    # to be set before importing any of the modules that use tidegates.metrics
+
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        folder = tempfile.mkdtemp(prefix='tidegates-metrics-')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = folder
+        parent = os.getpid()
+        atexit.register(lambda: os.getpid() == parent and shutil.rmtree(folder, ignore_errors=True))
+
+    import panel as pn
+    from tidegates import metrics
+    from tidegates.widgets import MapLayers, AppPool
+    from tidegates.project import load_project
+    from tidegates.cache import ResultCache
+    from tidegates.remote import RemoteSolver
+
     pn.extension(design='native')
+    load_project('static/workbook.csv', DataSet.TNC_OR)
+    OP.cache = ResultCache()
+    if OP.remote is None:
+        OP.remote = RemoteSolver.from_env()
+    pool = AppPool(new_app)
+    app_pool = pool if pool.size > 0 else None
     pn.serve( 
         {'tidegates': make_app},
-        port = 5006,
+        port = port,
         admin = True,
         verbose = True,
-        autoreload = True,
+        autoreload = workers <= 1,
+        num_procs = workers,
         websocket_origin= '*',
+        extra_patterns = metrics.routes(),
+        static_dirs = MapLayers.static_dirs(),
     )
 
 def validate_options(
@@ -137,14 +264,43 @@ def output_files(pattern):
     outputs = glob(f'tmp/{args.output}_*.txt')
     return sorted(outputs, key=number_part)
 
+def show_results(op):
+    """
+    Print the gate table and display the ROI curves made from the results of
+    an optimization, then log the time spent in each phase of the run.
+
+    Args:
+        op:  an OP object with the results of an optimization
+    """
+    from bokeh.io import show
+    from bokeh.layouts import row
+
+    print(op.table_view())
+    op.make_roi_curves()
+    if op.display_figures:
+        show(row([f for _, f in op.display_figures]))
+    op.log_timings()
+
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         Logging.setup('panel')
         start_app()
     else:
         args = init_cli()
+        OP.command = args.optipass
+        if args.remote or os.environ.get('OPTIPASS_URL'):
+            from tidegates.remote import RemoteSolver
+            OP.remote = RemoteSolver(args.remote) if args.remote else RemoteSolver.from_env()
+        if args.action == 'serve':
+            Logging.setup('panel')
+            start_app(args.workers, args.port)
+            exit(0)
         Logging.setup('api')
 
+        if args.action == 'validate':
+            from tidegates import validate
+            exit(validate.main([args.project]))
+
         p = Project(args.project, DataSet.TNC_OR)
         regions = p.regions if args.regions == 'all' else args.regions
         validate_options('region', regions, p.regions)
@@ -170,39 +326,71 @@ if __name__ == '__main__':
                 op.input_frame = op.generate_input_frame()
                 op.outputs = output_files(args.output)
                 op.collect_results(args.scaled)
-                print(op.table_view())
-                op.make_roi_curves().show()
+                show_results(op)
             case 'all':
                 op.generate_input_frame()
                 op.run(budgets, args.action=='preview')
                 if op.outputs is not None:
+                    from tidegates.history import RunStore
                     op.collect_results(args.scaled)
-                    print(op.table_view())
-                    op.make_roi_curves().show()
+                    RunStore().save(op, args.scaled)
+                    show_results(op)
+            case 'pareto':
+                if len(targets) < 2:
+                    print('--action pareto requires two or more targets')
+                    exit(1)
+                from bokeh.io import show
+                from tidegates.pareto import ParetoSweep
+                sweep = ParetoSweep(p, regions, targets, climate).run(budgets)
+                print(sweep.frontier().to_string(index=False))
+                show(sweep.figure())
+            case 'import':
+                if not args.output:
+                    print('--output required with --action import')
+                    exit(1)
+                from tidegates.results import ResultFile
+                try:
+                    op = ResultFile(args.output).make_op(p, args.scaled)
+                except (OSError, ValueError) as err:
+                    print(err)
+                    exit(1)
+                show_results(op)
+            case 'history':
+                from tidegates.history import RunStore
+                print(RunStore().find(limit=1000).to_string(index=False))
+            case 'reload' | 'sensitivity':
+                if not args.run:
+                    print(f'--run required with --action {args.action}')
+                    exit(1)
+                from tidegates.history import RunStore
+                try:
+                    op = RunStore().load(args.run, p)
+                except ValueError as err:
+                    print(err)
+                    exit(1)
+                if args.action == 'sensitivity':
+                    from tidegates.sensitivity import Sensitivity
+                    s = Sensitivity(op, draws=args.draws).run()
+                    for name, band in s.bands.items():
+                        print(name)
+                        print(band)
+                    print('Fraction of samples within budget')
+                    print(s.feasible)
+                    print('Robustness')
+                    print(s.robustness)
+                    op.set_bands(s.bands)
+                show_results(op)
             case 'gui':
                 if not (args.budget and args.output):
                     print('gui action requires --output and --budget')
                     exit(1)
-                app = make_app()
-                app.title = 'Tide Gate Optimization [Integration Test]'
-                app.optimize_button.disabled = True
-                for r in regions:
-                    for b in app.region_boxes.grid:
-                        if b.name == r:
-                            b.value = True
-                m = app.bf.targets['Current']
-                for t in targets:
-                    s = m[t].long
-                    for b in app.target_boxes.tabs[0].grid:
-                        if b.name == s:
-                            b.value = True
+                import panel as pn
                 op = OP(p,regions,targets,None,climate)
                 op.budget_max, op.budget_delta = budgets
                 op.input_frame = op.generate_input_frame()
                 op.outputs = output_files(args.output)
                 op.collect_results(False)
-                app.add_output_pane(op)
-                app.tabs.active = 2
+                app = integration_app(op)
                 pn.extension(design='native')
                 pn.serve(app, autoreload=True)
 
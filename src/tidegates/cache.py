@@ -0,0 +1,167 @@
+#
+# OptiPass result cache
+#
+# OptiPass is deterministic:  running it twice with the same barrier file,
+# budget, and target weights produces the same output file.  A ResultCache
+# saves each output file in a folder on disk, using a fingerprint of the
+# inputs as the file name, so a run that has already been done (by any
+# session, in any server process) can be copied from the cache instead of
+# running OptiPass again.  The $0 budget run, which every optimization
+# starts with, is the most common hit.
+#
+# Files are written to a temporary name and then renamed, so several server
+# processes can share a cache folder.  When the folder grows beyond its quota
+# the least recently used files are deleted.
+#
+# The location and size of the cache folder are set by environment variables:
+#
+#   TIDEGATES_CACHE       the cache folder (default "cache")
+#   TIDEGATES_CACHE_MB    the quota, in MB (default 256)
+#
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from . import metrics
+
+ROOT = os.environ.get('TIDEGATES_CACHE') or 'cache'
+MAX_BYTES = int(os.environ.get('TIDEGATES_CACHE_MB', 256)) * 1024 * 1024
+
+class ResultCache:
+    '''
+    A folder of OptiPass output files indexed by fingerprints of the inputs.
+
+    Attributes:
+      root:  the cache folder
+      max_bytes:  the quota for the folder
+    '''
+
+    def __init__(self, root: str = ROOT, max_bytes: int = MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def digest(barrier_file: str) -> str:
+        '''
+        Make a hash of the contents of a barrier file.  All the budget levels
+        of an optimization use the same file, so it only needs to be hashed once.
+        '''
+        h = hashlib.sha256()
+        with open(barrier_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def fingerprint(digest: str, *args) -> str:
+        '''
+        Make a key for an OptiPass run from the digest of the barrier file
+        and the other parameters (budget, number of targets, weights, and
+        the command that runs OptiPass).
+        '''
+        h = hashlib.sha256(digest.encode())
+        for x in args:
+            h.update(repr(x).encode())
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key + '.txt')
+
+    def get(self, key: str, dest: str) -> bool:
+        '''
+        If there is an output file for a key in the cache copy it to dest.
+
+        Returns:
+          True if the file was found
+        '''
+        src = self.path(key)
+        try:
+            shutil.copyfile(src, dest)
+            os.utime(src)                   # update the time used by the LRU sweep
+            hit = True
+        except FileNotFoundError:
+            hit = False
+        metrics.record_cache('optipass', hit)
+        return hit
+
+    def put(self, key: str, src: str):
+        '''
+        Save a copy of an output file in the cache.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, self.path(key))
+        self.trim()
+
+    def trim(self):
+        '''
+        Delete the least recently used files until the folder is under its quota.
+        '''
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+####################
+#
+# Unit tests
+#
+
+class TestResultCache:
+
+    @staticmethod
+    def test_get_put():
+        '''
+        A file saved in the cache should be copied out under its key, and
+        changing the barrier file should change the key.
+        '''
+        with tempfile.TemporaryDirectory() as d:
+            cache = ResultCache(os.path.join(d, 'cache'))
+            bf = os.path.join(d, 'barriers.txt')
+            with open(bf, 'w') as f:
+                f.write('ID\tDSID\nA\tNA\n')
+            key = ResultCache.fingerprint(ResultCache.digest(bf), 100, 1, [1])
+            out = os.path.join(d, 'out.txt')
+            assert not cache.get(key, out)
+            with open(out, 'w') as f:
+                f.write('BUDGET:\t100\n')
+            cache.put(key, out)
+            copy = os.path.join(d, 'copy.txt')
+            assert cache.get(key, copy)
+            assert open(copy).read() == 'BUDGET:\t100\n'
+            with open(bf, 'a') as f:
+                f.write('B\tA\n')
+            assert ResultCache.fingerprint(ResultCache.digest(bf), 100, 1, [1]) != key
+            assert ResultCache.fingerprint(ResultCache.digest(bf), 200, 1, [1]) != key
+
+    @staticmethod
+    def test_trim():
+        '''
+        When the cache is over its quota the oldest files are deleted.
+        '''
+        with tempfile.TemporaryDirectory() as d:
+            cache = ResultCache(os.path.join(d, 'cache'), max_bytes=250)
+            src = os.path.join(d, 'out.txt')
+            with open(src, 'w') as f:
+                f.write('x' * 100)
+            for i in range(3):
+                cache.put(f'k{i}', src)
+                os.utime(cache.path(f'k{i}'), (1000 + i, 1000 + i))
+            assert sorted(os.listdir(cache.root)) == ['k1.txt', 'k2.txt']
@@ -0,0 +1,310 @@
+#
+# What-if evaluation
+#
+# An Evaluator answers the question "how much would potential habitat change
+# if these gates were added to (or removed from) the solution for a budget
+# level?" without running OptiPass again.
+#
+# For a gate g the change is exact and needs only two numbers per target:
+#
+#   delta = d[g] * u[g] * (p' - p)
+#
+# where p and p' are the passabilities of g before and after the change, d[g]
+# is the product of passabilities below g (on the path to the mouth) and u[g]
+# is the habitat upstream from g, discounted by the barriers in between (see
+# network.py).  The evaluator keeps u for every barrier.  Changing the
+# passability of g only changes u for the barriers below it, so after each
+# change u is updated along that path, and a set of gates is evaluated by
+# changing them one at a time.  The cost of evaluating a gate is proportional
+# to its depth in the network, not the size of the network.
+#
+# The same updates are used to compute potential habitat for all the budget
+# levels of an optimization (see sweep):  the habitat for the first budget is
+# computed from scratch, and each of the following levels is derived from the
+# previous one by toggling only the gates whose action changed.
+#
+
+import numpy as np
+import pandas as pd
+
+from .optipass import OP
+
+class Evaluator:
+    '''
+    Incremental evaluation of changes to a solution.
+
+    Attributes:
+      op:  the OP object with the results of an optimization
+      budget:  the budget level of the solution
+      selected:  a boolean vector, True for each barrier in the current solution
+    '''
+
+    def __init__(self, op: OP, budget: int, scaled: bool = False):
+        '''
+        Arguments:
+          op:  an OP object, after calling collect_results
+          budget:  the budget level of the solution to start from
+          scaled:  if True use scaled habitat amounts
+        '''
+        self.op = op
+        self.budget = budget
+        a = op.arrays()
+        self.network = a.network
+        self.ids = list(a.ids)
+        self.index = { g: i for i, g in enumerate(self.ids) }
+
+        # The arrays in a BarrierArrays object have one row per barrier; the
+        # evaluator uses the transposes (one row per target) so the values for
+        # a barrier are in a column
+
+        self.cost = a.cost
+        self.weights = np.array(op.weights, dtype=float)
+        self.pre = a.pre.T
+        self.post = a.post.T
+        self.habitat = (a.habitat if scaled else a.unscaled).T
+
+        self.paths = { }
+        self.reset(op.matrix[budget].to_numpy(dtype=bool))
+
+    def reset(self, selected: np.ndarray):
+        '''
+        Start over from a different solution.
+
+        Arguments:
+          selected:  a boolean vector with one value for each barrier
+        '''
+        self.selected = np.array(selected, dtype=bool)
+        self.p = np.where(self.selected, self.post, self.pre)
+        self.u = self.network.upstream(self.p.T, self.habitat.T).T
+        self.roots = self.network.levels[0]
+
+    def per_target(self) -> np.ndarray:
+        '''
+        Return a vector with the potential habitat of each target for the current solution.
+        '''
+        return (self.p[:, self.roots] * self.u[:, self.roots]).sum(axis=1)
+
+    def total(self) -> float:
+        '''
+        Return the weighted potential habitat of the current solution.
+        '''
+        return float(self.weights @ self.per_target())
+
+    def solution_cost(self) -> float:
+        '''
+        Return the total cost of the gates in the current solution.
+        '''
+        return float(self.cost[self.selected].sum())
+
+    def path(self, i: int) -> np.ndarray:
+        '''
+        Return the indices of the barriers below barrier i, nearest first.
+        Paths are found when they are first needed and saved.
+        '''
+        if i not in self.paths:
+            parent = self.network.parent
+            path = []
+            j = parent[i]
+            while j >= 0:
+                path.append(j)
+                j = parent[j]
+            self.paths[i] = np.array(path, dtype=int)
+        return self.paths[i]
+
+    def _flip(self, i: int, undo: list = None) -> np.ndarray:
+        '''
+        Add or remove the barrier with index i, update the upstream habitat of
+        the barriers below it, and return the change in habitat for each target.
+        If an undo list is passed the values that are changed are appended to it.
+        '''
+        path = self.path(i)
+        old = self.p[:, i].copy()
+        new = self.pre[:, i] if self.selected[i] else self.post[:, i]
+        dp = new - old
+        below = self.p[:, path]
+        delta = below.prod(axis=1) * self.u[:, i] * dp
+        if undo is not None:
+            undo.append((i, old, self.u[:, path]))
+        if len(path):
+            factors = np.ones(below.shape)
+            np.cumprod(below[:, :-1], axis=1, out=factors[:, 1:])
+            self.u[:, path] += (dp * self.u[:, i])[:, None] * factors
+        self.p[:, i] = new
+        self.selected[i] = not self.selected[i]
+        return delta
+
+    def _indices(self, gates) -> list[int]:
+        if isinstance(gates, str):
+            gates = [gates]
+        return [self.index[g] for g in gates]
+
+    def toggle(self, gates) -> tuple:
+        '''
+        Add gates that are not in the current solution and remove gates that are.
+        The solution is updated, so a series of calls can be used to explore
+        different swaps.
+
+        Arguments:
+          gates:  a barrier ID or a list of IDs
+
+        Returns:
+          the change in weighted potential habitat and the change in cost
+        '''
+        dh = dc = 0.0
+        for i in self._indices(gates):
+            dc += -self.cost[i] if self.selected[i] else self.cost[i]
+            dh += float(self.weights @ self._flip(i))
+        return dh, dc
+
+    def evaluate(self, gates) -> tuple:
+        '''
+        Compute the effect of toggling a set of gates (see toggle) without
+        changing the current solution.
+
+        Returns:
+          the change in weighted potential habitat and the change in cost
+        '''
+        undo = []
+        dh = dc = 0.0
+        try:
+            for i in self._indices(gates):
+                dc += -self.cost[i] if self.selected[i] else self.cost[i]
+                dh += float(self.weights @ self._flip(i, undo))
+        finally:
+            for i, p, u in reversed(undo):
+                self.u[:, self.paths[i]] = u
+                self.p[:, i] = p
+                self.selected[i] = not self.selected[i]
+        return dh, dc
+
+    def gains(self) -> pd.Series:
+        '''
+        Return the change in weighted potential habitat from toggling each
+        barrier by itself:  a positive value for a barrier that is not in the
+        solution is the gain from adding it, a negative value for a barrier in
+        the solution is the loss from removing it.
+        '''
+        c = self.network.cumulative(self.p.T)
+        d = self.network.downstream(c).T
+        dp = np.where(self.selected, self.pre, self.post) - self.p
+        return pd.Series(self.weights @ (d * self.u * dp), index=self.ids)
+
+    @staticmethod
+    def sweep(op: OP, scaled: bool = False) -> np.ndarray:
+        '''
+        Compute the potential habitat of each target at every budget level of
+        an optimization.  The first level is computed from scratch; each of the
+        others is found by toggling the gates that differ from the previous level.
+
+        Arguments:
+          op:  an OP object with a selection matrix
+          scaled:  if True use scaled habitat amounts
+
+        Returns:
+          an array with one row for each budget level and one column for each target
+        '''
+        budgets = [int(b) for b in op.summary.budget]
+        matrix = op.matrix[budgets].to_numpy(dtype=bool)
+        ev = Evaluator(op, budgets[0], scaled)
+        rows = [ev.per_target()]
+        for j in range(1, len(budgets)):
+            for i in np.flatnonzero(matrix[:, j] != ev.selected):
+                ev._flip(i)
+            rows.append(ev.per_target())
+        return np.array(rows)
+
+####################
+#
+# Unit tests
+#
+
+class TestEvaluator:
+
+    @staticmethod
+    def make_op(d):
+        import os
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook, write_outputs
+
+        p = Project(write_workbook(os.path.join(d, 'wb.csv'), 300, nregions=3), DataSet.TNC_OR)
+        op = OP(p, p.regions[:2], ['CO','CH'], ['2', '1'], 'Current')
+        op.generate_input_frame()
+        op.outputs = write_outputs(op.input_frame, [0, 1000000, 2000000], os.path.join(d, 'out'), op.weights)
+        op.collect_results()
+        return op
+
+    @staticmethod
+    def test_total():
+        '''
+        The weighted habitat of each solution should match the values computed by OP.
+        '''
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            op = TestEvaluator.make_op(d)
+            for i, b in enumerate(op.summary.budget):
+                ev = Evaluator(op, int(b))
+                assert np.isclose(ev.total(), 2 * op.summary.CO[i] + op.summary.CH[i])
+
+    @staticmethod
+    def test_gain_columns():
+        '''
+        With no gates selected the marginal gains should match the gain
+        columns in the OP matrix.
+        '''
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            op = TestEvaluator.make_op(d)
+            expected = 2 * op.matrix.GAIN_CO + op.matrix.GAIN_CH
+            assert np.allclose(Evaluator(op, 0).gains(), expected[op.input_frame.ID])
+
+    @staticmethod
+    def test_sweep():
+        '''
+        The incremental sweep should give the same values as the path products
+        computed by OP._ah, with solutions that are not nested.
+        '''
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            op = TestEvaluator.make_op(d)
+            op.matrix[1000000] = op.matrix[2000000].to_numpy()[::-1]
+            data = op.project.data.set_index('BARID').fillna(0)
+            hab = Evaluator.sweep(op)
+            for i, t in enumerate(op.targets):
+                assert np.allclose(hab[:, i], op._ah(t, data, False))
+
+    @staticmethod
+    def test_toggle():
+        '''
+        The change reported for toggling a gate or a set of gates should equal
+        the difference between totals computed from scratch, and evaluate
+        should not change the solution.
+        '''
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            op = TestEvaluator.make_op(d)
+            ev = Evaluator(op, 1000000)
+            ids = list(op.input_frame.ID)
+            before = ev.total()
+            gains = ev.gains()
+            for g in ids[:40]:
+                dh, _ = ev.evaluate(g)
+                assert np.isclose(dh, gains[g])
+            assert np.isclose(ev.total(), before)
+
+            swap = list(dict.fromkeys([g for g in ids if ev.selected[ev.index[g]]][:2] + ids[1:6]))
+            dh, dc = ev.evaluate(swap)
+            after = ev.selected.copy()
+            after[[ev.index[g] for g in swap]] ^= True
+            fresh = Evaluator(op, 1000000)
+            fresh.reset(after)
+            assert np.isclose(before + dh, fresh.total())
+            assert np.isclose(ev.solution_cost() + dc, fresh.solution_cost())
+
+            ev.toggle(swap)
+            assert np.isclose(ev.total(), fresh.total())
+            assert np.allclose(ev.u, fresh.u)
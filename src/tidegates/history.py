@@ -0,0 +1,253 @@
+#
+# Run history
+#
+# A RunStore saves the results of optimization runs in a SQLite database so
+# they can be displayed again later without running OptiPass.  Each record has
+# the run parameters (regions, targets, weights, climate, budgets), the time
+# spent in each phase, the budget and habitat columns of the summary, and the
+# selection matrix (which barriers are in the solution at each budget level),
+# stored as a bit array.  The potential habitat columns are recomputed when a
+# run is loaded, which only takes a few milliseconds.
+#
+# Records are indexed by the run parameters.  Each run also has a fingerprint,
+# computed from the OptiPass input frame and the parameters, so repeating a
+# run updates the existing record instead of adding a new one, and a run is
+# not loaded if the barrier data has changed since it was saved.  The start
+# of the fingerprint is also used as a token that identifies a run in the
+# URL of the app, so a session can be resumed after the page is reloaded.
+#
+# The database is in history.db unless TIDEGATES_HISTORY specifies a
+# different file.
+#
+
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from .optipass import OP
+from .project import Project
+
+ROOT = os.environ.get('TIDEGATES_HISTORY') or 'history.db'
+
+TOKEN_LENGTH = 20
+HEX_DIGITS = set('0123456789abcdef')
+
+schema = '''
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        fingerprint TEXT UNIQUE,
+        created TEXT,
+        regions TEXT,
+        targets TEXT,
+        weights TEXT,
+        climate TEXT,
+        budget_max INTEGER,
+        budget_delta INTEGER,
+        scaled INTEGER,
+        timings TEXT,
+        summary TEXT,
+        nbarriers INTEGER,
+        matrix BLOB
+    );
+    CREATE INDEX IF NOT EXISTS runs_params ON runs (regions, targets, weights, climate);
+'''
+
+class RunStore:
+    '''
+    Save and load optimization results.
+
+    Attributes:
+      path:  the name of the database file
+    '''
+
+    def __init__(self, path: str = ROOT):
+        self.path = path
+        with self.connect() as db:
+            db.executescript(schema)
+
+    def connect(self):
+        '''
+        Open a connection to the database.  A new connection is made for each
+        operation so the store can be used by several threads and processes.
+        '''
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def params(op: OP) -> dict:
+        '''
+        Return a dictionary with the run parameters of an OP object, in the
+        form used in the database.
+        '''
+        return {
+            'regions': ','.join(sorted(op.regions)),
+            'targets': ','.join(t.abbrev for t in op.targets),
+            'weights': ','.join(str(w) for w in op.weights) if op.weighted else '',
+            'climate': op.climate or '',
+            'budget_max': int(op.budget_max),
+            'budget_delta': int(op.budget_delta),
+        }
+
+    @staticmethod
+    def fingerprint(op: OP, params: dict) -> str:
+        '''
+        Compute a hash of the OptiPass input frame and the run parameters.
+        '''
+        h = hashlib.sha256(op.input_frame.to_csv(index=False).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def save(self, op: OP, scaled: bool = False) -> int:
+        '''
+        Save the results of an optimization run.  If there is already a record
+        for a run with the same fingerprint the record is updated.
+
+        Arguments:
+          op:  an OP object, after calling collect_results
+          scaled:  the value passed to collect_results
+
+        Returns:
+          the ID of the record
+        '''
+        params = self.params(op)
+        budgets = [int(b) for b in op.summary.budget]
+        bits = op.matrix[budgets].to_numpy(dtype=np.uint8)
+        rec = params | {
+            'fingerprint': self.fingerprint(op, params),
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'scaled': int(scaled),
+            'timings': json.dumps(op.timer.phases),
+            'summary': json.dumps({'budget': budgets, 'habitat': [float(x) for x in op.summary.habitat]}),
+            'nbarriers': bits.shape[0],
+            'matrix': np.packbits(bits, axis=0).tobytes(),
+        }
+        cols = ', '.join(rec)
+        marks = ', '.join(':' + k for k in rec)
+        updates = ', '.join(f'{k} = excluded.{k}' for k in ['created', 'timings'])
+        with self.connect() as db:
+            db.execute(f'INSERT INTO runs ({cols}) VALUES ({marks}) ON CONFLICT(fingerprint) DO UPDATE SET {updates}', rec)
+            row = db.execute('SELECT id FROM runs WHERE fingerprint = ?', (rec['fingerprint'],)).fetchone()
+        return row[0]
+
+    def token(self, run_id: int) -> str:
+        '''
+        Return the token for a saved run, or None if there is no run with that ID.
+        '''
+        with self.connect() as db:
+            row = db.execute('SELECT fingerprint FROM runs WHERE id = ?', (run_id,)).fetchone()
+        return row[0][:TOKEN_LENGTH] if row else None
+
+    def lookup(self, token: str) -> int:
+        '''
+        Return the ID of the run with a token, or None if the token is not valid.
+        Fingerprints are lower case hex digits, so the fingerprints that start
+        with the token are the ones between the token and the token followed
+        by 'g', and the query can use the index on the fingerprint column.
+        '''
+        if not token or len(token) != TOKEN_LENGTH or not set(token) <= HEX_DIGITS:
+            return None
+        with self.connect() as db:
+            row = db.execute('SELECT id FROM runs WHERE fingerprint >= ? AND fingerprint < ?', (token, token + 'g')).fetchone()
+        return row[0] if row else None
+
+    def find(self, regions: list[str] = None, targets: list[str] = None, climate: str = None, limit: int = 50) -> pd.DataFrame:
+        '''
+        Return a table describing the most recent runs, optionally limited to runs
+        with a specified set of regions, targets, or climate.
+        '''
+        where = []
+        args = []
+        if regions:
+            where.append('regions = ?')
+            args.append(','.join(sorted(regions)))
+        if targets:
+            where.append('targets = ?')
+            args.append(','.join(targets))
+        if climate:
+            where.append('climate = ?')
+            args.append(climate)
+        sql = 'SELECT id, created, regions, targets, weights, climate, budget_max, budget_delta FROM runs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY created DESC, id DESC LIMIT ?'
+        with self.connect() as db:
+            return pd.read_sql_query(sql, db, params=args + [limit])
+
+    def load(self, run_id: int, project: Project) -> OP:
+        '''
+        Make an OP object with the results of a saved run.
+
+        Arguments:
+          run_id:  the ID of the record
+          project:  the Project with the barrier data used in the run
+
+        Returns:
+          an OP object with the same attributes it had when the run was saved
+        '''
+        with self.connect() as db:
+            db.row_factory = sqlite3.Row
+            rec = db.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+        if rec is None:
+            raise ValueError(f'no run with ID {run_id}')
+
+        weights = rec['weights'].split(',') if rec['weights'] else None
+        op = OP(project, rec['regions'].split(','), rec['targets'].split(','), weights, rec['climate'] or None)
+        op.budget_max, op.budget_delta = rec['budget_max'], rec['budget_delta']
+        op.generate_input_frame()
+        if self.fingerprint(op, self.params(op)) != rec['fingerprint']:
+            raise ValueError(f'barrier data has changed since run {run_id} was saved')
+
+        summary = json.loads(rec['summary'])
+        budgets = summary['budget']
+        packed = np.frombuffer(rec['matrix'], dtype=np.uint8).reshape(-1, len(budgets))
+        bits = np.unpackbits(packed, axis=0, count=rec['nbarriers'])
+        ids = op.input_frame.ID.to_numpy()
+        summary['gates'] = [list(ids[bits[:,j] == 1]) for j in range(len(budgets))]
+        op.load_results(pd.DataFrame(summary), bool(rec['scaled']))
+        return op
+
+####################
+#
+# Unit tests
+#
+
+class TestRunStore:
+
+    @staticmethod
+    def test_save_load():
+        '''
+        A run loaded from the store should have the same summary and
+        selection matrix as the original.
+        '''
+        import tempfile
+        from .targets import DataSet
+        from .synthetic import write_workbook, write_outputs
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 200, nregions=3), DataSet.TNC_OR)
+            op = OP(p, p.regions[:2], ['CO','CH'], ['3','1'], 'Current')
+            op.generate_input_frame()
+            op.budget_max, op.budget_delta = 2000000, 1000000
+            op.outputs = write_outputs(op.input_frame, [0, 1000000, 2000000], os.path.join(d, 'out'), [3,1])
+            op.collect_results()
+
+            store = RunStore(os.path.join(d, 'history.db'))
+            n = store.save(op)
+            assert store.save(op) == n
+            assert store.lookup(store.token(n)) == n
+            assert store.lookup('x' * TOKEN_LENGTH) is None
+            assert store.lookup(store.token(n)[:-1] + '%') is None
+            assert store.lookup('_' * TOKEN_LENGTH) is None
+            runs = store.find(targets=['CO','CH'])
+            assert list(runs.id) == [n] and runs.weights[0] == '3,1'
+            assert len(store.find(climate='Future')) == 0
+
+            res = store.load(n, p)
+            assert res.weights == [3,1]
+            assert list(res.summary.gates) == list(op.summary.gates)
+            assert res.matrix.equals(op.matrix)
+            assert res.summary.netgain.equals(op.summary.netgain)
@@ -4,8 +4,11 @@
 # terminal when running from the command line.
 #
 
-import panel as pn
 import logging
+import json
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
 
 class Logging:
 
@@ -31,11 +34,62 @@ class Logging:
     def api_log(*args):
         logging.info(' '.join([str(s) for s in args]))
 
+    @staticmethod
+    def panel_log(*args):
+        import panel as pn                  # imported here so the command line API doesn't load Panel
+        pn.state.log(*args)
+
     dispatch = {
         'none':   null,
-        'panel':  pn.state.log,
+        'panel':  panel_log,
         'api':    api_log,
     }
 
     def log(*args):
         Logging.dispatch[Logging.logger](*args)
+
+    @staticmethod
+    def record(event, **fields):
+        """
+        Emit a structured log record:  a JSON object with the event name
+        and the other fields, written as a single line.
+        """
+        Logging.log(json.dumps({'event': event} | fields, default=str))
+
+class Timer:
+    """
+    A Timer collects the time spent in each phase of an operation.  Phases
+    are timed by span, a context manager;  if a phase is entered more than
+    once its times are added together.
+
+    Attributes:
+      phases:  a dictionary that maps phase names to total time (in seconds)
+      counts:  a dictionary that maps phase names to the number of times the phase was entered
+    """
+
+    def __init__(self):
+        self.phases = { }
+        self.counts = { }
+
+    @contextmanager
+    def span(self, name):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + perf_counter() - t0
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+def timed(name):
+    """
+    Decorator for methods of objects that have a Timer in an attribute
+    named timer:  the time spent in the method is recorded in a phase
+    with the specified name.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timer.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,264 @@
+#
+# Prometheus metrics
+#
+# Counters, gauges, and histograms that describe the load on the server.
+# The values are exported in the Prometheus text format by a page that
+# start_app (in main.py) adds to the Bokeh server:
+#
+#   http://localhost:5006/metrics
+#
+# When the server runs several worker processes each process has its own
+# copy of the metrics.  If PROMETHEUS_MULTIPROC_DIR is set (main.py sets it
+# before starting the server) the processes write their values to files in
+# that folder, and the metrics page combines the values from all the files,
+# so the page shows totals for the whole server no matter which worker
+# handles the request.  The variable must be set before prometheus_client is
+# imported.  Each gauge has a multiprocess_mode that says how the values from
+# different processes are combined.
+#
+
+import atexit
+import os
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+SOLVER_RUNS = Counter(
+    'tidegates_solver_runs_total',
+    'Number of times OptiPass was run, by exit status',
+    ['status'],
+)
+
+SOLVER_LATENCY = Histogram(
+    'tidegates_solver_seconds',
+    'Time to run OptiPass once (one budget level)',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, float('inf')),
+)
+
+REMOTE_BATCH_LATENCY = Histogram(
+    'tidegates_remote_batch_seconds',
+    'Time for the remote service to solve all the budget levels of an optimization',
+    buckets=(0.5, 1, 2.5, 5, 10, 25, 60, 120, 300, float('inf')),
+)
+
+OPTIMIZATION_LATENCY = Histogram(
+    'tidegates_optimization_seconds',
+    'Time to run a complete optimization (all budget levels) for a GUI request',
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, float('inf')),
+)
+
+QUEUE_DEPTH = Gauge(
+    'tidegates_optimizations_in_progress',
+    'Number of optimization requests waiting for or running OptiPass',
+    multiprocess_mode='livesum',
+)
+
+ACTIVE_SESSIONS = Gauge(
+    'tidegates_active_sessions',
+    'Number of open browser sessions',
+    multiprocess_mode='livesum',
+)
+
+CACHE_REQUESTS = Counter(
+    'tidegates_cache_requests_total',
+    'Cache lookups, by cache name and result (hit or miss)',
+    ['cache', 'result'],
+)
+
+PHASE_LATENCY = Histogram(
+    'tidegates_phase_seconds',
+    'Time spent in each phase of an optimization run',
+    ['phase'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, float('inf')),
+)
+
+TMP_BYTES = Gauge(
+    'tidegates_tmp_bytes',
+    'Disk space used by files in the temporary folder',
+    multiprocess_mode='livemax',
+)
+
+WORKSPACES = Gauge(
+    'tidegates_workspaces',
+    'Number of run folders owned by open sessions',
+    multiprocess_mode='livesum',
+)
+
+WORKSPACES_REMOVED = Counter(
+    'tidegates_workspaces_removed_total',
+    'Files and folders deleted from the temporary folder, by reason (released, age, or quota)',
+    ['reason'],
+)
+
+PROCESS_RSS = Gauge(
+    'tidegates_process_rss_bytes',
+    'Resident set size of each server process',
+    multiprocess_mode='liveall',
+)
+
+def folder_size(path: str) -> int:
+    '''
+    Return the total size (in bytes) of all files in a folder and its subfolders,
+    or 0 if the folder does not exist.
+    '''
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                pass                # file deleted while we were scanning
+    return total
+
+def process_rss() -> int:
+    '''
+    Return the resident set size (in bytes) of this process.
+    '''
+    import psutil
+    return psutil.Process().memory_info().rss
+
+# Functions called by refresh, added by the modules that own the values
+# (e.g. workspace.py sets TMP_BYTES)
+
+refresh_hooks = []
+
+def on_refresh(func):
+    '''
+    Add a function to call each time the metrics page is made.
+    '''
+    refresh_hooks.append(func)
+
+def refresh():
+    '''
+    Update the gauges that are computed when the metrics page is made.  (Gauges
+    with set_function cannot be used in multiprocess mode, so the values are set
+    here instead.)
+    '''
+    PROCESS_RSS.set(process_rss())
+    for func in refresh_hooks:
+        func()
+
+def exposition() -> bytes:
+    '''
+    Return the metrics in the Prometheus text format.  In multiprocess mode the
+    values are collected from the files written by all the worker processes.
+    '''
+    refresh()
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+# In multiprocess mode, remove the values of the "live" gauges of a process
+# when it exits, so they are no longer included in the totals
+
+if MULTIPROC_DIR:
+    atexit.register(lambda: multiprocess.mark_process_dead(os.getpid()))
+
+def record_cache(name: str, hit: bool):
+    '''
+    Count a cache lookup.
+
+    Arguments:
+      name:  the name of the cache
+      hit:  True if the item was found in the cache
+    '''
+    CACHE_REQUESTS.labels(cache=name, result='hit' if hit else 'miss').inc()
+
+def observe_phases(phases: dict):
+    '''
+    Add the times recorded by a Timer to the phase histogram.
+
+    Arguments:
+      phases:  a dictionary that maps phase names to times (in seconds)
+    '''
+    for name, t in phases.items():
+        PHASE_LATENCY.labels(phase=name).observe(t)
+
+def session_started():
+    '''
+    Called when the server creates a new session.  Increment the session
+    count and register a callback that decrements it when the session ends.
+    '''
+    import panel as pn
+
+    ACTIVE_SESSIONS.inc()
+    PROCESS_RSS.set(process_rss())
+    pn.state.on_session_destroyed(lambda _: ACTIVE_SESSIONS.dec())
+
+def routes() -> list:
+    '''
+    Return a list of URL patterns to pass to the server (as the extra_patterns
+    option) to add a page that displays the metrics.
+    '''
+    from tornado.web import RequestHandler
+
+    class MetricsHandler(RequestHandler):
+        def get(self):
+            self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+            self.write(exposition())
+
+    return [('/metrics', MetricsHandler)]
+
+####################
+#
+# Unit tests
+#
+
+class TestMetrics:
+
+    @staticmethod
+    def test_exposition():
+        '''
+        The metrics page should include the names of the application metrics,
+        and values of gauges that are computed when the page is made.
+        '''
+        observe_phases({'parse': 0.01})
+        record_cache('test', True)
+        text = exposition().decode()
+        for name in ['tidegates_solver_seconds', 'tidegates_phase_seconds_count{phase="parse"}',
+                     'tidegates_cache_requests_total{cache="test",result="hit"}', 'tidegates_process_rss_bytes']:
+            assert name in text
+
+    @staticmethod
+    def test_multiprocess():
+        '''
+        In multiprocess mode the page should show the sum of the counters in
+        all the processes, and the live gauges of processes that are running.
+        '''
+        import subprocess
+        import sys
+        import tempfile
+
+        script = '''
+import os, sys
+sys.path.insert(0, 'src')
+from tidegates import metrics
+for i in range(3):
+    if os.fork() == 0:
+        metrics.SOLVER_RUNS.labels(status='ok').inc()
+        metrics.ACTIVE_SESSIONS.inc()
+        sys.exit(0)
+    os.wait()
+metrics.ACTIVE_SESSIONS.inc()
+sys.stdout.write(metrics.exposition().decode())
+'''
+        with tempfile.TemporaryDirectory() as d:
+            env = os.environ | { 'PROMETHEUS_MULTIPROC_DIR': d }
+            res = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+        assert res.returncode == 0, res.stderr
+        assert 'tidegates_solver_runs_total{status="ok"} 3.0' in res.stdout
+        assert 'tidegates_active_sessions 1.0' in res.stdout
+
+    @staticmethod
+    def test_folder_size():
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            os.mkdir(os.path.join(d, 'sub'))
+            for fn, n in [('a', 10), ('sub/b', 5)]:
+                with open(os.path.join(d, fn), 'w') as f:
+                    f.write('x' * n)
+            assert folder_size(d) == 15
+            assert folder_size(os.path.join(d, 'nosuch')) == 0
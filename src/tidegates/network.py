@@ -0,0 +1,203 @@
+#
+# Barrier networks
+#
+# A Network is an array representation of the forest defined by the DSID
+# column of a barrier frame:  each barrier has the index of its downstream
+# neighbor (its parent), and barriers are grouped by depth (distance from
+# the river mouth).  Values that depend on paths through the network are
+# computed one level at a time, with NumPy operations on all the barriers
+# in a level, instead of following the path from each barrier separately.
+#
+# If p is a vector of passabilities and h a vector of habitat amounts:
+#
+#   * cumulative(p) is the product of the passabilities on the path from
+#     each barrier to the mouth, including the barrier itself
+#
+#   * upstream(p, h) is the habitat above each barrier, discounted by the
+#     passabilities of the barriers between it and the barrier
+#
+#   * habitat(p, h) is the potential habitat, the sum of cumulative(p) * h
+#
+# All three methods also accept 2D arrays with one row for each barrier and
+# one column for each of several scenarios (e.g. the samples in a sensitivity
+# analysis), so all the scenarios are processed with the same NumPy
+# operations.  Barriers are on the first axis so the values for the barriers
+# in a level are copied as contiguous rows.
+#
+
+import numpy as np
+import pandas as pd
+
+class Network:
+    '''
+    Connectivity of a set of barriers.
+
+    Attributes:
+      ids:  barrier IDs, in the order of the frame passed to the constructor
+      parent:  the index of the downstream neighbor of each barrier (-1 for barriers at the mouth)
+      levels:  a list of index arrays, one for each depth, starting at the mouth
+    '''
+
+    def __init__(self, ids, dsid):
+        '''
+        Make a network from a list of barrier IDs and the ID of the downstream
+        neighbor of each barrier.  A barrier with no DSID, or a DSID that is
+        not in the list of IDs, is at the mouth of its river.
+
+        Arguments:
+          ids:  a sequence of barrier IDs
+          dsid:  a sequence of the same length with downstream IDs
+        '''
+        self.ids = np.asarray(ids)
+        pos = pd.Series(np.arange(len(self.ids)), index=self.ids)
+        parent = pd.Series(np.asarray(dsid, dtype=object)).map(pos)
+        self.parent = parent.fillna(-1).to_numpy(dtype=int)
+
+        depth = np.full(len(self.ids), -1)
+        level = np.flatnonzero(self.parent < 0)
+        self.levels = []
+        while len(level):
+            depth[level] = len(self.levels)
+            self.levels.append(level)
+            level = np.flatnonzero(np.isin(self.parent, level))
+        if (depth < 0).any():
+            raise ValueError('barrier network has a cycle')
+
+        # For the bottom-up pass:  in each level (except the first) the order
+        # that groups barriers by parent, the parents, and where each group starts
+
+        self.groups = []
+        for level in self.levels[1:]:
+            order = np.argsort(self.parent[level], kind='stable')
+            parents, starts = np.unique(self.parent[level][order], return_index=True)
+            self.groups.append((level[order], parents, starts))
+
+    @staticmethod
+    def from_frame(frame: pd.DataFrame):
+        '''
+        Make a network from a frame with ID and DSID columns (e.g. an OptiPass input frame).
+        '''
+        return Network(frame.ID, frame.DSID.where(frame.DSID.notnull(), None))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def cumulative(self, p: np.ndarray) -> np.ndarray:
+        '''
+        Compute the product of passabilities on the path from each barrier
+        to the mouth.
+
+        Arguments:
+          p:  passabilities, with the barrier index on the first axis
+
+        Returns:
+          an array with the same shape as p
+        '''
+        c = np.array(p, dtype=float)
+        for level in self.levels[1:]:
+            c[level] *= c[self.parent[level]]
+        return c
+
+    def upstream(self, p: np.ndarray, h: np.ndarray) -> np.ndarray:
+        '''
+        Compute the habitat upstream from each barrier:  the habitat at the
+        barrier plus, for each barrier above it, its habitat times the product
+        of passabilities on the path between the two barriers (not including
+        the passability of the barrier itself).
+
+        Arguments:
+          p:  passabilities, with the barrier index on the first axis
+          h:  habitat amounts, with the same shape as p or a vector
+
+        Returns:
+          an array with the shape of p
+        '''
+        p = np.asarray(p, dtype=float)
+        h = np.asarray(h, dtype=float)
+        if h.ndim < p.ndim:
+            h = h.reshape(h.shape + (1,) * (p.ndim - h.ndim))
+        u = np.broadcast_to(h, p.shape).copy()
+        for idx, parents, starts in reversed(self.groups):
+            u[parents] += np.add.reduceat(p[idx] * u[idx], starts, axis=0)
+        return u
+
+    def habitat(self, p: np.ndarray, h: np.ndarray) -> np.ndarray:
+        '''
+        Compute potential habitat, the sum over all barriers of habitat times
+        the product of passabilities on the path to the mouth.
+
+        Arguments:
+          p:  passabilities, with the barrier index on the first axis
+          h:  habitat amounts, a vector with one value for each barrier
+
+        Returns:
+          a number, or an array with one value for each column of p
+        '''
+        return np.asarray(h, dtype=float) @ self.cumulative(p)
+
+    def downstream(self, c: np.ndarray) -> np.ndarray:
+        '''
+        Given the cumulative passabilities, return the product of passabilities
+        strictly below each barrier (1 for barriers at the mouth).
+        '''
+        d = np.ones_like(c)
+        has_parent = self.parent >= 0
+        d[has_parent] = c[self.parent[has_parent]]
+        return d
+
+####################
+#
+# Unit tests
+#
+
+class TestNetwork:
+
+    @staticmethod
+    def network():
+        #   A is at the mouth, B and C are above A, D is above B, E is a separate river
+        return Network(list('ABCDE'), [None, 'A', 'A', 'B', None])
+
+    @staticmethod
+    def test_levels():
+        n = TestNetwork.network()
+        assert list(n.parent) == [-1, 0, 0, 1, -1]
+        assert [list(x) for x in n.levels] == [[0, 4], [1, 2], [3]]
+
+    @staticmethod
+    def test_habitat():
+        '''
+        The vectorized methods should agree with values computed one path at a time.
+        '''
+        n = TestNetwork.network()
+        p = np.array([0.5, 0.2, 1.0, 0.4, 0.3])
+        h = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+        paths = { 0: [0], 1: [1, 0], 2: [2, 0], 3: [3, 1, 0], 4: [4] }
+        c = [np.prod(p[paths[i]]) for i in range(5)]
+        assert np.allclose(n.cumulative(p), c)
+        assert np.isclose(n.habitat(p, h), sum(c * h))
+        u = n.upstream(p, h)
+        assert np.isclose(u[1], 2.0 + 0.4 * 4.0)
+        assert np.isclose(u[0], 1.0 + 0.2 * u[1] + 1.0 * 3.0)
+        assert np.isclose(p[0] * u[0] + p[4] * u[4], n.habitat(p, h))
+        assert np.allclose(n.downstream(n.cumulative(p)), [1, 0.5, 0.5, 0.1, 1])
+
+    @staticmethod
+    def test_batch():
+        '''
+        Each column of a 2D array should give the same result as a single vector.
+        '''
+        n = TestNetwork.network()
+        rng = np.random.default_rng(1)
+        p = rng.random((5, 3))
+        h = rng.random(5)
+        for i in range(3):
+            assert np.allclose(n.habitat(p, h)[i], n.habitat(p[:,i], h))
+            assert np.allclose(n.upstream(p, h)[:,i], n.upstream(p[:,i], h))
+
+    @staticmethod
+    def test_cycle():
+        try:
+            Network(['A', 'B'], ['B', 'A'])
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
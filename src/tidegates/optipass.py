@@ -2,22 +2,18 @@
 import platform
 import os
 import subprocess
+import time
 from glob import glob
 from math import prod
 
 import pandas as pd
-import param
 import numpy as np
-import panel as pn
-import networkx as nx
 import tempfile
 
-from bokeh.plotting import figure
-from bokeh.models import NumeralTickFormatter, HoverTool, Title
+# NOTE:  networkx, Bokeh, and Matplotlib are imported by the methods that use
+# them so the command line API doesn't have to wait for them to load
 
-import matplotlib.pyplot as plt
-
-from .messages import Logging
+from .messages import Logging, Timer, timed
 from .project import Project
 from .targets import DataSet
 
@@ -61,7 +57,13 @@ class OP:
         self.targets = [structs[t] for t in targets]
         self.input_frame = None
         self.outputs = None
+        self.timer = Timer()
+        self.plots = []
+        self.figures = { }
+        self.bands = { }
+        self._arrays = None
 
+    @timed('generate_input_frame')
     def generate_input_frame(self):
         '''
         Create a data frame that will be written in the format of a "barrier
@@ -107,13 +109,57 @@ class OP:
 
         return df
 
+    @timed('write_barrier_file')
+    def write_barrier_file(self, fn):
+        '''
+        Save the input frame in a tab-separated file that can be passed to
+        OptiPass with the -f option.
+
+        Arguments:
+          fn:  the name of the file to write
+        '''
+        self.input_frame.to_csv(fn, index=False, sep='\t', lineterminator=os.linesep, na_rep='NA')
+
+    # The command used to run OptiPass.  If this is None, the command is taken
+    # from the OPTIPASS_COMMAND environment variable or is based on the platform.
+
+    command = None
+
+    # An optional ResultCache (see cache.py).  If it is defined, run copies output
+    # files from the cache instead of running OptiPass with the same inputs again.
+
+    cache = None
+
+    # An optional RemoteSolver (see remote.py).  If it is defined, run sends all
+    # the budget levels that are not in the cache to a remote OptiPass service
+    # in one request instead of running OptiPass locally.
+
+    remote = None
+
+    @staticmethod
+    def optipass_command():
+        '''
+        Return the shell command that runs OptiPass, or None if there is no way to
+        run it on this system.  A command set in OP.command takes precedence,
+        followed by the value of the OPTIPASS_COMMAND environment variable (e.g. to
+        run bin/optipass_standin.py for testing).  Otherwise, if the shell environment
+        includes a variable named WINEARCH it means the script is running on Linux,
+        and we need to use Wine, or else use a command that will run on Windows.
+        '''
+        if cmnd := OP.command or os.environ.get('OPTIPASS_COMMAND'):
+            return cmnd
+        if platform.system() == 'Windows':
+            return 'bin\\OptiPassMain.exe'
+        if platform.system() == 'Linux' and os.environ.get('WINEARCH'):
+            return 'wine bin/OptiPassMain.exe'
+        return None
+
     # def run(self, budgets: list[int], preview: bool, progress_hook = lambda: 0):
-    def run(self, budgets: list[int], preview: bool):
+    def run(self, budgets: list[int], preview: bool, folder: str = 'tmp'):
         '''
-        Generate and execute the shell commands that run OptiPass.  If the shell
-        environment includes a variable named WINEARCH it means the script is
-        running on Linux, and we need to use Wine, otherwise build a command that
-        will run on Windows.
+        Generate and execute the shell commands that run OptiPass.  The
+        command that runs OptiPass is determined by optipass_command, unless
+        a remote service is defined (see OP.remote).
 
         The first time OptiPass is run it will be given a budget of $0 to establish
         the current passage levels.  It's then run once more at each level in the
@@ -126,26 +172,32 @@ class OP:
         Arguments:
           budgets:  a list of budget values (dollar amounts)
           preview:  if True, print shell commands but don't execute them
+          folder:  the directory for the barrier file and output files
         '''
-        if platform.system() == 'Windows':
-            app = 'bin\\OptiPassMain.exe'
-        elif platform.system() == 'Linux' and os.environ.get('WINEARCH'):
-            app = 'wine bin/OptiPassMain.exe'
-        else:
+        from . import metrics
+
+        if OP.remote:
+            app = OP.remote.url
+        elif (app := OP.optipass_command()) is None:
             Logging.log(f'{platform.system()} not configured to run WINE')
             self.outputs = None
             return
-        
+
         template = app + ' -f {bf} -o {of} -b {n}'
 
-        df = self.generate_input_frame()
-        _, barrier_file = tempfile.mkstemp(suffix='.txt', dir='./tmp', text=True)
-        df.to_csv(barrier_file, index=False, sep='\t', lineterminator=os.linesep, na_rep='NA')
+        self.generate_input_frame()
+        os.makedirs(folder, exist_ok=True)
+        fd, barrier_file = tempfile.mkstemp(suffix='.txt', dir=folder, text=True)
+        os.close(fd)
+        self.write_barrier_file(barrier_file)
+        self.barrier_file = barrier_file
 
         self.budget_max, self.budget_delta = budgets
         num_budgets = self.budget_max // self.budget_delta
         outputs = []
+        remote = []
         root, _ = os.path.splitext(barrier_file)
+        digest = OP.cache.digest(barrier_file) if OP.cache and not preview else None
         for i in range(num_budgets + 1):
             outfile = f'{root}_{i+1}.txt'
             budget = self.budget_delta * i
@@ -153,50 +205,116 @@ class OP:
             if (num_targets := len(self.targets)) > 1:
                 cmnd += ' -t {}'.format(num_targets)
                 cmnd += ' -w ' + ', '.join([str(n) for n in self.weights])
+            key = None
+            if digest:
+                key = OP.cache.fingerprint(digest, app, budget, num_targets, self.weights)
+                if OP.cache.get(key, outfile):
+                    outputs.append(outfile)
+                    continue
+            if OP.remote and not preview:
+                remote.append((budget, outfile, key))
+                outputs.append(outfile)
+                continue
             Logging.log(cmnd)
             print(cmnd)
             if not preview:
-                res = subprocess.run(cmnd, shell=True, capture_output=True)
+                with self.timer.span('optipass'), metrics.SOLVER_LATENCY.time():
+                    res = subprocess.run(cmnd, shell=True, capture_output=True)
+                metrics.SOLVER_RUNS.labels(status='ok' if res.returncode == 0 else 'failed').inc()
                 print(res.stdout)
                 print(res.stderr)
             if preview or (res.returncode == 0):
                 outputs.append(outfile)
+                if key and os.path.exists(outfile):
+                    OP.cache.put(key, outfile)
                 # progress_hook()
             else:
                 Logging.log('OptiPass failed:')
                 Logging.log(res.stderr)
+        if remote:
+            outputs = self._run_remote(barrier_file, remote, outputs)
         self.outputs = outputs
 
+    def _run_remote(self, barrier_file, jobs, outputs):
+        '''
+        Solve a set of budget levels with the remote service, save the results
+        in the cache, and return the list of outputs without the files for
+        budget levels that could not be solved.
+
+        Arguments:
+          barrier_file:  the name of the OptiPass input file
+          jobs:  a list of (budget, output file, cache key) tuples
+          outputs:  the names of all the output files, in budget order
+        '''
+        from . import metrics
+
+        Logging.log(f'{OP.remote.url}: {len(jobs)} budget levels')
+        start = time.perf_counter()
+        with self.timer.span('optipass'):
+            written = set(OP.remote.solve(barrier_file, [(b, fn) for b, fn, _ in jobs], len(self.targets), self.weights))
+        elapsed = time.perf_counter() - start
+        metrics.REMOTE_BATCH_LATENCY.observe(elapsed)
+        for _, outfile, key in jobs:
+            metrics.SOLVER_LATENCY.observe(elapsed / len(jobs))
+            metrics.SOLVER_RUNS.labels(status='ok' if outfile in written else 'failed').inc()
+            if key and outfile in written:
+                OP.cache.put(key, outfile)
+        failed = { fn for _, fn, _ in jobs } - written
+        return [fn for fn in outputs if fn not in failed]
+
     def collect_results(self, scaled=False):
         '''
         Parse the output files produced by OptiPass (the file names are in
         self.outputs) and collect the results, which are saved in two Pandas
         data frames.
         '''
-        df = self.input_frame
-        G = nx.from_pandas_edgelist(
-            df[df.DSID.notnull()], 
-            source='ID', 
-            target='DSID', 
-            create_using=nx.DiGraph
-        )
-        for x in df[df.DSID.isnull()].ID:
-            G.add_node(x)
-        self.paths = { n: self._path_from(n,G) for n in G.nodes }
-
         cols = { x: [] for x in ['budget', 'habitat', 'gates']}
-        for fn in self.outputs:
-            self._parse_op_output(fn, cols)
-        self.summary = pd.DataFrame(cols)
+        with self.timer.span('parse'):
+            for fn in self.outputs:
+                self._parse_op_output(fn, cols)
+        self.load_results(pd.DataFrame(cols), scaled)
+
+    def load_results(self, summary, scaled=False):
+        '''
+        Save the results of an optimization and compute the potential habitat
+        for each budget level.  Called by collect_results, and to restore the
+        results of a previous run (see history.py).
+
+        Arguments:
+          summary:  a data frame with budget, habitat, and gates columns
+          scaled:  True if the benefit should be computed using scaled habitat amounts
+        '''
+        self._make_paths()
+        self.summary = summary
         
         dct = {}
         for i in range(len(self.summary)):
             b = int(self.summary.budget[i])
-            dct[b] = [ 1 if g in self.summary.gates[i] else 0 for g in self.input_frame.ID]
+            dct[b] = self.input_frame.ID.isin(self.summary.gates[i]).to_numpy(dtype=int)
         self.matrix = pd.DataFrame(dct, index=self.input_frame.ID)
         self.matrix['count'] = self.matrix.sum(axis=1)
         self.potential_habitat(self.targets, scaled)
 
+    @timed('paths')
+    def _make_paths(self):
+        '''
+        Build a graph of barrier connectivity from the DSID column of the input
+        frame and save the path from each barrier to the river mouth in the
+        paths attribute.
+        '''
+        import networkx as nx
+
+        df = self.input_frame
+        G = nx.from_pandas_edgelist(
+            df[df.DSID.notnull()],
+            source='ID',
+            target='DSID',
+            create_using=nx.DiGraph
+        )
+        for x in df[df.DSID.isnull()].ID:
+            G.add_node(x)
+        self.paths = { n: self._path_from(n,G) for n in G.nodes }
+
     def _path_from(self, x, graph):
         '''
         Return a list of nodes in the path from a barrier to a downstream barrier that
@@ -206,6 +324,8 @@ class OP:
           x: the barrier at the start of the path
           graph:  the digraph with barrier connectivity
         '''
+        import networkx as nx
+
         return [x] + [child for _, child in nx.dfs_edges(graph,x)]
 
     def _parse_op_output(self, fn, dct):
@@ -257,6 +377,7 @@ class OP:
                     lst.append(name)
             dct['gates'].append(lst)
 
+    @timed('potential_habitat')
     def potential_habitat(self, tlist, scaled):
         '''
         Compute the potential habitat available before and after restoration, using
@@ -266,18 +387,21 @@ class OP:
           tlist:  list of target IDs
           scaled:  True if we should create weighted potential habitat values
         '''
+        from .evaluator import Evaluator
+
         filtered = self.project.data[self.project.data.REGION.isin(self.regions)].fillna(0)
         filtered.index = filtered.BARID
+        habitat = Evaluator.sweep(self, scaled)
+        gains = None if scaled else self._gains()
         wph = np.zeros(len(self.summary))
         for i in range(len(tlist)):
             t = self.targets[i]
-            cp = self._ah(t, filtered, scaled)
+            cp = habitat[:, i]
             wph += (self.weights[i] * cp)
             col = pd.DataFrame({t.abbrev: cp})
             self.summary = pd.concat([self.summary, col], axis=1)
             if not scaled:
-                gain = self._gain(t, filtered)
-                self.matrix = pd.concat([self.matrix, filtered[t.unscaled], gain], axis=1)
+                self.matrix = pd.concat([self.matrix, filtered[t.unscaled], gains[f'GAIN_{t.abbrev}']], axis=1)
 
         # If scaled is True add the wph column so we can compare with OP values
         if scaled:
@@ -289,7 +413,10 @@ class OP:
     def _ah(self, target, data, scaled):
         """
         Compute the available habitat for a target, in the form of
-        a vector of habitat values for each budget level;
+        a vector of habitat values for each budget level.  This is the
+        direct computation, following the path from every barrier at every
+        budget level;  potential_habitat uses the much faster incremental
+        method in evaluator.py, and this method is kept to test it.
 
         Arguments:
           target:  a Target object (with ID and names of data columns to use)
@@ -306,10 +433,41 @@ class OP:
             res[i] = sum(prod(pvec[x] for x in self.paths[b]) * habitat[b] for b in m.index)
         return res
     
-    def _gain(self, target, data):
-        col = (data[target.postpass] - data[target.prepass]) * data[target.unscaled]
-        return col.to_frame(name=f'GAIN_{target.abbrev}')
+    def arrays(self):
+        '''
+        Return the BarrierArrays (see project.py) for the regions and targets
+        of this optimization, with the barriers in the order of the input frame.
+        The reordered arrays are saved, so they are made once per optimization
+        unless the input frame changes.
+        '''
+        a = self.project.arrays(self.regions, self.targets)
+        ids = self.input_frame.ID.to_numpy()
+        if self._arrays is not None:
+            source, reordered = self._arrays
+            if source is a and len(ids) == len(reordered.ids) and (ids == reordered.ids).all():
+                return reordered
+        if len(ids) != len(a.ids) or (ids != a.ids).any():
+            self._arrays = (a, a.reorder(ids))
+            return self._arrays[1]
+        return a
+
+    def _gains(self):
+        '''
+        Compute the gain in potential habitat for each target from replacing each
+        barrier by itself, with all other barriers at their current passability.
+        The gain depends on the passabilities below the barrier and the habitat
+        above it (see network.py), not just the habitat at the barrier.  All
+        targets are computed at once, one column per target.
+
+        Returns:
+          a frame indexed by barrier ID with a GAIN column for each target
+        '''
+        a = self.arrays()
+        c = a.network.cumulative(a.pre)
+        gain = a.network.downstream(c) * a.network.upstream(a.pre, a.unscaled) * (a.post - a.pre)
+        return pd.DataFrame(gain, index=a.ids, columns=[f'GAIN_{t.abbrev}' for t in self.targets])
     
+    @timed('table_view')
     def table_view(self, test=False):
         '''
         Create a table that will be displayed by the GUI
@@ -354,6 +512,25 @@ class OP:
         # df.columns = pd.MultiIndex.from_tuples(df.columns)
         return df
 
+    def log_timings(self):
+        '''
+        Emit a structured log record with the time spent in each phase
+        of this optimization, along with the size of the problem, and add
+        the times to the Prometheus phase histogram.
+        '''
+        from . import metrics
+
+        metrics.observe_phases(self.timer.phases)
+        Logging.record(
+            'op_timing',
+            barriers = 0 if self.input_frame is None else len(self.input_frame),
+            budgets = len(self.summary) if hasattr(self, 'summary') else 0,
+            targets = len(self.targets),
+            regions = self.regions,
+            phases = { k: round(v, 6) for k, v in self.timer.phases.items() },
+            counts = self.timer.counts,
+        )
+
     @staticmethod
     def format_budgets(cols):
         return { n: OP.format_budget_amount(n) for n in cols }
@@ -371,13 +548,14 @@ class OP:
             s = s[:-2]
         return s+suffix
     
+    @timed('make_roi_curves')
     def make_roi_curves(self):
         """
-        Generate ROI plots based on computed benefits.
+        Define the ROI plots based on computed benefits.  This method only saves
+        the data, titles, and labels for each plot.  The figures are made when
+        they are first requested (see get_figure) and saved in a cache.
         """
-        figures = []
-        download_figures = []
-
+        plots = []
         climate = None
 
         subtitle = 'Region: ' if len(self.regions) == 1 else 'Regions: '
@@ -390,24 +568,100 @@ class OP:
                 title += f' ({climate} Climate)'
             if self.weighted:
                 title += f' ⨉ {int(self.weights[i])}'
-            f = self.bokeh_figure(self.summary.budget, self.summary[t.abbrev], title, subtitle, t.label)
-            figures.append((t.short, f))
-            f = self.pyplot_figure(self.summary.budget, self.summary[t.abbrev], title, subtitle, t.label)
-            download_figures.append((t.short, f))
+            plots.append((t.short, (self.summary.budget, self.summary[t.abbrev], title, subtitle, t.label)))
 
         if len(self.targets) > 1:
             title = 'Combined Potential Benefit'
             if climate:
                 title += f' ({climate} Climate)'
-            f = self.bokeh_figure(self.summary.budget, self.summary.netgain, title, subtitle, 'Weighted Net Gain')
-            figures.insert(0, ('Net', f))
-            f = self.pyplot_figure(self.summary.budget, self.summary[t.abbrev], title, subtitle, 'Weighted Net Gain')
-            download_figures.insert(0, ('Net', f))
+            plots.insert(0, ('Net', (self.summary.budget, self.summary.netgain, title, subtitle, 'Weighted Net Gain')))
+
+        self.plots = plots
+        self.figures = { }
+
+    @property
+    def figure_names(self) -> list[str]:
+        """
+        The names of the ROI plots defined by make_roi_curves, with the net
+        benefit plot (if there is one) first.
+        """
+        return [name for name, _ in self.plots]
+
+    @property
+    def display_figures(self) -> list[tuple]:
+        """
+        A list of (name, figure) pairs with a Bokeh figure for each ROI plot.
+        """
+        return [(name, self.get_figure(name)) for name in self.figure_names]
+
+    def get_figure(self, name: str, fmt: str = 'bokeh'):
+        """
+        Return a figure for one of the ROI plots.  If the format is 'bokeh' the
+        return value is a Bokeh figure that can be displayed in the GUI or saved
+        as HTML.  Otherwise the format is the name of an image format (pdf, png,
+        or jpeg) and the return value is the contents of an image file.
+        Images are drawn by Matplotlib, which is not loaded until the first
+        image is requested; the Matplotlib figure is discarded as soon as the
+        image is made.  Figures and images are cached, so each one is made at
+        most once.
+
+        Arguments:
+          name:  the name of the plot (a target name or 'Net')
+          fmt:  'bokeh' or an image format
+
+        Returns:
+          a Bokeh figure or the contents of an image file
+        """
+        from . import metrics
+
+        key = (name, fmt)
+        metrics.record_cache('figure', key in self.figures)
+        if key not in self.figures:
+            args = dict(self.plots)[name]
+            band = self.bands.get(name)
+            if fmt == 'bokeh':
+                self.figures[key] = self.bokeh_figure(*args, band=band)
+            else:
+                self.figures[key] = self.render_image(self.matplotlib_figure(*args, band=band), fmt)
+        return self.figures[key]
+
+    def set_bands(self, bands: dict):
+        """
+        Add confidence bands to the ROI plots.  The bands are drawn the next
+        time a figure is requested.
+
+        Arguments:
+          bands:  a dictionary that maps plot names to frames with lo and hi columns (see sensitivity.py)
+        """
+        self.bands = bands
+        self.figures = { }
+
+    def release_figures(self, fmt: str, names: list[str] = None):
+        """
+        Remove images in a specified format from the figure cache.
+
+        Arguments:
+          fmt:  the image format
+          names:  if not None, only remove the images for the plots with these names
+        """
+        for key in [k for k in self.figures if k[1] == fmt and (names is None or k[0] in names)]:
+            del self.figures[key]
+
+    @staticmethod
+    def render_image(fig, fmt: str) -> bytes:
+        """
+        Save a Matplotlib figure in an in-memory file, return the contents of the file.
+        """
+        from io import BytesIO
+
+        buf = BytesIO()
+        fig.savefig(buf, format=fmt, bbox_inches='tight')
+        return buf.getvalue()
+
+    def bokeh_figure(self, x, y, title, subtitle, axis_label, band=None):
+        from bokeh.plotting import figure
+        from bokeh.models import NumeralTickFormatter, HoverTool, Title
 
-        self.display_figures = figures
-        self.download_figures = download_figures
-    
-    def bokeh_figure(self, x, y, title, subtitle, axis_label):
         H = 400
         W = 400
         LW = 2
@@ -422,6 +676,8 @@ class OP:
             tools = [HoverTool(mode='vline')],
             tooltips = 'Budget @x{$0.0a}, Benefit @y{0.0}',
         )
+        if band is not None:
+            f.varea(x, band['lo'].to_numpy(), band['hi'].to_numpy(), fill_alpha=0.2)
         f.line(x, y, line_width=LW)
         f.circle(x, y, fill_color='white', size=D)
         f.add_layout(Title(text=subtitle, text_font_style='italic'), 'above')
@@ -430,7 +686,10 @@ class OP:
         f.toolbar_location = None
         return f
     
-    def pyplot_figure(self, x, y, title, subtitle, axis_label):
+    def matplotlib_figure(self, x, y, title, subtitle, axis_label, band=None):
+        # Figure objects are not managed by pyplot, so they don't need to be closed
+        # and are drawn by the non-interactive (Agg) canvas
+        from matplotlib.figure import Figure
 
         def tick_fmt(n, x):
             return OP.format_budget_amount(n)
@@ -441,10 +700,13 @@ class OP:
         LW = 1.25
         D = 7
 
-        fig, ax = plt.subplots(figsize=(H,W))
+        fig = Figure(figsize=(H,W))
+        ax = fig.subplots()
         fig.suptitle(title, fontsize=11, fontweight='bold')
 
         ax.grid(linestyle='--', linewidth=0.5)
+        if band is not None:
+            ax.fill_between(x, band['lo'], band['hi'], color=LC, alpha=0.2, linewidth=0)
         ax.plot(x, y, color=LC, linewidth=LW)
         ax.plot(x, y, 'o', markerfacecolor='white', markeredgecolor=LC, markersize=D, markeredgewidth=0.75)
         ax.xaxis.set_major_formatter(tick_fmt)
@@ -457,8 +719,6 @@ class OP:
 # Tests
 #
 
-import pytest
-
 class TestOP:
 
     @staticmethod
@@ -550,6 +810,48 @@ class TestOP:
         assert [b for b in op.matrix.columns if b != 'count' and op.matrix.loc['D',b]] == [ ]
         assert [b for b in op.matrix.columns if b != 'count' and op.matrix.loc['E',b]] == [100,300]
 
+    @staticmethod
+    def test_timings():
+        '''
+        Collecting results should record the time spent parsing output files,
+        building paths, and computing potential habitat.
+        '''
+        op = OP(Project('static/test_wb.csv', DataSet.OPM), ['OPM'], ['T1'], ['1'], None)
+        op.input_frame = pd.read_csv('static/Example_1/Example1.txt', sep='\t')
+        op.outputs = sorted(glob('static/Example_1/example_*.txt'))
+        op.collect_results(scaled=True)
+
+        assert set(op.timer.phases) == {'parse', 'paths', 'potential_habitat'}
+        assert all(t >= 0 for t in op.timer.phases.values())
+        assert op.timer.counts['parse'] == 1
+
+    @staticmethod
+    def test_roi_figures():
+        '''
+        ROI figures should not be made until they are requested, images
+        should be cached, and no figures should be left open in pyplot.
+        '''
+        op = OP(Project('static/test_wb.csv', DataSet.OPM), ['OPM'], ['T1','T2'], ['3','1'], None)
+        op.input_frame = pd.read_csv('static/Example_4/Example4.txt', sep='\t')
+        op.outputs = sorted(glob('static/Example_4/example_*.txt'))
+        op.collect_results(scaled=True)
+        op.make_roi_curves()
+
+        assert op.figure_names == ['Net', 'Target 1', 'Target 2']
+        assert op.figures == { }
+        png = op.get_figure('Net', 'png')
+        assert png.startswith(b'\x89PNG')
+        assert op.get_figure('Net', 'png') is png
+        assert list(op.figures) == [('Net', 'png')]
+        svg = op.get_figure('Target 1', 'svg')
+        op.release_figures('svg', ['Net', 'Target 2'])
+        assert op.get_figure('Target 1', 'svg') is svg
+        op.release_figures('png')
+        assert list(op.figures) == [('Target 1', 'svg')]
+
+        import matplotlib.pyplot as plt
+        assert plt.get_fignums() == []
+
     @staticmethod
     def test_potential_habitat_1():
         '''
@@ -583,6 +885,145 @@ class TestOP:
         assert round(m.wph[0],3) == 5.491
         assert round(m.wph[4],3) == 21.084    # the value shown in the OP manual
 
+    @staticmethod
+    def test_standin():
+        '''
+        Run the OptiPass stand-in on a synthetic network.  There should be one
+        output file for each budget level, and the results should be nested.
+        Then run it again with failure injection; there should be no outputs.
+        '''
+        import sys
+        import tempfile
+        from .synthetic import write_workbook
+
+        os.makedirs('tmp', exist_ok=True)
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 100, nregions=2), DataSet.TNC_OR)
+        standin = f'{sys.executable} bin/optipass_standin.py'
+        op = OP(p, p.regions, ['CO','CH'], ['2','1'], 'Current')
+        failed = OP(p, p.regions, ['CO'], None, 'Current')
+        try:
+            OP.command = standin
+            op.run([2000000, 500000], False)
+            assert len(op.outputs) == 5
+            op.collect_results()
+            gates = list(op.summary.gates)
+            assert all(set(gates[i]) <= set(gates[i+1]) for i in range(len(gates)-1))
+
+            OP.command = standin + ' --fail 1'
+            failed.run([1000000, 500000], False)
+            assert failed.outputs == []
+        finally:
+            OP.command = None
+            for x in [op, failed]:
+                if hasattr(x, 'barrier_file'):
+                    for fn in glob(os.path.splitext(x.barrier_file)[0] + '*'):
+                        os.remove(fn)
+
+    @staticmethod
+    def test_arrays():
+        '''
+        If the input frame is not in the same order as the project data the
+        arrays are reordered, but only the first time they are requested.
+        '''
+        import tempfile
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 100, nregions=2), DataSet.TNC_OR)
+        op = OP(p, p.regions, ['CO','CH'], None, 'Current')
+        op.generate_input_frame()
+        assert op.arrays() is p.arrays(op.regions, op.targets)
+        op.input_frame = op.input_frame.iloc[::-1]
+        a = op.arrays()
+        assert list(a.ids) == list(op.input_frame.ID)
+        assert op.arrays() is a
+
+    @staticmethod
+    def test_result_cache():
+        '''
+        Running the same optimization twice with a cache should copy every
+        output file from the cache the second time.
+        '''
+        import sys
+        import tempfile
+        from . import metrics
+        from .cache import ResultCache
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 100, nregions=2), DataSet.TNC_OR)
+            try:
+                OP.command = f'{sys.executable} bin/optipass_standin.py'
+                OP.cache = ResultCache(os.path.join(d, 'cache'))
+                hits = lambda: metrics.CACHE_REQUESTS.labels(cache='optipass', result='hit')._value.get()
+                first = OP(p, p.regions, ['CO'], None, 'Current')
+                first.run([1000000, 500000], False, folder=d)
+                n = hits()
+                second = OP(p, p.regions, ['CO'], None, 'Current')
+                second.run([1000000, 500000], False, folder=d)
+                assert hits() - n == 3
+                first.collect_results()
+                second.collect_results()
+                assert list(first.summary.gates) == list(second.summary.gates)
+            finally:
+                OP.command = None
+                OP.cache = None
+
+    @staticmethod
+    def test_lazy_imports():
+        '''
+        The command line API should not load the GUI or plotting libraries, or
+        the libraries used only by the server, the run history, and the remote
+        solver.  Run main.py with -X importtime (which prints the name of every
+        module imported) and make sure none of them are in the list.
+        '''
+        import sys
+        res = subprocess.run([sys.executable, '-X', 'importtime', 'src/main.py', '--help'], capture_output=True, text=True)
+        assert res.returncode == 0
+        modules = { line.split('|')[-1].strip().split('.')[0] for line in res.stderr.splitlines() if line.startswith('import time:') }
+        assert 'pandas' in modules
+        assert not modules & {'panel', 'bokeh', 'matplotlib', 'networkx', 'holoviews'}
+        assert not modules & {'prometheus_client', 'requests', 'urllib3', 'sqlite3'}
+
+    @staticmethod
+    def test_gui_action():
+        '''
+        The gui action makes the app before the server is started, so making it
+        should not need a server session.  Run main.integration_app in a new
+        process, with a synthetic project in place of the workbook, and make
+        sure the selected regions and the results are displayed.
+        '''
+        import sys
+        import tempfile
+
+        script = '''
+import os, sys
+sys.path.insert(0, 'src')
+import main
+from tidegates import widgets
+from tidegates.project import Project
+from tidegates.targets import DataSet
+from tidegates.optipass import OP
+from tidegates.synthetic import write_workbook, write_outputs
+
+d = sys.argv[1]
+p = Project(write_workbook(os.path.join(d, 'wb.csv'), 100, nregions=3), DataSet.TNC_OR)
+op = OP(p, p.regions[:2], ['CO','CH'], None, 'Current')
+op.budget_max, op.budget_delta = 1000000, 500000
+op.input_frame = op.generate_input_frame()
+op.outputs = write_outputs(op.input_frame, [0, 500000, 1000000], os.path.join(d, 'out'), op.weights)
+op.collect_results(False)
+widgets.load_project = lambda fn, ds: p
+app = main.integration_app(op)
+print(sorted(app.region_boxes.selection()) == sorted(p.regions[:2]), app.tabs.active)
+'''
+        with tempfile.TemporaryDirectory() as d:
+            env = os.environ | { 'TIDEGATES_HISTORY': os.path.join(d, 'history.db') }
+            res = subprocess.run([sys.executable, '-c', script, d], env=env, capture_output=True, text=True)
+        assert res.returncode == 0, res.stderr
+        assert res.stdout.split() == ['True', '2']
+
     @staticmethod
     def test_budget_formats():
         '''
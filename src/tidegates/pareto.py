@@ -0,0 +1,279 @@
+#
+# Pareto frontiers
+#
+# When a user selects more than one target the solution found by OptiPass
+# depends on the target weights.  A ParetoSweep runs OptiPass with many
+# different weight vectors and collects the solutions, so users can see
+# the trade-offs between targets without trying weights one at a time.
+#
+#   * Weight vectors that are multiples of each other (e.g. 1:2 and 2:4)
+#     lead to the same optimization problem, so only the vector with no
+#     common factor is solved.  If there are more vectors than the limit a
+#     random sample is used, always including equal weights and the vectors
+#     that emphasize one target.
+#
+#   * The weight vectors are solved concurrently, each in its own OP object
+#     (OptiPass runs in a subprocess, so threads are sufficient).
+#
+#   * Different weights often produce the same set of gates.  Each distinct
+#     solution is evaluated only once, using the vectorized potential habitat
+#     computation in network.py (all targets and solutions at once), and is
+#     labeled with all the weight vectors that produced it.
+#
+#   * At each budget level a solution is on the frontier if no other solution
+#     for that budget has at least as much habitat for every target and more
+#     for at least one.
+#
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from .optipass import OP
+from .project import Project
+
+def weight_vectors(ntargets: int, levels: int = 5, limit: int = None, seed: int = 0) -> list[tuple]:
+    '''
+    Make the list of weight vectors for a sweep.
+
+    Arguments:
+      ntargets:  the number of targets
+      levels:  weights are integers from 1 to levels
+      limit:  the maximum number of vectors (all are used if this is None)
+      seed:  seed for the random number generator used to sample vectors
+
+    Returns:
+      a list of tuples, with no two tuples proportional to each other
+    '''
+    vectors = [v for v in product(range(1, levels + 1), repeat=ntargets) if math.gcd(*v) == 1]
+    if limit is None or len(vectors) <= limit:
+        return vectors
+    keep = [(1,) * ntargets]
+    keep += [tuple(levels if i == j else 1 for j in range(ntargets)) for i in range(ntargets)]
+    rest = [v for v in vectors if v not in keep]
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(rest), size=max(0, limit - len(keep)), replace=False)
+    return sorted(keep + [rest[i] for i in picked])
+
+def pareto_front(points: np.ndarray) -> np.ndarray:
+    '''
+    Find the non-dominated rows of a matrix, assuming larger values are better.
+
+    Arguments:
+      points:  an array with one row for each solution and one column for each objective
+
+    Returns:
+      a boolean vector, True for each row on the frontier
+    '''
+    points = np.asarray(points, dtype=float)
+    ge = (points[:, None, :] >= points[None, :, :]).all(axis=2)
+    gt = (points[:, None, :] > points[None, :, :]).any(axis=2)
+    return ~(ge & gt).any(axis=0)
+
+class ParetoSweep:
+    '''
+    Run OptiPass with a set of weight vectors and find the frontier of per-target
+    habitat at each budget level.
+
+    Attributes:
+      vectors:  the weight vectors that were solved
+      solutions:  a frame with one row for each distinct solution (see run)
+      solves:  the number of OptiPass runs
+    '''
+
+    def __init__(self, project: Project, regions: list[str], targets: list[str], climate: str, levels: int = 5, limit: int = 32, seed: int = 0):
+        '''
+        Arguments:
+          project:  the Project with the barrier data
+          regions:  region names
+          targets:  2-letter target IDs (at least two)
+          climate:  the climate scenario
+          levels:  weights are integers from 1 to levels
+          limit:  the maximum number of weight vectors
+          seed:  seed used when sampling weight vectors
+        '''
+        self.project = project
+        self.regions = regions
+        self.targets = targets
+        self.climate = climate
+        self.vectors = weight_vectors(len(targets), levels, limit, seed)
+        self.solutions = None
+        self.solves = 0
+
+    def solve(self, weights: tuple, budgets: tuple, folder: str) -> pd.DataFrame:
+        '''
+        Run OptiPass for one weight vector and parse the output files.
+
+        Returns:
+          a frame with budget and gates columns
+        '''
+        op = OP(self.project, self.regions, self.targets, [str(w) for w in weights], self.climate)
+        op.run(budgets, False, folder=folder)
+        if op.outputs is None or len(op.outputs) != budgets[0] // budgets[1] + 1:
+            raise RuntimeError(f'OptiPass failed with weights {weights}')
+        cols = { x: [] for x in ['budget', 'habitat', 'gates']}
+        for fn in op.outputs:
+            op._parse_op_output(fn, cols)
+        return pd.DataFrame(cols)
+
+    def run(self, budgets: tuple, folder: str = 'tmp', workers: int = 4):
+        '''
+        Solve every weight vector and save the distinct solutions in a frame
+        with columns for the budget, the weight vectors that led to the
+        solution (e.g. "1:3" or "1:3, 2:5"), the number of gates, their total
+        cost, the potential habitat of each target, and a flag that is True
+        for solutions on the frontier.
+
+        Arguments:
+          budgets:  the maximum budget and the budget increment
+          folder:  the directory for OptiPass input and output files
+          workers:  the number of OptiPass runs to start at the same time
+
+        Returns:
+          this object (so the call can be chained with the constructor)
+        '''
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(lambda w: self.solve(w, budgets, folder), self.vectors))
+        self.solves = sum(len(df) for df in results)
+
+        distinct = { }
+        for weights, df in zip(self.vectors, results):
+            label = ':'.join(str(w) for w in weights)
+            for budget, gates in zip(df.budget, df.gates):
+                distinct.setdefault((int(budget), frozenset(gates)), []).append(label)
+
+        op = OP(self.project, self.regions, self.targets, None, self.climate)
+        op.generate_input_frame()
+        a = op.arrays()
+
+        keys = list(distinct)
+        selected = np.array([np.isin(a.ids, list(gates)) for _, gates in keys]).T
+        df = pd.DataFrame({
+            'budget': [b for b, _ in keys],
+            'weights': [', '.join(distinct[k]) for k in keys],
+            'gates': [len(g) for _, g in keys],
+            'cost': a.cost @ selected,
+        })
+
+        # Passabilities for every barrier, target, and solution, so the habitat
+        # for all targets is computed in one pass over the network
+
+        p = np.where(selected[:, None, :], a.post[:, :, None], a.pre[:, :, None])
+        c = a.network.cumulative(p)
+        habitat = (a.unscaled[:, :, None] * c).sum(axis=0)
+        for i, t in enumerate(op.targets):
+            df[t.abbrev] = habitat[i]
+
+        abbrevs = [t.abbrev for t in op.targets]
+        df['pareto'] = False
+        for _, group in df.groupby('budget'):
+            df.loc[group.index, 'pareto'] = pareto_front(group[abbrevs].to_numpy())
+        self.solutions = df.sort_values(['budget', abbrevs[0]]).reset_index(drop=True)
+        self.target_names = { t.abbrev: t.short for t in op.targets }
+        return self
+
+    def frontier(self) -> pd.DataFrame:
+        '''
+        Return the solutions on the frontier.
+        '''
+        return self.solutions[self.solutions.pareto].drop(columns='pareto').reset_index(drop=True)
+
+    def figure(self, x: str = None, y: str = None):
+        '''
+        Make a Bokeh scatter plot of the solutions, with the habitat for one
+        target on each axis.  Each budget level has its own color, and the
+        frontier for each budget is drawn as a line.  Hovering over a point
+        shows the budget, the number of gates, and the weights.
+
+        Arguments:
+          x:  the ID of the target for the x axis (the first target if not specified)
+          y:  the ID of the target for the y axis (the second target if not specified)
+        '''
+        from bokeh.plotting import figure
+        from bokeh.models import ColumnDataSource, HoverTool
+        from bokeh.palettes import Viridis256
+
+        targets = list(self.target_names)
+        x = x or targets[0]
+        y = y or targets[1]
+        df = self.solutions.copy()
+        budgets = sorted(df.budget.unique())
+        colors = { b: Viridis256[int(i * 255 / max(1, len(budgets) - 1))] for i, b in enumerate(budgets) }
+        df['color'] = df.budget.map(colors)
+        df['label'] = df.budget.map(OP.format_budget_amount)
+
+        f = figure(
+            x_axis_label=self.target_names[x],
+            y_axis_label=self.target_names[y],
+            width=500,
+            height=500,
+            tools='pan,wheel_zoom,box_zoom,reset',
+        )
+        for b in budgets:
+            front = df[(df.budget == b) & df.pareto].sort_values(x)
+            f.line(front[x], front[y], color=colors[b], line_width=1.5)
+        points = f.circle(x, y, source=ColumnDataSource(df), size=9, color='color', fill_alpha=0.7, legend_field='label')
+        f.add_tools(HoverTool(renderers=[points], tooltips=[('Budget', '@label'), ('Gates', '@gates'), ('Weights', '@weights')]))
+        f.legend.title = 'Budget'
+        f.legend.location = 'bottom_right'
+        f.toolbar_location = 'below'
+        return f
+
+####################
+#
+# Unit tests
+#
+
+class TestPareto:
+
+    @staticmethod
+    def test_weight_vectors():
+        '''
+        Proportional vectors should be removed, and a sample should keep the
+        equal and extreme vectors.
+        '''
+        v = weight_vectors(2, 4)
+        assert (2, 4) not in v and (1, 2) in v and (2, 2) not in v
+        assert len(v) == len(set(v)) == 11
+        s = weight_vectors(3, 5, limit=10)
+        assert len(s) == 10
+        assert all(x in s for x in [(1,1,1), (5,1,1), (1,5,1), (1,1,5)])
+
+    @staticmethod
+    def test_pareto_front():
+        points = [[1, 5], [2, 4], [2, 3], [3, 1], [1, 5], [0, 0]]
+        assert list(pareto_front(points)) == [True, True, False, True, True, False]
+
+    @staticmethod
+    def test_sweep():
+        '''
+        Run a sweep with the OptiPass stand-in.  The $0 budget has a single
+        solution, every solution has a label, and no frontier solution is
+        dominated by another solution for the same budget.
+        '''
+        import os
+        import sys
+        import tempfile
+        from .targets import DataSet
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 200, nregions=3), DataSet.TNC_OR)
+            save = OP.command
+            OP.command = f'{sys.executable} bin/optipass_standin.py'
+            try:
+                sweep = ParetoSweep(p, p.regions[:2], ['CO', 'CH'], 'Current', levels=3).run((2000000, 1000000), folder=d)
+            finally:
+                OP.command = save
+            assert sweep.solves == 3 * len(sweep.vectors)
+            df = sweep.solutions
+            assert len(df[df.budget == 0]) == 1 and df.weights.str.len().min() > 0
+            assert len(df) <= sweep.solves
+            for _, group in df.groupby('budget'):
+                front = group[group.pareto]
+                for _, s in group.iterrows():
+                    assert not ((front.CO >= s.CO) & (front.CH >= s.CH) & ((front.CO > s.CO) | (front.CH > s.CH)) & s.pareto).any()
+            assert len(sweep.figure().renderers) == 4
@@ -2,10 +2,15 @@
 # Project
 #
 
+import threading
+from collections import OrderedDict
+from functools import cache
+
 import pandas as pd
 import numpy as np
 
-from .targets import make_targets, DataSet
+from .targets import make_targets, DataSet, Target
+from .network import Network
 
 class Project:
     """
@@ -15,6 +20,8 @@ class Project:
     (currently either OPM or TNC_OR).  The data in the CSV file and the
     target descriptions returned by the make_targets function in the targets
     module are used to initialize the attributes of the Project object.
+    If the optional validate argument is True the data is checked for errors
+    (see validate.py) and a ValueError listing them is raised.
 
     Attributes:
       data: a copy of the original data, in the form of a Pandas data frame
@@ -25,9 +32,15 @@ class Project:
       target_map:  a dictionary that associates target names with the target IDs
     """
 
-    def __init__(self, fn, ds):
+    ARRAY_CACHE_SIZE = 16
+
+    def __init__(self, fn, ds, validate=False):
         self.data = pd.read_csv(fn)
+        if validate:
+            self._validate(ds)
         self.targets = make_targets(ds)
+        self._arrays = OrderedDict()
+        self._arrays_lock = threading.Lock()
         if ds == DataSet.TNC_OR:
             self.map_info = self._make_map_info()
             self.regions = self._make_region_list()
@@ -36,6 +49,19 @@ class Project:
             dct = self.targets['Current']
             self.target_map = { dct[x].long: x for x in dct.keys()}
 
+    def _validate(self, ds):
+        '''
+        Check the data for errors (see validate.py) and raise a ValueError
+        that lists them if any are found.
+        '''
+        from .validate import validate, format_issues
+
+        if issues := validate(self.data, ds):
+            lines = format_issues(issues)
+            if len(lines) > 20:
+                lines = lines[:20] + [f'... and {len(lines) - 20} more']
+            raise ValueError('invalid workbook:\n' + '\n'.join(lines))
+
     def _make_map_info(self):
         '''
         Make a dataframe with attributes needed to display gates on a map.
@@ -69,6 +95,103 @@ class Project:
         tf = self.data[['BARID','REGION','COST']].groupby('REGION').sum(numeric_only=True)
         return { x: tf.COST[x] for x in tf.index }
 
+    def arrays(self, regions: list[str], targets: list[Target]):
+        '''
+        Return a BarrierArrays object with the data for the barriers in a set of
+        regions and a list of targets.  The arrays are made the first time a
+        combination of regions and targets is requested and then saved, so
+        optimizations with the same settings (in any session) share them.
+        Only the most recently used ARRAY_CACHE_SIZE combinations are kept.
+
+        Arguments:
+          regions:  a list of region names
+          targets:  a list of Target objects
+        '''
+        key = (tuple(sorted(regions)), tuple(targets))
+        with self._arrays_lock:
+            if (a := self._arrays.get(key)) is not None:
+                self._arrays.move_to_end(key)
+                return a
+        a = BarrierArrays(self.data[self.data.REGION.isin(regions)], targets)
+        with self._arrays_lock:
+            a = self._arrays.setdefault(key, a)
+            self._arrays.move_to_end(key)
+            while len(self._arrays) > self.ARRAY_CACHE_SIZE:
+                self._arrays.popitem(last=False)
+        return a
+
+class BarrierArrays:
+    '''
+    The barrier data used in habitat calculations, as NumPy arrays with one row
+    for each barrier and (for the target data) one column for each target, so
+    all targets are processed by the same array operations instead of looking
+    up columns one target at a time.
+
+    Attributes:
+      ids:  the barrier IDs
+      cost:  the cost of replacing each barrier
+      pre:  passability of each barrier for each target before restoration
+      post:  passability after restoration
+      habitat:  scaled habitat amounts
+      unscaled:  unscaled habitat amounts
+      network:  a Network object with the barrier connectivity
+    '''
+
+    def __init__(self, data: pd.DataFrame, targets: list[Target]):
+        '''
+        Arguments:
+          data:  rows of the project data for the selected barriers
+          targets:  a list of Target objects
+        '''
+        self.ids = data.BARID.to_numpy()
+        self.network = Network(self.ids, data.DSID.where(data.DSID.notnull(), None))
+        data = data.fillna(0)
+        self.cost = data.COST.to_numpy(dtype=float)
+        self.pre = self._stack(data, [t.prepass for t in targets])
+        self.post = self._stack(data, [t.postpass for t in targets])
+        self.habitat = self._stack(data, [t.habitat for t in targets])
+        self.unscaled = self._stack(data, [t.unscaled for t in targets])
+        for a in [self.cost, self.pre, self.post, self.habitat, self.unscaled]:
+            a.flags.writeable = False
+
+    @staticmethod
+    def _stack(data: pd.DataFrame, cols: list[str]) -> np.ndarray:
+        '''
+        Make an array with the values in a list of columns.  Columns that are
+        not in the data (e.g. unscaled habitat in the OptiPass manual examples)
+        are filled with 0.
+        '''
+        zeros = np.zeros(len(data))
+        return np.column_stack([data[c].to_numpy(dtype=float) if c in data.columns else zeros for c in cols])
+
+    def reorder(self, ids):
+        '''
+        Return a copy of the arrays with the barriers in a different order.
+        '''
+        pos = pd.Series(np.arange(len(self.ids)), index=self.ids)[list(ids)].to_numpy()
+        res = BarrierArrays.__new__(BarrierArrays)
+        res.ids = self.ids[pos]
+        parent = self.network.parent[pos]
+        res.network = Network(res.ids, np.where(parent >= 0, self.ids[parent], None))
+        for name in ['cost', 'pre', 'post', 'habitat', 'unscaled']:
+            setattr(res, name, getattr(self, name)[pos])
+        return res
+
+@cache
+def load_project(fn: str, ds: DataSet) -> Project:
+    '''
+    Return a Project object for a data file.  The file is read the first time
+    the project is requested, after that the same object is returned, so all
+    sessions in a server process share one copy of the data.  Project objects
+    are not modified after they are created (except to save the arrays made
+    by the arrays method).
+
+    Arguments:
+      fn:  the name of the CSV file with barrier data
+      ds:  the data set description
+    '''
+    return Project(fn, ds)
+
 ####################
 #
 # Unit tests
@@ -87,11 +210,33 @@ class TestProject:
         Load the test data frame, expect to find 6 rows, with single letter
         barrier IDs
         '''
-        p = Project('static/test_wb.csv', DataSet.OPM)
+        p = Project('static/test_wb.csv', DataSet.OPM, validate=True)
         assert isinstance(p.data, pd.DataFrame)
         assert len(p.data) == 6
         assert list(p.data.BARID) == list('ABCDEF')
 
+    @staticmethod
+    def test_arrays():
+        '''
+        The arrays should have one row per barrier and one column per target,
+        with the values in the data columns, and should be made only once.
+        '''
+        p = Project('static/test_wb.csv', DataSet.OPM)
+        targets = [p.targets['T1'], p.targets['T2']]
+        a = p.arrays(['OPM'], targets)
+        assert a.pre.shape == a.post.shape == a.habitat.shape == (6, 2)
+        assert np.array_equal(a.pre[:, 1], p.data.PRE2.fillna(0))
+        assert np.array_equal(a.habitat[:, 0], p.data.HAB1.fillna(0))
+        assert not a.unscaled.any()
+        assert p.arrays(['OPM'], targets) is a
+        p.ARRAY_CACHE_SIZE = 1
+        b = p.arrays(['OPM'], targets[:1])
+        assert len(p._arrays) == 1 and p.arrays(['OPM'], targets[:1]) is b
+        assert p.arrays(['OPM'], targets) is not a
+        r = a.reorder(list('FEDCBA'))
+        assert list(r.ids) == list('FEDCBA') and np.array_equal(r.cost, a.cost[::-1])
+        assert np.isclose(r.network.habitat(r.post, r.habitat[:, 0])[0], a.network.habitat(a.post, a.habitat[:, 0])[0])
+
     @staticmethod
     def test_regions():
         '''
@@ -0,0 +1,409 @@
+#
+# Remote OptiPass service
+#
+# A RemoteSolver sends OptiPass runs to a web service instead of running
+# OptiPass in a subprocess, so the server that hosts the app does not need
+# Wine or a copy of OptiPass and solves can be spread over a pool of
+# machines.  All the budget levels of an optimization are sent in one
+# request:
+#
+#   POST /solve
+#   { "barriers": <the barrier file>, "budgets": [0, 50000, ...],
+#     "targets": 2, "weights": [3, 1] }
+#
+# The response is a stream of JSON objects, one per line, sent as each
+# budget level is solved (in any order):
+#
+#   { "budget": 50000, "output": <the OptiPass output file> }
+#   { "budget": 100000, "error": "OptiPass failed" }
+#
+# Connections are reused (each RemoteSolver has a pooled requests Session,
+# created when it is first used so it is not shared by forked worker
+# processes).  Requests that fail with a connection error or a 429/5xx
+# status are retried with exponential backoff by the session's adapter.  If
+# a response stream is cut off (or times out) after it has started, the
+# budget levels that were not received are sent again in a new request.
+# A line that can't be parsed is treated the same way as a cut off stream.
+#
+# The service URL is set with the OPTIPASS_URL environment variable or the
+# --remote command line option.  requests is imported the first time a
+# request is sent, so importing this module does not slow down the app when
+# OptiPass runs locally.  MockService implements the same protocol
+# with a local command (e.g. bin/optipass_standin.py), for testing:
+#
+#   $ python -m tidegates.remote --port 8000 --optipass "python3 bin/optipass_standin.py"
+#
+
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .messages import Logging
+
+class RemoteSolver:
+    '''
+    Client for a remote OptiPass service.
+
+    Attributes:
+      url:  the URL of the solve endpoint
+      timeout:  connect and read timeouts, in seconds (the read timeout is the
+        longest time to wait for the next line of a response)
+      retries:  the number of times to retry a failed request, and the number
+        of times to resend budget levels after a response is cut off
+      backoff:  the backoff factor for retries (the delays are backoff, 2 * backoff, ...)
+    '''
+
+    STATUS_RETRY = (429, 500, 502, 503, 504)
+
+    def __init__(self, url: str, timeout: tuple = (10, 600), retries: int = 3, backoff: float = 0.5, pool: int = 8):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = pool
+        self._session = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env():
+        '''
+        Return a RemoteSolver for the service in OPTIPASS_URL, or None if it is not set.
+        '''
+        if url := os.environ.get('OPTIPASS_URL'):
+            return RemoteSolver(url)
+        return None
+
+    @property
+    def session(self):
+        '''
+        The session used to send requests (a requests.Session), made the first
+        time it is needed.
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        with self._lock:
+            if self._session is None:
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=self.STATUS_RETRY,
+                    allowed_methods=None,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=self.pool, pool_maxsize=self.pool, max_retries=retry)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def solve(self, barrier_file: str, jobs: list[tuple], ntargets: int, weights: list[int]) -> list[str]:
+        '''
+        Solve a set of budget levels and write the output files.
+
+        Arguments:
+          barrier_file:  the name of the OptiPass input file
+          jobs:  a list of (budget, output file name) pairs
+          ntargets:  the number of targets
+          weights:  the target weights
+
+        Returns:
+          the names of the output files that were written, in the order of the jobs
+        '''
+        import requests
+
+        with open(barrier_file) as f:
+            barriers = f.read()
+        pending = { int(b): fn for b, fn in jobs }
+        written = set()
+        for attempt in range(self.retries + 1):
+            request = {
+                'barriers': barriers,
+                'budgets': list(pending),
+                'targets': ntargets,
+                'weights': list(weights) if ntargets > 1 else [],
+            }
+
+            # Connection errors and error statuses have already been retried
+            # by the adapter, so if the request fails here give up
+
+            try:
+                resp = self.session.post(self.url, json=request, stream=True, timeout=self.timeout)
+                resp.raise_for_status()
+            except requests.RequestException as err:
+                Logging.log(f'remote solve failed: {err}')
+                break
+
+            # If the stream is cut off go around the loop again to send the
+            # budget levels that are still pending
+
+            with resp:
+                try:
+                    for line in resp.iter_lines():
+                        if not line:
+                            continue
+                        try:
+                            rec = json.loads(line)
+                            budget = int(rec['budget'])
+                        except (ValueError, KeyError, TypeError) as err:
+                            Logging.log(f'remote solve: bad response line {line[:200]!r} ({len(pending)} budgets left): {err}')
+                            break
+                        fn = pending.pop(budget, None)
+                        if fn is None:
+                            continue
+                        if 'output' in rec:
+                            with open(fn, 'w') as f:
+                                f.write(rec['output'])
+                            written.add(fn)
+                        else:
+                            Logging.log(f'OptiPass failed at budget {rec["budget"]}: {rec.get("error")}')
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as err:
+                    Logging.log(f'remote solve interrupted ({len(pending)} budgets left): {err}')
+            if not pending:
+                break
+        return [fn for _, fn in jobs if fn in written]
+
+class MockService:
+    '''
+    A local HTTP server that implements the remote OptiPass protocol by running
+    an OptiPass command (by default the stand-in) for each budget level.
+
+    Attributes:
+      command:  the shell command that runs OptiPass
+      workers:  the number of budget levels solved at the same time
+      fail:  the number of requests to reject (with status 503) before accepting
+        requests, to test retries
+      drop:  if not None, close each response stream after this many results
+      garble:  the number of responses that start with a line that is not JSON
+      requests:  the number of solve requests received
+    '''
+
+    def __init__(self, command: str = 'python3 bin/optipass_standin.py', port: int = 0, workers: int = 4, fail: int = 0, drop: int = None, garble: int = 0):
+        self.command = command
+        self.workers = workers
+        self.fail = fail
+        self.drop = drop
+        self.garble = garble
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/solve'
+
+    def start(self):
+        '''
+        Start the server in a background thread.  Returns this object.
+        '''
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run(self, folder: str, barrier_file: str, budget: int, ntargets: int, weights: list) -> dict:
+        '''
+        Run OptiPass for one budget level and return the line to send.
+        '''
+        outfile = os.path.join(folder, f'out_{budget}.txt')
+        cmnd = f'{self.command} -f {barrier_file} -o {outfile} -b {budget}'
+        if ntargets > 1:
+            cmnd += f' -t {ntargets} -w ' + ', '.join(str(w) for w in weights)
+        res = subprocess.run(cmnd, shell=True, capture_output=True, text=True)
+        if res.returncode != 0 or not os.path.exists(outfile):
+            return { 'budget': budget, 'error': res.stderr.strip() or 'OptiPass failed' }
+        with open(outfile) as f:
+            return { 'budget': budget, 'output': f.read() }
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=b''):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.reply(200 if self.path == '/health' else 404, b'ok')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path != '/solve':
+                    return self.reply(404)
+                service.requests += 1
+                if service.requests <= service.fail:
+                    return self.reply(503)
+                try:
+                    req = json.loads(body)
+                    budgets = [int(b) for b in req['budgets']]
+                    ntargets = int(req.get('targets', 1))
+                    weights = req.get('weights', [])
+                except (ValueError, KeyError, TypeError):
+                    return self.reply(400)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                if service.requests <= service.fail + service.garble:
+                    line = b'{"budget": \n'
+                    self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+                with tempfile.TemporaryDirectory() as d:
+                    barrier_file = os.path.join(d, 'barriers.txt')
+                    with open(barrier_file, 'w') as f:
+                        f.write(req['barriers'])
+                    with ThreadPoolExecutor(service.workers) as pool:
+                        jobs = [pool.submit(service.run, d, barrier_file, b, ntargets, weights) for b in budgets]
+                        for n, job in enumerate(as_completed(jobs)):
+                            if service.drop is not None and n >= service.drop:
+                                self.close_connection = True
+                                return
+                            line = (json.dumps(job.result()) + '\n').encode()
+                            self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+                            self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+
+        return Handler
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mock remote OptiPass service')
+    parser.add_argument('--port', metavar='N', type=int, default=8000, help='server port')
+    parser.add_argument('--optipass', metavar='CMD', default='python3 bin/optipass_standin.py', help='command that runs OptiPass')
+    parser.add_argument('--workers', metavar='N', type=int, default=4, help='budget levels solved at the same time')
+    args = parser.parse_args()
+    service = MockService(args.optipass, args.port, args.workers)
+    print(f'listening at {service.url}')
+    service.server.serve_forever()
+
+####################
+#
+# Unit tests
+#
+
+class TestRemoteSolver:
+
+    @staticmethod
+    def run(service, d, p):
+        '''
+        Run an optimization with the remote solver and a local mock service.
+        '''
+        from .optipass import OP
+
+        save = OP.remote
+        OP.remote = RemoteSolver(service.url, timeout=(5, 30), backoff=0.01)
+        try:
+            op = OP(p, p.regions[:2], ['CO', 'CH'], ['3', '1'], 'Current')
+            op.run((2000000, 500000), False, folder=d)
+        finally:
+            OP.remote = save
+        return op
+
+    @staticmethod
+    def test_remote():
+        '''
+        The output files from the remote service should match the files
+        written by running the stand-in locally, even if the service rejects
+        the first requests and cuts off a response.
+        '''
+        from .optipass import OP
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 200, nregions=3), DataSet.TNC_OR)
+            save = OP.command
+            OP.command = 'python3 bin/optipass_standin.py'
+            try:
+                local = OP(p, p.regions[:2], ['CO', 'CH'], ['3', '1'], 'Current')
+                local.run((2000000, 500000), False, folder=d)
+            finally:
+                OP.command = save
+            local.collect_results()
+
+            service = MockService(fail=2, drop=2).start()
+            try:
+                op = TestRemoteSolver.run(service, d, p)
+            finally:
+                service.stop()
+            assert len(op.outputs) == 5
+            assert service.requests == 2 + 3
+            op.collect_results()
+            assert list(op.summary.gates) == list(local.summary.gates)
+            assert op.summary.habitat.equals(local.summary.habitat)
+
+    @staticmethod
+    def test_bad_line():
+        '''
+        A line in the response that is not JSON should not fail the run;  the
+        budget levels that were not received are sent again.
+        '''
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 50, nregions=3), DataSet.TNC_OR)
+            service = MockService(garble=1).start()
+            try:
+                op = TestRemoteSolver.run(service, d, p)
+            finally:
+                service.stop()
+            assert len(op.outputs) == 5
+            assert service.requests == 2
+
+    @staticmethod
+    def test_unavailable():
+        '''
+        If the service keeps rejecting requests the solver should give up after
+        the adapter's retries, without sending the request again.
+        '''
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 50, nregions=3), DataSet.TNC_OR)
+            service = MockService(fail=100).start()
+            try:
+                op = TestRemoteSolver.run(service, d, p)
+            finally:
+                service.stop()
+            assert op.outputs == []
+            assert service.requests == 3 + 1
+
+    @staticmethod
+    def test_failure():
+        '''
+        Budget levels that fail on the service are left out of the outputs.
+        '''
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 50, nregions=3), DataSet.TNC_OR)
+            service = MockService(command='false').start()
+            try:
+                op = TestRemoteSolver.run(service, d, p)
+            finally:
+                service.stop()
+            assert op.outputs == []
@@ -0,0 +1,244 @@
+#
+# Summarized OptiPass results
+#
+# Besides the raw output files parsed by OP.collect_results, OptiPass runs can
+# be saved in a single tab-separated "run results" file that summarizes all
+# the budget levels (see static/CoquilleInundCoho_run_results.txt):
+#
+#   * a row of budgets (in millions of dollars) followed by barrier counts
+#
+#   * NET POTENTIAL BENEFIT (TARGET UNITS):  the net gain of each target at
+#     each budget, one row per target, labeled with the name of the unscaled
+#     habitat column
+#
+#   * NET POTENTIAL BENEFIT (STANDARDIZED VALUES):  the target weights, the
+#     scaled gain for each target, and the weighted net gain (only in files
+#     for runs with more than one target)
+#
+#   * a table with one row per barrier, with a 0/1 column for each budget
+#     level and the barrier attributes
+#
+# A ResultFile reads the header sections line by line (they are short) and
+# the barrier table with a single call to read_csv.  The selection matrix is
+# taken from the budget columns of the table, and make_op loads the results
+# into an OP object, so archived runs are displayed the same way as runs
+# parsed from OptiPass output files.
+#
+
+import io
+
+import numpy as np
+import pandas as pd
+
+from .optipass import OP
+from .project import Project
+
+class ResultFile:
+    '''
+    The contents of a summarized OptiPass results file.
+
+    Attributes:
+      budgets:  a vector of budget levels, in dollars
+      counts:  a frame with the barrier counts at each budget level
+      benefits:  a frame with the net gain of each target (in target units) at each budget level
+      weights:  a series with the weight of each target (empty if the file has no weights)
+      standardized:  a frame with the scaled net gain of each target (empty if not in the file)
+      net:  the weighted net gain at each budget level (None if not in the file)
+      table:  a frame with one row per barrier
+    '''
+
+    UNITS = { 'million': 1000000, 'thousand': 1000 }
+    NET = 'Weighted Net Gain Across Targets'
+
+    def __init__(self, fn: str):
+        '''
+        Arguments:
+          fn:  the name of the file to read
+        '''
+        with open(fn) as f:
+            text = f.read()
+        lines = text.splitlines()
+        start = next((i for i, line in enumerate(lines) if line.startswith('BARID\t')), None)
+        if start is None:
+            raise ValueError(f'{fn}: no barrier table')
+
+        rows = [[x.strip() for x in line.split('\t')] for line in lines[:start]]
+        rows = [[x for x in r if x] for r in rows]
+        label, *amounts = rows[0]
+        scale = next((n for unit, n in self.UNITS.items() if unit in label.lower()), 1)
+        self.budgets = np.array([round(float(x) * scale) for x in amounts], dtype=int)
+
+        sections = { 'counts': { } }
+        current = sections['counts']
+        for row in rows[1:]:
+            if not row:
+                continue
+            if len(row) == 1 and row[0].endswith(':'):
+                current = sections.setdefault(row[0][:-1].upper(), { })
+            else:
+                current[row[0]] = [float(x) for x in row[1:]]
+
+        self.counts = self._frame(sections['counts'])
+        self.benefits = self._frame(sections.get('NET POTENTIAL BENEFIT (TARGET UNITS)', { }))
+        weights = sections.get('TARGET WEIGHTS', { })
+        self.weights = pd.Series({ k: v[0] for k, v in weights.items() }, dtype=float)
+        scaled = sections.get('NET POTENTIAL BENEFIT BY TARGET', { })
+        net = next((x.pop(self.NET) for x in sections.values() if self.NET in x), None)
+        self.standardized = self._frame(scaled)
+        self.net = None if net is None else pd.Series(net, index=self.budgets)
+
+        self.table = pd.read_csv(
+            io.StringIO('\n'.join(lines[start:])),
+            sep='\t',
+            dtype={ 'BARID': str, 'Downstr BARID': str, 'Region': str },
+        )
+
+    def _frame(self, dct: dict) -> pd.DataFrame:
+        '''
+        Make a frame with one row for each item in a dictionary and one column
+        for each budget level.
+        '''
+        return pd.DataFrame.from_dict(dct, orient='index', columns=self.budgets)
+
+    @property
+    def regions(self) -> list[str]:
+        '''
+        The names of the regions in the barrier table.
+        '''
+        return list(self.table.Region.dropna().unique())
+
+    def selections(self) -> np.ndarray:
+        '''
+        Return a boolean array with one row for each barrier in the table and
+        one column for each budget level, True if the barrier is in the solution.
+        '''
+        return self.table.iloc[:, 1:len(self.budgets) + 1].to_numpy(dtype=float) == 1
+
+    def summary(self) -> pd.DataFrame:
+        '''
+        Return a frame with budget, habitat, and gates columns, in the form
+        expected by OP.load_results.  The file reports net gains instead of
+        potential habitat, so the habitat column is the weighted net gain
+        (the sum of the net gains if the file has a single target).
+        '''
+        selected = self.selections()
+        ids = self.table.BARID.to_numpy()
+        habitat = self.net if self.net is not None else self.benefits.sum(axis=0)
+        return pd.DataFrame({
+            'budget': self.budgets.astype(float),
+            'habitat': habitat.to_numpy(dtype=float),
+            'gates': [list(ids[selected[:, j]]) for j in range(len(self.budgets))],
+        })
+
+    def targets(self, project: Project) -> tuple:
+        '''
+        Find the targets in a project that have the habitat columns named in the file.
+
+        Returns:
+          a list of target IDs and the climate scenario (None if the project
+          does not have climate scenarios)
+        '''
+        names = list(self.benefits.index)
+        if project.targets and all(isinstance(x, dict) for x in project.targets.values()):
+            options = list(project.targets.items())
+        else:
+            options = [(None, project.targets)]
+        for climate, dct in options:
+            columns = { t.unscaled: t.abbrev for t in dct.values() }
+            if all(x in columns for x in names):
+                return [columns[x] for x in names], climate
+        raise ValueError(f'no targets with columns {names}')
+
+    def make_op(self, project: Project, scaled: bool = False) -> OP:
+        '''
+        Make an OP object with the results in the file.
+
+        Arguments:
+          project:  the Project with the barrier data used in the run
+          scaled:  the value to pass to collect_results
+
+        Returns:
+          an OP object with summary and matrix attributes, as if it had
+          parsed the OptiPass output files for the run
+        '''
+        targets, climate = self.targets(project)
+        weights = None
+        if len(self.weights) and not (self.weights == 1).all():
+            w = self.weights.reindex(self.benefits.index)
+            weights = [str(int(round(x))) for x in w]
+        op = OP(project, self.regions, targets, weights, climate)
+        if len(self.budgets) > 1:
+            op.budget_max, op.budget_delta = int(self.budgets[-1]), int(self.budgets[1] - self.budgets[0])
+        op.generate_input_frame()
+        op.load_results(self.summary(), scaled)
+        return op
+
+####################
+#
+# Unit tests
+#
+
+class TestResultFile:
+
+    @staticmethod
+    def test_read():
+        '''
+        Read the Coquille example:  11 budget levels from $0 to $10M, two targets,
+        and a table with one row per barrier.
+        '''
+        res = ResultFile('static/CoquilleInundCoho_run_results.txt')
+        assert list(res.budgets) == [i * 1000000 for i in range(11)]
+        assert list(res.counts.loc['Barrier Count']) == [0, 2, 3, 5, 7, 8, 10, 12, 15, 17, 20]
+        assert list(res.benefits.index) == ['Coho_salmon', 'InundHab_Current']
+        assert list(res.weights) == [1.0, 1.0]
+        assert np.isclose(res.net.iloc[-1], 4.4165)
+        assert res.regions == ['Coquille']
+        summary = res.summary()
+        assert list(summary.gates.map(len)) == list(res.counts.loc['Barrier Count'])
+        assert summary.gates[1] == ['10Ats1', '36Ats1']
+        assert (res.selections().sum(axis=1) == res.table.InSoln).all()
+
+    @staticmethod
+    def test_make_op():
+        '''
+        Write a results file for a synthetic run and load it into an OP object;
+        the summary and matrix should match the ones made from the OptiPass outputs.
+        '''
+        import os
+        import tempfile
+        from .targets import DataSet
+        from .synthetic import write_workbook, write_outputs
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 200, nregions=3), DataSet.TNC_OR)
+            op = OP(p, p.regions[:1], ['CO', 'FI'], ['3', '1'], 'Current')
+            op.generate_input_frame()
+            op.outputs = write_outputs(op.input_frame, [0, 1000000, 2000000], os.path.join(d, 'out'), op.weights)
+            op.collect_results()
+
+            budgets = [int(b) for b in op.summary.budget]
+            fn = os.path.join(d, 'results.txt')
+            with open(fn, 'w') as f:
+                print('\t'.join(['BUDGET ($ million)'] + [str(b / 1000000) for b in budgets]), file=f)
+                print('\t'.join(['Barrier Count'] + [str(len(g)) for g in op.summary.gates]), file=f)
+                print('\t' * len(budgets), file=f)
+                print('NET POTENTIAL BENEFIT (TARGET UNITS):', file=f)
+                for t in op.targets:
+                    print('\t'.join([t.unscaled] + [str(x) for x in op.summary[t.abbrev]]), file=f)
+                print('', file=f)
+                print('NET POTENTIAL BENEFIT (STANDARDIZED VALUES):', file=f)
+                print('Target Weights:', file=f)
+                for t, w in zip(op.targets, op.weights):
+                    print(f'{t.unscaled}\t{w}.0000', file=f)
+                print('Net Potential Benefit by Target:', file=f)
+                print('\t'.join(['Weighted Net Gain Across Targets'] + [str(x) for x in op.summary.netgain]), file=f)
+                print('', file=f)
+                table = op.matrix[budgets].rename_axis('BARID').reset_index()
+                table['Region'] = p.regions[0]
+                table.to_csv(f, sep='\t', index=False)
+
+            res = ResultFile(fn).make_op(p)
+            assert res.weights == [3, 1] and res.climate == 'Current'
+            assert res.matrix.equals(op.matrix)
+            assert np.allclose(res.summary.CO, op.summary.CO)
+            assert np.allclose(res.summary.netgain, op.summary.netgain)
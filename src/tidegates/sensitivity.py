@@ -0,0 +1,256 @@
+#
+# Sensitivity analysis
+#
+# The passability and cost of each barrier are point estimates.  A
+# Sensitivity object measures how much the results of an optimization
+# depend on them:  it draws random samples of the PREPASS, POSTPASS, and
+# COST columns around the values in the data set and evaluates the gates
+# selected by OptiPass for every sample and budget level.  The results are
+#
+#   * bands:  for each ROI curve, the mean, median, and a confidence interval
+#     of the potential benefit at each budget level (the Net curve, like the
+#     weighted net gain reported by OptiPass, uses scaled habitat amounts;
+#     the curves for individual targets use unscaled amounts)
+#
+#   * feasible:  the fraction of samples in which the total cost of each
+#     solution is within its budget
+#
+#   * robustness:  for each gate in a solution, the fraction of samples in
+#     which it is still one of the k best gates by benefit per dollar, where
+#     k is the number of gates in the solution
+#
+# The benefit of a gate is its exact marginal gain:  the change in potential
+# habitat if that one gate is added to (or removed from) the solution.  For a
+# gate g it is d * u * (post - pre), where d is the product of passabilities
+# below g and u is the habitat upstream from g (see network.py).
+#
+# Samples are processed in batches, as 3D arrays with one row per barrier, one
+# column per target, and one plane per sample, so the cost of an analysis is a
+# few NumPy operations per level of the barrier network for each batch and
+# budget, for any number of targets.
+#
+
+import numpy as np
+import pandas as pd
+
+from .optipass import OP
+
+class Sensitivity:
+    '''
+    Monte Carlo analysis of the solutions found by an optimization run.
+
+    Attributes:
+      op:  the OP object with the results
+      draws:  the number of samples
+      pass_sd:  standard deviation of the noise added to passabilities
+      cost_sd:  standard deviation of the log of the factor applied to costs
+      level:  the confidence level for the bands
+      bands:  a dictionary that maps ROI curve names to frames with mean, median, lo, and hi columns
+      feasible:  a series with the fraction of samples within budget at each budget level
+      robustness:  a frame with a row for each gate and a column for each budget level
+    '''
+
+    BATCH = 64
+
+    def __init__(self, op: OP, draws: int = 1000, pass_sd: float = 0.1, cost_sd: float = 0.2, level: float = 0.9, seed: int = None):
+        self.op = op
+        self.draws = draws
+        self.pass_sd = pass_sd
+        self.cost_sd = cost_sd
+        self.level = level
+        self.rng = np.random.default_rng(seed)
+        self.arrays = op.arrays()
+        self.network = self.arrays.network
+        self.budgets = [int(b) for b in op.summary.budget]
+        self.selected = op.matrix[self.budgets].to_numpy(dtype=bool)
+        self.bands = { }
+        self.feasible = None
+        self.robustness = None
+
+    def sample(self, p: np.ndarray, size: int) -> np.ndarray:
+        '''
+        Draw samples of a vector of passabilities, clipped to the range [0,1].
+        '''
+        p = p[:, None]
+        return np.clip(p + self.rng.normal(0, self.pass_sd, (len(p), size)), 0, 1)
+
+    def sample_cost(self, size: int) -> np.ndarray:
+        '''
+        Draw samples of the cost column, using a log-normal factor with mean 1.
+        '''
+        c = self.arrays.cost[:, None]
+        s = self.cost_sd
+        return c * self.rng.lognormal(-s * s / 2, s, (len(c), size))
+
+    def run(self):
+        '''
+        Evaluate the solutions for every sample and save the bands, feasibility,
+        and robustness scores in attributes of this object.
+
+        Returns:
+          this object (so the call can be chained with the constructor)
+        '''
+        nb = len(self.budgets)
+        targets = self.op.targets
+        a = self.arrays
+        weights = np.array(self.op.weights, dtype=float)[:, None]
+        habitat = np.zeros((len(targets), self.draws, nb))          # samples of potential habitat
+        scaled = np.zeros((len(targets), self.draws, nb))           # the same, using scaled habitat
+        within = np.zeros(nb)
+        robust = np.zeros(self.selected.shape)
+
+        with self.op.timer.span('sensitivity'):
+            for start in range(0, self.draws, self.BATCH):
+                size = min(self.BATCH, self.draws - start)
+                rows = slice(start, start + size)
+                cost = self.sample_cost(size)
+
+                # Targets that use the same data column (e.g. POSTPASS) share its samples
+
+                columns = { }
+                for i, t in enumerate(targets):
+                    for col, values in [(t.prepass, a.pre), (t.postpass, a.post)]:
+                        if col not in columns:
+                            columns[col] = self.sample(values[:, i], size)
+                pre = np.stack([columns[t.prepass] for t in targets], axis=1)
+                post = np.stack([columns[t.postpass] for t in targets], axis=1)
+
+                for j, budget in enumerate(self.budgets):
+                    sel = self.selected[:, j]
+                    p = np.where(sel[:, None, None], post, pre)
+                    c = self.network.cumulative(p)
+                    habitat[:, rows, j] = (a.unscaled[:, :, None] * c).sum(axis=0)
+                    scaled[:, rows, j] = (a.habitat[:, :, None] * c).sum(axis=0)
+                    gain = self.network.downstream(c) * self.network.upstream(p, a.unscaled) * (post - pre)
+                    gain = (weights * gain).sum(axis=1)
+                    within[j] += (cost[sel].sum(axis=0) <= budget).sum()
+                    robust[:, j] += self.in_top(gain, cost, sel)
+
+        net = (weights[:, :, None] * scaled).sum(axis=0)
+        curves = { t.short: habitat[i] for i, t in enumerate(targets) }
+        if len(targets) > 1:
+            curves = { 'Net': net - net[:, :1] } | curves
+        self.bands = { name: self.band(x) for name, x in curves.items() }
+        self.feasible = pd.Series(within / self.draws, index=self.budgets)
+
+        used = self.selected.any(axis=1)
+        scores = np.where(self.selected, robust / self.draws, np.nan)
+        self.robustness = pd.DataFrame(scores[used], index=self.op.input_frame.ID[used], columns=self.budgets)
+        return self
+
+    @staticmethod
+    def in_top(gain: np.ndarray, cost: np.ndarray, sel: np.ndarray) -> np.ndarray:
+        '''
+        For each selected gate, count the samples in which its gain per dollar
+        is one of the k largest, where k is the number of selected gates.
+        Gates with no cost are ranked by gain alone, ahead of the others.
+        '''
+        k = sel.sum()
+        if k == 0:
+            return np.zeros(len(sel))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(cost > 0, gain / cost, np.inf * np.sign(gain))
+        ratio = np.nan_to_num(ratio, nan=0.0, posinf=np.finfo(float).max)
+        n = len(ratio)
+        threshold = np.partition(ratio, n - k, axis=0)[n - k]
+        counts = np.zeros(len(sel))
+        counts[sel] = (ratio[sel] >= threshold).sum(axis=1)
+        return counts
+
+    def band(self, x: np.ndarray) -> pd.DataFrame:
+        '''
+        Summarize an array of samples (one row per sample, one column per budget)
+        with the mean, the median, and the bounds of the confidence interval.
+        '''
+        a = (1 - self.level) / 2
+        return pd.DataFrame({
+            'mean': x.mean(axis=0),
+            'median': np.median(x, axis=0),
+            'lo': np.quantile(x, a, axis=0),
+            'hi': np.quantile(x, 1 - a, axis=0),
+        }, index=self.budgets)
+
+####################
+#
+# Unit tests
+#
+
+class TestSensitivity:
+
+    @staticmethod
+    def make_op(d, weights=None):
+        import os
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook, write_outputs
+
+        p = Project(write_workbook(os.path.join(d, 'wb.csv'), 300, nregions=3), DataSet.TNC_OR)
+        op = OP(p, p.regions[:2], ['CO','CH'], weights, 'Current')
+        op.generate_input_frame()
+        op.outputs = write_outputs(op.input_frame, [0, 1000000, 2000000], os.path.join(d, 'out'), op.weights)
+        op.collect_results()
+        return op
+
+    @staticmethod
+    def test_point_estimate():
+        '''
+        With no noise every sample should reproduce the potential habitat
+        computed by OP, and every solution should be within budget.
+        '''
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            op = TestSensitivity.make_op(d)
+            s = Sensitivity(op, draws=10, pass_sd=0, cost_sd=0).run()
+            assert np.allclose(s.bands['Coho']['lo'], op.summary.CO)
+            assert np.allclose(s.bands['Chinook']['hi'], op.summary.CH)
+            assert (s.feasible == 1).all()
+            assert s.robustness.shape[1] == 3 and s.robustness[0].isna().all()
+
+    @staticmethod
+    def test_net_band():
+        '''
+        With no noise the median of the Net band should be the weighted net gain
+        reported by OptiPass (run with the stand-in, which computes potential
+        habitat the same way as OptiPass).
+        '''
+        import os
+        import sys
+        import tempfile
+        from .project import Project
+        from .targets import DataSet
+        from .synthetic import write_workbook, write_outputs
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 200, nregions=3), DataSet.TNC_OR)
+            save = OP.command
+            OP.command = f'{sys.executable} bin/optipass_standin.py'
+            try:
+                op = OP(p, p.regions[:2], ['CO','CH'], ['3', '1'], 'Current')
+                op.run((2000000, 1000000), False, folder=d)
+            finally:
+                OP.command = save
+            op.collect_results()
+            s = Sensitivity(op, draws=4, pass_sd=0, cost_sd=0).run()
+            assert np.allclose(s.bands['Net']['median'], op.summary.netgain, atol=1e-3)
+
+    @staticmethod
+    def test_bands():
+        '''
+        With noise the bands should contain the mean, and robustness scores
+        should be fractions.
+        '''
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            op = TestSensitivity.make_op(d, ['3', '1'])
+            s = Sensitivity(op, draws=600, seed=1).run()
+            net = s.bands['Net']
+            assert (net['lo'] <= net['mean']).all() and (net['mean'] <= net['hi']).all()
+            assert net['hi'].iloc[-1] > net['lo'].iloc[-1]
+            scores = s.robustness[2000000].dropna()
+            assert len(scores) > 0 and scores.between(0, 1).all()
+            op.make_roi_curves()
+            op.set_bands(s.bands)
+            assert len(op.get_figure('Net').renderers) == 3
+            assert op.get_figure('Coho', 'png').startswith(b'\x89PNG')
@@ -0,0 +1,186 @@
+#
+# Synthetic barrier networks
+#
+# Functions that make barrier data sets and OptiPass output files of any
+# size, so the optimization pipeline can be exercised without the real
+# workbook or a copy of OptiPass.  The data frames have the same column
+# names as the Oregon Coast workbook, so they can be loaded by a Project
+# object with DataSet.TNC_OR.
+#
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .targets import make_targets, DataSet
+
+def target_columns() -> list[str]:
+    '''
+    Make a list of the names of all the habitat and passability columns
+    referred to by the Oregon Coast targets, in the order they are first used.
+    '''
+    cols = []
+    for dct in make_targets(DataSet.TNC_OR).values():
+        for t in dct.values():
+            for c in [t.habitat, t.prepass, t.postpass, t.unscaled]:
+                if c not in cols:
+                    cols.append(c)
+    return cols
+
+def make_workbook(n: int, nregions: int = 15, seed: int = 0) -> pd.DataFrame:
+    '''
+    Make a data frame with n barriers divided evenly among a set of regions.
+    Each region is a random tree:  the first barrier in a region is at the
+    river mouth (it has no DSID) and every other barrier is upstream from
+    a barrier created earlier in the same region.
+
+    Arguments:
+      n:  the number of barriers
+      nregions:  the number of regions
+      seed:  seed for the random number generator
+
+    Returns:
+      a data frame in the format of the Oregon Coast workbook
+    '''
+    rng = np.random.default_rng(seed)
+    nregions = max(1, min(n, nregions))
+
+    region = np.arange(n) * nregions // n
+    start = np.searchsorted(region, region)
+    offset = np.arange(n) - start
+    parent = start + np.floor(rng.random(n) * offset).astype(int)
+
+    ids = np.array([f'SB{i:06d}' for i in range(n)])
+    dsid = np.where(offset > 0, ids[parent], None)
+    names = np.array([f'Region{r+1:02d}' for r in range(nregions)])
+
+    cost = rng.choice([0, 120000, 390000, 550000, 815000], size=n, p=[0.1, 0.2, 0.3, 0.2, 0.2])
+    nproj = (cost > 0).astype(int)
+
+    df = pd.DataFrame({
+        'BARID': ids,
+        'REGION': names[region],
+        'DSID': dsid,
+        'BarrierType': rng.choice(['Tide gate', 'Culvert', 'Dam'], size=n),
+        'NPROJ': nproj,
+        'COST': cost,
+        'PrimaryTG': nproj,
+        'DominantTG': (rng.random(n) < 0.2).astype(int),
+        'POINT_X': -124.2 + rng.normal(0, 0.05, n),
+        'POINT_Y': 46.2 - 0.2 * region + rng.normal(0, 0.05, n),
+    })
+
+    for c in target_columns():
+        if c.startswith('PREPASS'):
+            df[c] = np.round(rng.choice([0.0, 0.1, 0.3, 0.5, 0.8], size=n), 2)
+        elif c == 'POSTPASS':
+            df[c] = 1.0
+        else:
+            df[c] = np.round(rng.exponential(2.0, n), 3)
+    return df
+
+def write_workbook(fn: str, n: int, nregions: int = 15, seed: int = 0) -> str:
+    '''
+    Make a synthetic workbook (see make_workbook) and save it in a CSV file.
+
+    Returns:
+      the name of the file
+    '''
+    make_workbook(n, nregions, seed).to_csv(fn, index=False)
+    return fn
+
+def write_outputs(frame: pd.DataFrame, budgets: list[int], root: str, weights: list[int] = None) -> list[str]:
+    '''
+    Write a set of files in the format produced by OptiPass, one for each
+    budget level, using the same naming convention as OP.run.  Gates are
+    selected greedily, in order of weighted benefit per dollar, so each
+    solution is a superset of the previous one.  The solutions are plausible
+    but not optimal.
+
+    Arguments:
+      frame:  a barrier frame made by OP.generate_input_frame
+      budgets:  a list of budget amounts
+      root:  the path and base name of the output files
+      weights:  target weights (one target per HAB_ column if not specified)
+
+    Returns:
+      a list of output file names
+    '''
+    hab = frame[[c for c in frame.columns if c.startswith('HAB_')]].fillna(0).to_numpy()
+    pre = frame[[c for c in frame.columns if c.startswith('PRE_')]].fillna(0).to_numpy()
+    post = frame[[c for c in frame.columns if c.startswith('POST_')]].fillna(0).to_numpy()
+    weights = weights or [1] * hab.shape[1]
+
+    cost = frame.COST.fillna(0).to_numpy()
+    gain = ((post - pre) * hab) @ np.array(weights, dtype=float)
+    ratio = np.where(cost > 0, gain / np.maximum(cost, 1), -1)
+    order = np.argsort(-ratio, kind='stable')
+    spent = np.cumsum(cost[order])
+
+    outputs = []
+    for i, budget in enumerate(budgets):
+        action = np.zeros(len(frame), dtype=int)
+        action[order[(spent <= budget) & (ratio[order] >= 0)]] = 1
+        habitat = (np.where(action[:,None] == 1, post, pre) * hab).sum(axis=0)
+        fn = f'{root}_{i+1}.txt'
+        with open(fn, 'w') as f:
+            f.write(f'BUDGET:\t{budget:.2f}\nSTATUS:\tOPT\n%OPTGAP:\t0.00\n')
+            if len(weights) == 1:
+                f.write(f'PTNL_HABITAT:\t{habitat[0]:.4f}\nNETGAIN:\t0.0000\n')
+            else:
+                f.write('WEIGHTS\n')
+                for j, w in enumerate(weights):
+                    f.write(f'TARGET{j+1}:\t{w:.4f}\n')
+                f.write('PTNL_HABITAT\n')
+                for j, h in enumerate(habitat):
+                    f.write(f'TARGET{j+1}:\t{h:.4f}\n')
+                f.write(f'WT_PTNL_HABITAT:\t{habitat @ np.array(weights):.4f}\nWT_NETGAIN:\t0.0000\n')
+            f.write('\nBARID\tACTION\n')
+            for name, a in zip(frame.ID, action):
+                f.write(f'{name}\t{a}\n')
+        outputs.append(fn)
+    return outputs
+
+####################
+#
+# Unit tests
+#
+
+from glob import glob
+import tempfile
+
+class TestSynthetic:
+
+    @staticmethod
+    def test_workbook():
+        '''
+        Every DSID should refer to a barrier in the same region, and the
+        columns used by the targets should all be present.
+        '''
+        df = make_workbook(200, nregions=4)
+        assert len(df) == 200
+        assert df.REGION.nunique() == 4
+        region = dict(zip(df.BARID, df.REGION))
+        links = df[df.DSID.notnull()]
+        assert all(region[d] == r for d, r in zip(links.DSID, links.REGION))
+        assert set(target_columns()) <= set(df.columns)
+
+    @staticmethod
+    def test_outputs():
+        '''
+        Synthetic output files should be readable by the OP parser, and
+        larger budgets should select at least as many gates.
+        '''
+        from .project import Project
+        from .optipass import OP
+
+        with tempfile.TemporaryDirectory() as d:
+            p = Project(write_workbook(os.path.join(d, 'wb.csv'), 300), DataSet.TNC_OR)
+            op = OP(p, p.regions[:3], ['CO','CH'], None, 'Current')
+            op.generate_input_frame()
+            op.outputs = write_outputs(op.input_frame, [0, 1000000, 2000000], os.path.join(d, 'out'))
+            assert len(glob(os.path.join(d, 'out_*.txt'))) == 3
+            op.collect_results()
+            n = list(op.summary.gates.apply(len))
+            assert n[0] == 0 and n[0] <= n[1] <= n[2]
@@ -0,0 +1,318 @@
+#
+# Workbook validation
+#
+# Checks for problems in a barrier workbook that would make an optimization
+# fail or give wrong answers:  missing columns, values that are not numbers,
+# NPROJ flags that do not agree with the cost or gate type, and DSIDs that
+# refer to barriers that are not in the workbook or that form a cycle (which
+# would make path construction loop forever).
+#
+# Every check is a vectorized operation on a whole column, and the network
+# checks visit each barrier a constant number of times, so a workbook with a
+# million rows is validated in a few seconds.  All the problems are reported,
+# each with the line number in the CSV file (the header is line 1).
+#
+# The validator can be run from the command line:
+#
+#   $ python -m tidegates.validate static/workbook.csv
+#
+# or when a Project is loaded (Project(fn, ds, validate=True)).
+#
+
+import argparse
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .targets import make_targets, DataSet
+
+Issue = namedtuple('Issue', ['line', 'column', 'message'])
+
+def required_columns(ds: DataSet) -> list[str]:
+    '''
+    Make the list of columns a workbook for a data set must have:  the barrier
+    attributes plus the habitat and passability columns used by the targets.
+    '''
+    cols = ['BARID', 'REGION', 'DSID', 'COST']
+    if ds == DataSet.TNC_OR:
+        cols += ['NPROJ', 'POINT_X', 'POINT_Y']
+        structs = make_targets(ds).values()
+    else:
+        structs = [make_targets(ds)]
+    for dct in structs:
+        for t in dct.values():
+            for c in [t.habitat, t.prepass, t.postpass, t.unscaled]:
+                if c and c not in cols:
+                    cols.append(c)
+    return cols
+
+def read_workbook(fn: str) -> pd.DataFrame:
+    '''
+    Read a workbook for validation.  Only empty cells and NA are missing
+    values, and the ID columns are strings.  Columns with a value that is
+    not a number are left as strings, so the value can be reported.
+    '''
+    ids = { c: str for c in ['BARID', 'REGION', 'DSID'] }
+    return pd.read_csv(fn, dtype=ids, keep_default_na=False, na_values=['', 'NA'])
+
+def id_strings(col: pd.Series) -> pd.Series:
+    '''
+    Convert a column of barrier IDs to strings, with '' for missing IDs.
+    A Project reads numeric IDs as numbers, and a DSID column with missing
+    values is read as floats, so integral numbers are converted without a
+    decimal point (1 and 1.0 are both "1").
+    '''
+    if not pd.api.types.is_numeric_dtype(col):
+        return col.fillna('').astype(str)
+    x = col.astype(float)
+    integral = np.isfinite(x) & (x == np.round(x))
+    s = x.astype(str)
+    s[integral] = x[integral].astype(np.int64).astype(str)
+    s[x.isna()] = ''
+    return s
+
+def validate(data: pd.DataFrame, ds: DataSet = DataSet.TNC_OR) -> list[Issue]:
+    '''
+    Check a barrier frame, either the frame returned by read_workbook or the
+    frame read by a Project.  Columns that should be numeric can also be
+    strings, and are converted here.
+
+    Arguments:
+      data:  the workbook, with a row index that starts at 0
+      ds:  the data set that defines the required columns
+
+    Returns:
+      a list of Issue objects, sorted by line number (0 for problems that
+      are not on one line)
+    '''
+    issues = []
+    lines = np.arange(len(data)) + 2
+
+    def report(mask, column, message):
+        issues.extend(Issue(int(n), column, message) for n in lines[np.asarray(mask, dtype=bool)])
+
+    required = required_columns(ds)
+    missing = [c for c in required if c not in data.columns]
+    for c in missing:
+        issues.append(Issue(0, c, 'missing column'))
+    if 'BARID' in missing:
+        return issues
+
+    barid = id_strings(data.BARID)
+    report(barid == '', 'BARID', 'missing barrier ID')
+    report(barid.duplicated(keep='first') & (barid != ''), 'BARID', 'duplicate barrier ID')
+
+    numbers = { }
+    blanks = { }
+    for col in [c for c in data.columns if c in required or c == 'PrimaryTG']:
+        if col in ['BARID', 'REGION', 'DSID']:
+            continue
+        raw = data[col]
+        if pd.api.types.is_numeric_dtype(raw):
+            x = raw
+            blank = raw.isna()
+        else:
+            blank = raw.isna() | raw.astype(str).str.strip().isin(['', 'NA'])
+            x = pd.to_numeric(raw.where(~blank), errors='coerce')
+        numbers[col] = x
+        blanks[col] = blank
+        report(x.isna() & ~blank, col, 'not a number')
+        if col in ['NPROJ', 'POINT_X', 'POINT_Y']:
+            report(blank, col, 'missing value')
+        if col.startswith(('PRE', 'POST')):
+            report((x < 0) | (x > 1), col, 'passability not between 0 and 1')
+        elif col not in ['POINT_X', 'POINT_Y']:
+            report(x < 0, col, 'negative value')
+
+    if 'NPROJ' in numbers:
+        nproj = numbers['NPROJ']
+        report(nproj.notna() & ~nproj.isin([0, 1]), 'NPROJ', 'NPROJ not 0 or 1')
+        if 'PrimaryTG' in numbers:
+            report(numbers['PrimaryTG'].notna() & (numbers['PrimaryTG'] != 1) & (nproj != 0), 'NPROJ', 'NPROJ not 0 for non-primary gate')
+        if 'COST' in numbers:
+            report((numbers['COST'] == 0) & (nproj != 0), 'NPROJ', 'NPROJ not 0 when cost is $0')
+            report(blanks['COST'] & (nproj != 0), 'COST', 'missing cost for a barrier with a project')
+
+    if 'DSID' not in missing:
+        issues += network_issues(barid.to_numpy(), data.DSID, lines)
+
+    return sorted(issues, key=lambda x: x.line)
+
+def network_issues(barid: np.ndarray, dsid: pd.Series, lines: np.ndarray) -> list[Issue]:
+    '''
+    Check the DSID column:  every DSID must be a barrier ID, and following
+    DSIDs from any barrier must lead to a river mouth (a barrier with no DSID).
+
+    Barriers in cycles are found by removing barriers with no upstream
+    neighbors until none are left;  the barriers that are never removed are
+    the ones in cycles.  Barriers that are not in a cycle but have a cycle
+    below them are found by a breadth-first search upstream from the mouths.
+    Each pass handles all the barriers at the same distance from the start
+    with one NumPy operation, and each barrier is visited once.
+    '''
+    issues = []
+    ds = id_strings(dsid)
+    mouth = ds.isin(['', 'NA']).to_numpy()
+
+    first = ~pd.Series(barid).duplicated().to_numpy()
+    pos = pd.Series(np.flatnonzero(first), index=barid[first])
+    parent = ds.map(pos).to_numpy()
+    orphan = ~mouth & pd.isna(parent)
+    issues += [Issue(int(n), 'DSID', f'downstream ID {d} is not a barrier ID') for n, d in zip(lines[orphan], ds[orphan])]
+
+    # Orphans are treated as mouths so they are not also reported as
+    # being above a cycle
+
+    parent = np.where(mouth | orphan, -1, parent).astype(float).astype(int)
+    n = len(parent)
+    linked = parent >= 0
+
+    indegree = np.bincount(parent[linked], minlength=n)
+    removed = np.zeros(n, dtype=bool)
+    frontier = np.flatnonzero(indegree == 0)
+    while len(frontier):
+        removed[frontier] = True
+        below = parent[frontier]
+        below = below[below >= 0]
+        np.subtract.at(indegree, below, 1)
+        below = np.unique(below)
+        frontier = below[indegree[below] == 0]
+
+    order = np.argsort(parent, kind='stable')
+    children = order[np.searchsorted(parent[order], 0):]
+    bounds = np.searchsorted(parent[children], np.arange(n + 1))
+    reached = np.zeros(n, dtype=bool)
+    frontier = np.flatnonzero(~linked)
+    while len(frontier):
+        reached[frontier] = True
+        counts = bounds[frontier + 1] - bounds[frontier]
+        starts = np.repeat(bounds[frontier] - np.cumsum(counts) + counts, counts)
+        frontier = children[np.arange(counts.sum()) + starts]
+
+    cycle = ~removed
+    above = ~reached & removed
+    issues += [Issue(int(n), 'DSID', f'barrier {b} is in a cycle') for n, b in zip(lines[cycle], barid[cycle])]
+    issues += [Issue(int(n), 'DSID', f'barrier {b} is upstream from a cycle') for n, b in zip(lines[above], barid[above])]
+    return issues
+
+def format_issues(issues: list[Issue]) -> list[str]:
+    '''
+    Make a printable message for each issue.
+    '''
+    return [f'Line {x.line}: {x.column}: {x.message}' if x.line else f'{x.column}: {x.message}' for x in issues]
+
+def main(argv: list[str] = None) -> int:
+    '''
+    Validate the workbooks named on the command line and print the issues.
+    Returns 1 if any file has problems.
+    '''
+    parser = argparse.ArgumentParser(description='Check barrier workbooks for errors')
+    parser.add_argument('files', metavar='F', nargs='+', help='CSV files to check')
+    parser.add_argument('--dataset', choices=[x.name for x in DataSet], default=DataSet.TNC_OR.name, help='data set that defines the required columns')
+    args = parser.parse_args(argv)
+    status = 0
+    for fn in args.files:
+        if not os.path.exists(fn):
+            print(f'No such file: {fn}')
+            status = 1
+            continue
+        issues = validate(read_workbook(fn), DataSet[args.dataset])
+        for msg in format_issues(issues):
+            print(f'{fn}: {msg}')
+        if issues:
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+####################
+#
+# Unit tests
+#
+
+class TestValidate:
+
+    @staticmethod
+    def test_clean():
+        '''
+        A synthetic workbook and the OPM test data should have no issues.
+        '''
+        import tempfile
+        from .synthetic import make_workbook
+
+        df = make_workbook(500, nregions=3)
+        assert validate(df) == []
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'wb.csv')
+            df.to_csv(fn, index=False)
+            assert validate(read_workbook(fn)) == []
+        assert validate(read_workbook('static/test_wb.csv'), DataSet.OPM) == []
+
+    @staticmethod
+    def test_values():
+        '''
+        Bad values should be reported with their line numbers, including
+        NPROJ checks that need numeric comparisons.
+        '''
+        from .synthetic import make_workbook
+
+        df = make_workbook(20, nregions=1).astype(str).replace({'None': ''})
+        df.loc[3, 'COST'] = 'n/a'
+        df.loc[4, 'NPROJ'] = '2'
+        df.loc[5, ['COST', 'NPROJ']] = ['0', '1']
+        df.loc[6, ['PrimaryTG', 'NPROJ']] = ['0', '1']
+        df.loc[7, 'PREPASS_CO'] = '1.5'
+        df.loc[8, 'BARID'] = df.BARID[9]
+        found = { (x.line, x.message) for x in validate(df) }
+        assert (5, 'not a number') in found
+        assert (6, 'NPROJ not 0 or 1') in found
+        assert (7, 'NPROJ not 0 when cost is $0') in found
+        assert (8, 'NPROJ not 0 for non-primary gate') in found
+        assert (9, 'passability not between 0 and 1') in found
+        assert (11, 'duplicate barrier ID') in found
+        assert validate(df.drop(columns='COST'))[0] == Issue(0, 'COST', 'missing column')
+
+    @staticmethod
+    def test_network():
+        '''
+        Orphan DSIDs, cycles, and barriers above cycles should be reported.
+        '''
+        #   A is a mouth, B -> A, C -> D -> E -> C is a cycle, F -> C, G -> X (not a barrier)
+        df = pd.DataFrame({'BARID': list('ABCDEFG'), 'DSID': ['', 'A', 'D', 'E', 'C', 'C', 'X']})
+        issues = network_issues(df.BARID.to_numpy(), df.DSID, np.arange(7) + 2)
+        found = { (x.line, x.message) for x in issues }
+        assert found == {
+            (8, 'downstream ID X is not a barrier ID'),
+            (4, 'barrier C is in a cycle'),
+            (5, 'barrier D is in a cycle'),
+            (6, 'barrier E is in a cycle'),
+            (7, 'barrier F is upstream from a cycle'),
+        }
+
+    @staticmethod
+    def test_numeric_ids():
+        '''
+        Numeric IDs are read as integers in the BARID column and as floats in
+        a DSID column with missing values;  they should still match.
+        '''
+        import tempfile
+        from .project import Project
+        from .synthetic import make_workbook
+
+        df = make_workbook(20, nregions=1)
+        num = { b: i + 1 for i, b in enumerate(df.BARID) }
+        df['BARID'] = df.BARID.map(num)
+        df['DSID'] = df.DSID.map(num)
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'wb.csv')
+            df.to_csv(fn, index=False)
+            p = Project(fn, DataSet.TNC_OR, validate=True)
+            assert p.data.DSID.dtype == float
+            df.loc[3, 'DSID'] = 99
+            df.to_csv(fn, index=False)
+            issues = validate(pd.read_csv(fn))
+            assert issues == [Issue(5, 'DSID', 'downstream ID 99 is not a barrier ID')]
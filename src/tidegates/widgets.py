@@ -1,37 +1,151 @@
+import asyncio
+import os
 import param
 
 import panel as pn
 import pandas as pd
 
 import bokeh.plotting as bk
-from bokeh.io import save as savehtml
+from bokeh.embed import file_html
+from bokeh.resources import CDN
 from bokeh.models.widgets.tables import NumberFormatter
-from bokeh.tile_providers import get_provider
+from bokeh.models import ColumnDataSource, CDSView, GroupFilter, IndexFilter, UnionFilter, WMTSTileSource
 import xyzservices.providers as xyz
 
-from shutil import make_archive, rmtree
-from pathlib import Path
+from collections import deque
+from contextlib import nullcontext
+from functools import cache
+from tempfile import SpooledTemporaryFile
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from panel.io.model import hold
+from tornado.ioloop import IOLoop
 
 from .targets import DataSet, make_layout
 from .budgets import BudgetBox
-from .project import Project
+from .project import Project, load_project
 from .optipass import OP
 from .messages import Logging
+from . import metrics
+from .workspace import workspaces, session_id
+from .history import RunStore
+from .pareto import ParetoSweep
+from .evaluator import Evaluator
 from .styles import *
 
 pn.extension('gridstack', 'tabulator', 'floatpanel')
 
+@cache
+def static_file(fn: str) -> bytes:
+    """
+    Return the contents of a file in the static folder.  Files are read
+    the first time they are requested and saved for all sessions.
+
+    Arguments:
+      fn:  the name of the file (relative to the static folder)
+    """
+    with open(os.path.join('static', fn), 'rb') as f:
+        return f.read()
+
+def static_html(fn: str) -> str:
+    """
+    Return the text of an HTML file in the static folder (see static_file).
+    """
+    return static_file(fn).decode('utf-8')
+
+class MapLayers():
+    """
+    A MapLayers object manages the renderers drawn on a map figure:  a base
+    layer of map tiles, and overlays that are drawn on top of the tiles.  The
+    base layer is added to the figure once, when the map is created;  when the
+    map is zoomed only the ranges change, and the browser fetches any tiles it
+    needs for the new ranges.
+
+    Tiles come from OpenStreetMap unless one of these environment variables is set:
+
+      TIDEGATES_TILE_URL:  a URL template for a tile server (e.g. a server on a
+        local network), with {Z}, {X}, and {Y} placeholders
+      TIDEGATES_TILE_DIR:  a folder of tiles (organized as Z/X/Y.png) that will
+        be served by the web app itself, for servers that have no Internet connection
+
+    Attributes:
+      figure:  the Bokeh figure that displays the map
+      base:  the tile renderer
+      overlays:  a dictionary of renderers drawn on top of the tiles, indexed by name
+    """
+
+    route = 'tiles'
+
+    def __init__(self, figure):
+        self.figure = figure
+        self.base = figure.add_tile(self.tile_source())
+        self.overlays = { }
+
+    @staticmethod
+    def tile_source():
+        """
+        Return the source of the map tiles, based on the environment variables
+        described above.
+        """
+        if url := os.environ.get('TIDEGATES_TILE_URL'):
+            return WMTSTileSource(url=url)
+        if os.environ.get('TIDEGATES_TILE_DIR'):
+            return WMTSTileSource(url=f'/{MapLayers.route}/{{Z}}/{{X}}/{{Y}}.png')
+        return xyz.OpenStreetMap.Mapnik
+
+    @staticmethod
+    def static_dirs():
+        """
+        Return a dictionary to pass to the server (as the static_dirs option)
+        that serves tiles from the local tile folder, if there is one.
+        """
+        if folder := os.environ.get('TIDEGATES_TILE_DIR'):
+            return { MapLayers.route: folder }
+        return { }
+
+    def set_overlay(self, name, renderer):
+        """
+        Save a renderer as a named overlay.  If there is already an overlay with
+        that name its renderer is removed from the figure.
+
+        Arguments:
+          name:  the name of the overlay
+          renderer:  a renderer that has been added to the figure
+        """
+        self.remove_overlay(name)
+        self.overlays[name] = renderer
+
+    def remove_overlay(self, name):
+        """
+        Remove a named overlay from the figure (if there is one).
+        """
+        if (r := self.overlays.pop(name, None)) and r in self.figure.renderers:
+            self.figure.renderers.remove(r)
+
 class TGMap():
     """
     A TGMap object manages the display of a map that shows the locations of the barriers
     in a project.  The constructor is passed a reference to Project object that has
     barrier definitions.
 
+    All the barriers are drawn by a single glyph renderer, using one data source.
+    The renderer has a view with a filter that selects barriers in the currently
+    selected regions, so selecting a region only sends a new filter to the browser.
+
     Attributes:
       map:  a Bokeh figure object, with x and y ranges defined by the locations of the barriers
-      dots: a dictionary that maps region names to a list of circle glyphs for each barrier in a region
+      dots: the glyph renderer that draws a circle for each barrier
+      source: the data source with the coordinates, IDs, regions, and types of the barriers
+      view: the view that determines which barriers are displayed
+      filters: a dictionary that maps region names to a filter that selects barriers in the region
+      layers: the MapLayers object that manages the tiles and overlays
       ranges: a data frame that has the range of x and y coordinates for each region    
     """
+
+    # Set the environment variable TIDEGATES_WEBGL to draw the map with WebGL
+
+    webgl = bool(os.environ.get('TIDEGATES_WEBGL'))
+
     def __init__(self, bf):
         self.map, self.dots = self._create_map(bf)
         self.ranges = self._create_ranges(bf)
@@ -45,7 +159,6 @@ class TGMap():
         based on the latitude and longitude of the barriers in
         a project.
         """
-        self.tile_provider = get_provider(xyz.OpenStreetMap.Mapnik)
         p = bk.figure(
             title='Oregon Coast', 
             height=900,
@@ -54,6 +167,7 @@ class TGMap():
             y_range=(bf.map_info.y.min()*0.997,bf.map_info.y.max()*1.003),
             x_axis_type='mercator',
             y_axis_type='mercator',
+            output_backend='webgl' if self.webgl else 'canvas',
             toolbar_location='below',
             tools=['pan','wheel_zoom','hover','reset'],
             tooltips = [
@@ -62,14 +176,12 @@ class TGMap():
                 ("Type", "@type"),
             ]
         )
-        p.add_tile(self.tile_provider)
+        self.layers = MapLayers(p)
         p.toolbar.autohide = True
-        dots = { }
-        for r in bf.regions:
-            df = bf.map_info[bf.map_info.region == r]
-            c = p.circle('x', 'y', size=5, color='darkslategray', source=df, tags=list(df.id))
-            dots[r] = c
-            c.visible = False
+        self.source = ColumnDataSource(bf.map_info)
+        self.filters = { r: GroupFilter(column_name='region', group=r) for r in bf.regions }
+        self.view = CDSView(filter=IndexFilter(indices=[]))
+        dots = p.circle('x', 'y', size=5, color='darkslategray', source=self.source, view=self.view)
 
         self.outer_x = (bf.map_info.x.min()*0.997,bf.map_info.x.max()*1.003)
         self.outer_y = (bf.map_info.y.min()*0.997,bf.map_info.y.max()*1.003)
@@ -93,19 +205,23 @@ class TGMap():
     def display_regions(self, selection):
         """
         This method is called when the user clicks the checkbox next to the name
-        of a region.  Set the visible attribute of each dot to True or False depending
-        on whether the region it is in is selected.
+        of a region.  Update the filter in the view so it selects the barriers in
+        the selected regions.  The filtering is done in the browser, using the data
+        that was sent when the map was created.
 
         Arguments:
           selection:  a list of names of regions currently selected
         """
-        for r, dots in self.dots.items():
-            dots.visible = r in selection
+        if selection:
+            self.view.filter = UnionFilter(operands=[self.filters[r] for r in selection])
+        else:
+            self.view.filter = IndexFilter(indices=[])
 
     def zoom(self, selection):
         """
         Update the map, setting the x and y range based on the currently selected
-        regions.
+        regions.  The tile layer does not change, the browser will fetch the tiles
+        it needs to display the new area.
 
         Arguments:
           selection:  a list of names of regions currently selected
@@ -132,7 +248,6 @@ class TGMap():
         else:
             self.map.x_range.update(start=self.outer_x[0], end=self.outer_x[1])
             self.map.y_range.update(start=self.outer_y[0], end=self.outer_y[1])
-        self.map.add_tile(self.tile_provider)
 
 
 class RegionBox(pn.Column):
@@ -145,7 +260,15 @@ class RegionBox(pn.Column):
     budget widget is notified so it can update the maximum budget (based on the total
     cost of all barriers in the current selection), and the map is updated by zooming
     in to a level that contains only the barriers in the selected regions.
+
+    The set of selected regions is updated right away, but the other widgets are
+    updated after a short delay, and each click restarts the delay, so a series of
+    rapid clicks leads to a single update after the last one.
+    All the changes made in an update are sent to the browser in one message.
+    Buttons above the checkboxes select or clear all regions with a single update.
     """
+
+    DELAY = 250             # milliseconds to wait for more clicks before updating
     
     def __init__(self, project, map, budget):
         """
@@ -168,14 +291,23 @@ class RegionBox(pn.Column):
         self.grid = pn.GridBox(*boxes, ncols=3)
         self.selected = set()
         self.external_cb = None
+        self.pending = None
+        self.batch = False
+
+        self.all_button = pn.widgets.Button(name='Select All', button_type='light', width=90)
+        self.all_button.on_click(lambda _: self.set_selection(project.regions))
+        self.none_button = pn.widgets.Button(name='Clear', button_type='light', width=90)
+        self.none_button.on_click(lambda _: self.set_selection([]))
+
+        self.append(pn.Row(self.all_button, self.none_button))
         self.append(self.grid)
 
     def cb(self, *events):
         """
         Callback function invoked when one of the checkboxes is clicked.  If the new state
         of the checkbox is 'selected' the region is added to the set of selected regions,
-        otherwise it is removed.  After updating the set notify the map widget and any
-        other widgets that have been registered as external callbacks.
+        otherwise it is removed.  After updating the set schedule an update of the
+        other widgets (replacing the one already scheduled, if any).
         """
         for e in events:
             if e.type == 'changed':
@@ -183,13 +315,60 @@ class RegionBox(pn.Column):
                 if e.new:
                     self.selected.add(r)
                 else:
-                    self.selected.remove(r)
-                amount = sum(self.totals[x] for x in self.selected)
-                self.budget_box.set_budget_max(amount)
-        self.map.display_regions(self.selected)
-        self.map.zoom(self.selected)
-        if self.external_cb:
-            self.external_cb()
+                    self.selected.discard(r)
+        if not self.batch:
+            self._schedule_update()
+
+    def _schedule_update(self):
+        """
+        Arrange for update to be called after a short delay.  If an update is
+        already scheduled it is cancelled, so the delay starts over with each
+        click.  If the app is not running in a server session (e.g. in a test)
+        call it right away.
+        """
+        doc = pn.state.curdoc
+        if doc is None or doc.session_context is None:
+            self.update()
+            return
+        if self.pending is not None:
+            self.pending.stop()
+        self.pending = pn.state.add_periodic_callback(self.update, period=self.DELAY, count=1)
+
+    def update(self):
+        """
+        Notify the budget widget, the map, and any other widgets that have been
+        registered as external callbacks that the set of selected regions has
+        changed.  Changes to the document are held and sent as a single message.
+        """
+        self.pending = None
+        doc = pn.state.curdoc
+        with hold(doc) if doc else nullcontext():
+            amount = sum(self.totals[x] for x in self.selected)
+            self.budget_box.set_budget_max(amount)
+            self.map.display_regions(self.selected)
+            self.map.zoom(self.selected)
+            if self.external_cb:
+                self.external_cb()
+
+    def set_selection(self, names: list[str]):
+        """
+        Set the state of every checkbox, selecting the regions in a list
+        and clearing the others, then update the other widgets once.
+
+        Arguments:
+          names:  the names of the regions to select
+        """
+        doc = pn.state.curdoc
+        with hold(doc) if doc else nullcontext():
+            self.batch = True
+            try:
+                for box in self.grid:
+                    box.value = box.name in names
+            finally:
+                self.batch = False
+            if self.pending is not None:
+                self.pending.stop()
+            self.update()
 
     def selection(self) -> list[str]:
         """
@@ -335,6 +514,16 @@ Click on the **Output** tab to see the results.
     fail_text = '''### Optimization Failed
 
 Reason: {}
+'''
+
+    load_fail_text = '''### Could Not Load Previous Run
+
+Reason: {}
+'''
+
+    pareto_targets_text = '''### Select More Targets
+
+Exploring target weights requires two or more targets
 '''
 
     def __init__(self, template, run_cb):
@@ -444,6 +633,126 @@ Reason: {}
         self.append(pn.pane.Alert(text, alert_type = 'danger'))
         self.template.open_modal()
 
+    def show_load_fail(self, reason):
+        """
+        Method called if a previous run could not be loaded from the run history.
+
+        Arguments:
+          reason:  string containing the error message
+        """
+        self.clear()
+        self.append(pn.pane.Alert(self.load_fail_text.format(reason), alert_type = 'danger'))
+        self.template.open_modal()
+
+    def show_pareto_targets(self):
+        """
+        Method called when the user clicks the Explore Weights button with
+        fewer than two targets selected.
+        """
+        self.clear()
+        self.append(pn.pane.Alert(self.pareto_targets_text, alert_type = 'warning'))
+        self.template.open_modal()
+
+
+class HistoryBox(pn.Column):
+    """
+    The history box has a menu of previous optimization runs saved in the run
+    history (see history.py) and a button that displays the selected run in
+    the Output tab without running OptiPass again.
+    """
+
+    def __init__(self, store, load_cb):
+        """
+        Make the menu and button.
+
+        Arguments:
+          store:  the RunStore with the saved runs
+          load_cb:  function to call with the ID of a run when the user clicks the button
+        """
+        super(HistoryBox, self).__init__(margin=(10,0,10,5))
+        self.store = store
+        self.menu = pn.widgets.Select(options={ }, width=450)
+        self.load_button = pn.widgets.Button(name='Load', stylesheets=[button_style_sheet])
+        self.load_button.on_click(lambda _: load_cb(self.menu.value))
+        self.append(pn.Row(self.menu, self.load_button))
+        self.refresh()
+
+    def refresh(self):
+        """
+        Update the menu with the most recent runs in the store.
+        """
+        runs = self.store.find()
+        options = { }
+        for r in runs.itertuples():
+            targets = r.targets.replace(',', ', ')
+            if r.weights:
+                targets = ', '.join(f'{t}⨉{w}' for t, w in zip(r.targets.split(','), r.weights.split(',')))
+            label = f'{r.created[:16].replace("T", " ")}: {r.regions.replace(",", ", ")}; {targets}; {OP.format_budget_amount(r.budget_max)}'
+            options[label] = r.id
+        self.menu.options = options
+        self.load_button.disabled = len(options) == 0
+
+class ParetoPane(pn.Column):
+    """
+    The results of a weight sweep (see pareto.py) are displayed in a tab with
+    a trade-off plot and a table of the solutions on the frontier.  If more
+    than two targets were selected there are menus for choosing the targets
+    shown on the axes of the plot.
+    """
+
+    def __init__(self, sweep):
+        """
+        Make the plot and table.
+
+        Arguments:
+          sweep:  a ParetoSweep object, after calling its run method
+        """
+        super(ParetoPane, self).__init__()
+        self.sweep = sweep
+
+        names = { v: k for k, v in sweep.target_names.items() }
+        self.x_menu = pn.widgets.Select(name='X Axis', options=names, value=list(names.values())[0], width=150)
+        self.y_menu = pn.widgets.Select(name='Y Axis', options=names, value=list(names.values())[1], width=150)
+        self.plot = pn.pane.Bokeh(sweep.figure())
+        self.x_menu.param.watch(self.axis_cb, ['value'])
+        self.y_menu.param.watch(self.axis_cb, ['value'])
+
+        frontier = sweep.frontier()
+        frontier['budget'] = frontier.budget.map(OP.format_budget_amount)
+        frontier = frontier.rename(columns=sweep.target_names | {
+            'budget': 'Budget',
+            'weights': 'Weights',
+            'gates': 'Gates',
+            'cost': 'Cost',
+        })
+        formatters = { name: NumberFormatter(format='0.00', text_align='right') for name in sweep.target_names.values() }
+        formatters['Cost'] = NumberFormatter(format='$0,0', text_align='right')
+
+        self.append(pn.pane.HTML('<h3>Target Trade-Offs</h3>', styles=header_styles))
+        self.append(pn.pane.HTML(
+            f'<p>{len(sweep.vectors)} weight combinations, {sweep.solves} OptiPass runs, '
+            f'{len(sweep.solutions)} distinct solutions.  Lines connect the solutions that are '
+            'not dominated by another solution with the same budget.</p>'
+        ))
+        if len(names) > 2:
+            self.append(pn.Row(self.x_menu, self.y_menu))
+        self.append(self.plot)
+        self.append(pn.pane.HTML('<h3>Frontier</h3>'))
+        self.append(pn.widgets.Tabulator(
+            frontier,
+            show_index=False,
+            disabled=True,
+            formatters=formatters,
+            pagination='local',
+            page_size=OutputPane.GATE_PAGE_SIZE,
+        ))
+
+    def axis_cb(self, _):
+        """
+        Callback function for the axis menus:  redraw the plot.
+        """
+        if self.x_menu.value != self.y_menu.value:
+            self.plot.object = self.sweep.figure(self.x_menu.value, self.y_menu.value)
 
 class OutputPane(pn.Column):
     """
@@ -467,6 +776,8 @@ class OutputPane(pn.Column):
         super(OutputPane, self).__init__()
         self.op = op
         self.bf = bf
+        self.evaluators = { }
+        self.whatif_budget = int(op.summary.budget.iloc[-1])
         # self.figures = []
 
         self.append(pn.pane.HTML('<h3>Optimization Complete</h3>', styles=header_styles))
@@ -484,6 +795,7 @@ class OutputPane(pn.Column):
             self.append(self._make_budget_table())
             self.append(pn.Accordion(
                 ('Barrier Details', self._make_gate_table()),
+                ('What If', self._make_whatif()),
                 stylesheets = [accordion_style_sheet],
             ))
 
@@ -572,13 +884,20 @@ class OutputPane(pn.Column):
             selectable = True,
             configuration = {'columnDefaults': {'headerSort': False}},
         )
-        table.on_click(self.budget_table_cb)
         self.budget_table = df
+        self.budget_widget = table
         return table
 
+    # Number of rows in each page of the barrier details table
+
+    GATE_PAGE_SIZE = 25
+
     def _make_gate_table(self):
         """
-        Make a table showing details about gates used in solutions.
+        Make a table showing details about gates used in solutions.  The table uses
+        remote pagination, so the browser only gets the rows on the current page.
+        Columns that are hidden by default are not sent to the browser at all; a
+        menu above the table lets the user add them.
         """
         formatters = { }
         alignment = { }
@@ -596,10 +915,13 @@ class OutputPane(pn.Column):
                 formatters[col] = NumberFormatter(format='0.00', text_align='center')
                 # alignment[col] = 'right'
             elif col.endswith('gain'):
+                formatters[col] = NumberFormatter(format='0.0', text_align='center')
                 hidden.append(col)
             elif col == 'Cost':
                 formatters[col] = {'type': 'money', 'symbol': '$', 'precision': 0}
                 alignment[col] = 'right'
+        df['Marginal'] = self.evaluator(self.whatif_budget).gains()[df.ID].to_numpy()
+        formatters['Marginal'] = NumberFormatter(format='+0.00', text_align='center')
         colnames = [c.replace('_hab','') for c in df.columns]
         if self.op.weighted:
             for i, t in enumerate(self.op.targets):
@@ -611,10 +933,11 @@ class OutputPane(pn.Column):
         df.columns = colnames
 
         table = pn.widgets.Tabulator(
-            df, 
+            df.drop(columns=hidden), 
             show_index=False, 
             frozen_columns=['ID'],
-            hidden_columns=hidden,
+            pagination='remote',
+            page_size=self.GATE_PAGE_SIZE,
             formatters=formatters,
             text_align=alignment,
             configuration={'columnDefaults': {'headerSort': False}},
@@ -623,44 +946,156 @@ class OutputPane(pn.Column):
         )
         table.disabled = True
         self.gate_table = df
-        return table
+        self.gate_widget = table
+
+        chooser = pn.widgets.MultiChoice(name='Additional Columns', options=hidden, value=[], width=400)
+        chooser.param.watch(self.gate_columns_cb, ['value'])
+        self.gate_chooser = chooser
+        return pn.Column(chooser, table)
+
+    def gate_columns_cb(self, _):
+        """
+        Callback function invoked when the user changes the set of optional columns
+        in the barrier details table.  Replace the table contents with the default
+        columns plus the ones selected, in their original order.
+        """
+        hidden = self.gate_chooser.options
+        cols = [c for c in self.gate_table.columns if c not in hidden or c in self.gate_chooser.value]
+        self.gate_widget.value = self.gate_table[cols]
+
+    def evaluator(self, budget):
+        """
+        Return an Evaluator for the solution at a budget level, making it the
+        first time it is needed.
+        """
+        if budget not in self.evaluators:
+            self.evaluators[budget] = Evaluator(self.op, budget)
+        return self.evaluators[budget]
+
+    whatif_text = '''
+The **Marginal** column in the barrier details table is the exact change in
+weighted potential habitat if one gate is added to the solution for the budget
+selected here (a positive number) or removed from it (a negative number).
+Choose gates below to see the combined effect of adding or removing several
+gates, e.g. to swap a gate in the solution for one that is not.
+'''
+
+    def _make_whatif(self):
+        """
+        Make the widgets for evaluating changes to a solution:  a menu of budget
+        levels, a menu of gates to add or remove, and a text area that shows
+        the change in habitat and cost.  Only gates with projects (NPROJ > 0)
+        can be in a solution, so the menu of gates is limited to those.
+        """
+        budgets = [int(b) for b in self.op.summary.budget if b > 0]
+        self.whatif_menu = pn.widgets.Select(
+            name='Solution',
+            options={ OP.format_budget_amount(b): b for b in budgets },
+            value=self.whatif_budget,
+            width=120,
+        )
+        self.whatif_gates = pn.widgets.MultiChoice(
+            name='Gates to add or remove',
+            options=list(self.op.input_frame.ID[self.op.input_frame.NPROJ > 0]),
+            value=[],
+            width=450,
+        )
+        self.whatif_result = pn.pane.Markdown('')
+        self.whatif_menu.param.watch(self.whatif_budget_cb, ['value'])
+        self.whatif_gates.param.watch(self.whatif_cb, ['value'])
+        return pn.Column(
+            pn.pane.Markdown(self.whatif_text),
+            pn.Row(self.whatif_menu, self.whatif_gates),
+            self.whatif_result,
+        )
+
+    def whatif_budget_cb(self, e):
+        """
+        Callback function invoked when the user selects a different solution in
+        the What If section.  Update the Marginal column and the evaluation of
+        the selected gates.
+        """
+        self.whatif_budget = e.new
+        self.gate_table['Marginal'] = self.evaluator(e.new).gains()[self.gate_table.ID].to_numpy()
+        self.gate_columns_cb(None)
+        self.whatif_cb(None)
+
+    def whatif_cb(self, _):
+        """
+        Callback function invoked when the user changes the set of gates in the
+        What If section.  Show the effect of toggling the gates.
+        """
+        gates = self.whatif_gates.value
+        if not gates:
+            self.whatif_result.object = ''
+            return
+        ev = self.evaluator(self.whatif_budget)
+        dh, dc = ev.evaluate(gates)
+        added = [g for g in gates if not ev.selected[ev.index[g]]]
+        removed = [g for g in gates if ev.selected[ev.index[g]]]
+        cost = ev.solution_cost() + dc
+        text = f'Adding {len(added)} and removing {len(removed)} gates '
+        text += f'changes weighted potential habitat by **{dh:+.2f}** (from {ev.total():.2f} to {ev.total() + dh:.2f}).  '
+        text += f'The total cost would be ${cost:,.0f} '
+        text += 'which is over' if cost > self.whatif_budget else 'which is within'
+        text += f' the budget of {OP.format_budget_amount(self.whatif_budget)}.'
+        self.whatif_result.object = text
     
-    def make_dots(self, plot):
-        """
-        Called after the output panel is initialized, make a set of glyphs to display
-        for each budget level.
-        """
-        if hasattr(self, 'budget_table'):
-            self.selected_row = None
-            self.dots = []
-            for row in self.budget_table.itertuples():
-                df = self.bf.map_info[self.bf.data.BARID.isin(row.gates)]
-                c = plot.circle_dot('x', 'y', size=12, line_color='blue', fill_color='white', source=df)
-                # c = plot.star_dot('x', 'y', size=20, line_color='blue', fill_color='white', source=df)
-                # c = plot.star('x', 'y', size=12, color='blue', source=df)
-                # c = plot.hex('x', 'y', size=12, color='green', source=df)
-                c.visible = False
-                self.dots.append(c)
-
-    def budget_table_cb(self, e):
-        """
-        The callback function invoked when the user clicks a row in the budget table.
-        Use the event to figure out which row was clicked.  Hide any dots that were displayed
-        previously, then make the dots for the selected row visible.
-        """
-        if n := self.selected_row:
-            self.dots[n].visible = False
-        self.selected_row = e.row
-        self.dots[self.selected_row].visible = True
+    # JavaScript code run in the browser when the user selects rows in the budget
+    # table.  The source has one column of 0s and 1s for each budget level (s0, s1, ...);
+    # set the indices of the filter to the gates used in the selected solutions.
+
+    select_gates_js = '''
+        const rows = cb_obj.indices;
+        const indices = [];
+        for (let i = 0; i < src.get_length(); i++) {
+            if (rows.some((r) => src.data['s' + r][i] == 1))
+                indices.push(i);
+        }
+        filt.indices = indices;
+    '''
+
+    def make_dots(self, map):
+        """
+        Called after the output panel is initialized, make the glyphs that show
+        the barriers in a solution.  There is one data source for all budget levels,
+        with the locations of every gate used in any solution and a column from the
+        selection matrix for each budget.  The glyphs are filtered by a view
+        that is updated in the browser when the user clicks a row in the budget
+        table, so the server is not involved.
+
+        Arguments:
+          map:  the TGMap object that displays the barriers
+        """
+        if not hasattr(self, 'budget_table'):
+            return
+        m = self.op.matrix
+        m = m[m['count'] > 0]
+        info = self.bf.map_info.set_index('id').loc[m.index]
+        data = { 'x': info.x.to_numpy(), 'y': info.y.to_numpy() }
+        for i, b in enumerate(self.op.summary.budget):
+            data[f's{i}'] = m[int(b)].to_numpy()
+        self.solution_source = ColumnDataSource(data)
+        self.solution_filter = IndexFilter(indices=[])
+        dots = map.graphic().circle_dot(
+            'x', 'y', size=12, line_color='blue', fill_color='white',
+            source=self.solution_source,
+            view=CDSView(filter=self.solution_filter),
+        )
+        map.layers.set_overlay('solution', dots)
+        self.budget_widget.jscallback(
+            args={'src': self.solution_source, 'filt': self.solution_filter},
+            **{'source.selected.indices': self.select_gates_js},
+        )
 
     def hide_dots(self):
         """
         Callback function invoked when users click on a region name in the start panel to hide
         any dots that might be on the map.
         """
-        if self.selected_row:
-            self.dots[self.selected_row].visible = False
-        self.selected_row = None
+        if hasattr(self, 'solution_filter'):
+            self.solution_filter.indices = []
+            self.budget_widget.selection = []
 
 class DownloadPane(pn.Column):
     """
@@ -735,8 +1170,8 @@ class DownloadPane(pn.Column):
         # that option; if there is a net benefit figure it's the first figure, enable it
         # if it's there
 
-        if len(outputs.op.display_figures) > 0:
-            if outputs.op.display_figures[0][0] == 'Net':
+        if len(outputs.op.figure_names) > 0:
+            if outputs.op.figure_names[0] == 'Net':
                 self.boxes[self.NB].value = True
                 self.boxes[self.NB].disabled = False
             self.boxes[self.IT].value = True
@@ -756,64 +1191,91 @@ class DownloadPane(pn.Column):
             parts.append(self.outputs.op.climate[0])
         return '_'.join(parts)
 
-    def _archive_cb(self, e):
+    # Archives smaller than this are kept in memory, larger ones are moved to a temp file
+
+    SPOOL_SIZE = 16 * 1024 * 1024
+
+    async def _archive_cb(self, e):
         """
-        Function called when the user clicks the Download button.  Create the output
-        folder and compress it.  When the archive is ready, display a FileDownload
+        Function called when the user clicks the Download button.  The zip file
+        is made in a background thread, so the server can respond to other events
+        while it is being created.  When the archive is ready, display a FileDownload
         widget with a button that starts the download.
         """
         if not any([x.value for x in self.boxes.values()]):
             return
         self.loading = True
-        base = self._make_archive_dir()
-        self._save_files(base)
-        p = make_archive(base, 'zip', base)
-        self.loading = False
-        self[-1] = pn.widgets.FileDownload(file=p, filename=self.filename+'.zip', stylesheets=[button_style_sheet])
-
-    def _make_archive_dir(self):
-        """
-        Create an empty directory for the download, using the name in the form.
-        """
         self.filename = self.filename_input.value_input or self.filename_input.value
-        archive_dir = Path.cwd() / 'tmp' / self.filename
-        if Path.exists(archive_dir):
-            rmtree(archive_dir)
-        Path.mkdir(archive_dir)
-        return archive_dir
+        fmt = self.image_type.value.lower()
+        names = self._figure_names()
+        # HTML pages are made from the figures displayed in the GUI, which belong to the
+        # session's document, so they are serialized here rather than in a worker thread
+        pages = { name: file_html(self.outputs.op.get_figure(name), CDN, name) for name in names } if fmt == 'html' else None
+        try:
+            loop = asyncio.get_running_loop()
+            archive = await loop.run_in_executor(None, self.make_archive, names, fmt, pages)
+        finally:
+            self.loading = False
 
-    def _save_files(self, loc):
-        """
-        Write the tables and figures to the download directory.
+        def contents():
+            archive.seek(0)
+            return archive
 
-        Arguments:
-          loc:  the path to the directory.
+        self[-1] = pn.widgets.FileDownload(callback=contents, filename=self.filename+'.zip', stylesheets=[button_style_sheet])
+
+    def _figure_names(self):
         """
-        figures = self.outputs.op.display_figures if self.image_type.value == 'HTML' else self.outputs.op.download_figures
-        for name, fig in figures:
+        Return a list of names of the figures selected by the checkboxes.
+        """
+        names = []
+        for name in self.outputs.op.figure_names:
             if name == 'Net' and not self.boxes[self.NB].value:
                 continue
             if name != 'Net' and not self.boxes[self.IT].value:
                 continue
-            if self.image_type.value == 'HTML':
-                savehtml(fig, filename=loc/f'{name}.html')
-            else:
-                ext = self.image_type.value.lower()
-                fn = loc/f'{name}.{ext}'
-                fig.savefig(fn, bbox_inches='tight')
-        if self.boxes[self.BS].value:
-            df = self.outputs.budget_table.drop(['gates'], axis=1)
-            df.to_csv(
-                loc/'budget_summary.csv', 
-                index=False,
-                float_format=lambda n: round(n,2)
-            )
-        if self.boxes[self.BD].value:
-            self.outputs.gate_table.to_csv(
-                loc/'barrier_details.csv',
-                index=False,
-                float_format=lambda n: round(n,2)
-            )
+            names.append(name)
+        return names
+
+    def make_archive(self, names, fmt, pages=None):
+        """
+        Write the tables and figures to a zip file.  The file is a SpooledTemporaryFile,
+        so small archives never touch the disk.  Images are rendered one at a
+        time (Matplotlib holds the GIL, so threads would not help), and images
+        that were not already in the figure cache are removed from it afterward.
+
+        Arguments:
+          names:  names of the figures to include
+          fmt:  the figure format ('html' or the name of an image format)
+          pages:  if the format is 'html' a dictionary with the text of each page
+
+        Returns:
+          the zip file, open for reading
+        """
+        op = self.outputs.op
+        if pages is None:
+            created = [name for name in names if (name, fmt) not in op.figures]
+            figures = [op.get_figure(name, fmt) for name in names]
+            op.release_figures(fmt, created)
+        else:
+            figures = [pages[name] for name in names]
+
+        archive = SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+        with ZipFile(archive, 'w', ZIP_DEFLATED) as zf:
+            for name, data in zip(names, figures):
+                zf.writestr(f'{name}.{fmt}', data)
+            if self.boxes[self.BS].value:
+                df = self.outputs.budget_table.drop(['gates'], axis=1)
+                zf.writestr('budget_summary.csv', df.to_csv(
+                    index=False,
+                    float_format=lambda n: round(n,2)
+                ))
+            if self.boxes[self.BD].value:
+                zf.writestr('barrier_details.csv', self.outputs.gate_table.to_csv(
+                    index=False,
+                    float_format=lambda n: round(n,2)
+                ))
+        archive.seek(0)
+        return archive
 
 class TideGatesApp(pn.template.BootstrapTemplate):
     """
@@ -843,7 +1305,7 @@ class TideGatesApp(pn.template.BootstrapTemplate):
         """
         super(TideGatesApp, self).__init__(**params)
 
-        self.bf = Project('static/workbook.csv', DataSet.TNC_OR)
+        self.bf = load_project('static/workbook.csv', DataSet.TNC_OR)
 
         self.map = TGMap(self.bf)
         self.map_pane = pn.panel(self.map.graphic())
@@ -852,8 +1314,12 @@ class TideGatesApp(pn.template.BootstrapTemplate):
         self.region_boxes = RegionBox(self.bf, self.map, self.budget_box)
         self.target_boxes = TargetBox()
         self.climate_group = pn.widgets.RadioBoxGroup(name='Climate', options=self.bf.climates)
+        self.workspace = None
+        self.history = RunStore()
+        self.history_box = HistoryBox(self.history, self.load_run)
  
         self.optimize_button = pn.widgets.Button(name='Run Optimizer', stylesheets=[button_style_sheet])
+        self.pareto_button = pn.widgets.Button(name='Explore Weights', stylesheets=[button_style_sheet])
 
         self.info = InfoBox(self, self.run_optimizer)
 
@@ -874,14 +1340,14 @@ class TideGatesApp(pn.template.BootstrapTemplate):
 
         welcome_tab = pn.Column(
             self.section_head('Welcome'),
-            pn.pane.HTML(open('static/welcome.html').read()),
+            pn.pane.HTML(static_html('welcome.html')),
         )
 
         help_tab = pn.Column(
             self.section_head('Instructions'),
-            pn.pane.HTML(open('static/help1.html').read()),
-            pn.pane.PNG('static/ROI.png', width=400),
-            pn.pane.HTML(open('static/help2.html').read()),
+            pn.pane.HTML(static_html('help1.html')),
+            pn.pane.PNG(static_file('ROI.png'), width=400),
+            pn.pane.HTML(static_html('help2.html')),
         )
 
         start_tab = pn.Column(
@@ -904,7 +1370,10 @@ class TideGatesApp(pn.template.BootstrapTemplate):
                 width=600,
             ),
 
-            self.optimize_button,
+            pn.Row(self.optimize_button, self.pareto_button),
+
+            self.section_head('Previous Runs'),
+            self.history_box,
         )
 
         output_tab = pn.Column(
@@ -934,6 +1403,7 @@ class TideGatesApp(pn.template.BootstrapTemplate):
         self.modal.append(self.info)
 
         self.optimize_button.on_click(self.validate_settings)
+        self.pareto_button.on_click(self.run_pareto)
 
     def section_head(self, s, b = None):
         """
@@ -985,8 +1455,16 @@ class TideGatesApp(pn.template.BootstrapTemplate):
             self.target_boxes.weights(),
             self.climate_group.value,
         )
-        self.op.generate_input_frame()
-        self.op.run(self.budget_box.values(), False)
+        # Each run has its own workspace; the one used by the previous run is no longer needed
+
+        owner = session_id()
+        if self.workspace:
+            workspaces.release(self.workspace, owner)
+        self.workspace = workspaces.create(owner)
+
+        with self.op.timer.span('run_optimizer'), metrics.QUEUE_DEPTH.track_inprogress(), metrics.OPTIMIZATION_LATENCY.time():
+            self.op.generate_input_frame()
+            self.op.run(self.budget_box.values(), False, folder=self.workspace)
 
         self.main[0].loading = False
 
@@ -1001,10 +1479,111 @@ class TideGatesApp(pn.template.BootstrapTemplate):
             Logging.log('Output files:' + ','.join(self.op.outputs))
             self.info.show_success()
             self.add_output_pane()
+            self.save_run()
         except RuntimeError as err:
             print(err)
             self.info.show_fail(err)
+        self.op.log_timings()
+
+    async def run_pareto(self, _):
+        """
+        Callback function invoked when the user clicks the Explore Weights button.
+        Run OptiPass with a range of weights for the selected targets and show
+        the trade-offs in a new tab.  The sweep runs in a background thread, so
+        the server can respond to other events while it is running.
+        """
+        regions = self.region_boxes.selection()
+        budget_max, budget_delta = self.budget_box.values()
+        targets = self.target_boxes.selection()
+
+        if len(regions) == 0 or budget_max == 0 or len(targets) == 0:
+            self.info.show_missing(regions, budget_max, targets)
+            return
+        if len(targets) < 2:
+            self.info.show_pareto_targets()
+            return
+
+        Logging.log('running weight sweep')
+        self.main[0].loading = True
+
+        owner = session_id()
+        if self.workspace:
+            workspaces.release(self.workspace, owner)
+        self.workspace = workspaces.create(owner)
+
+        try:
+            sweep = ParetoSweep(
+                self.bf,
+                list(regions),
+                [self.bf.target_map[t] for t in targets],
+                self.climate_group.value,
+            )
+            loop = asyncio.get_running_loop()
+            with metrics.QUEUE_DEPTH.track_inprogress():
+                await loop.run_in_executor(None, sweep.run, (budget_max, budget_delta), self.workspace)
+            pane = ParetoPane(sweep)
+            if len(self.tabs) > 5:
+                self.tabs[5] = ('Trade-Offs', pane)
+            else:
+                self.tabs.append(('Trade-Offs', pane))
+            self.tabs.active = 5
+        except RuntimeError as err:
+            self.info.show_fail(err)
+        finally:
+            self.main[0].loading = False
+
+    def save_run(self):
+        """
+        Save the results of the current optimization in the run history.  Errors
+        are logged but not shown to the user, since the results are already
+        displayed.
+        """
+        try:
+            run_id = self.history.save(self.op)
+            self.history_box.refresh()
+            self.set_resume_token(self.history.token(run_id))
+        except Exception as err:
+            Logging.log(f'could not save run: {err}')
 
+    def set_resume_token(self, token):
+        """
+        Add the token for the displayed run to the query part of the URL in the
+        browser, so the results are restored if the page is reloaded.
+        """
+        if pn.state.location is not None and token:
+            pn.state.location.update_query(run=token)
+
+    def resume(self):
+        """
+        Called when a session starts.  If the URL has a token for a saved run
+        display the results of that run instead of starting with an empty
+        Output tab.
+        """
+        args = pn.state.session_args.get('run')
+        if not args:
+            return
+        token = args[0].decode(errors='ignore')
+        if (run_id := self.history.lookup(token)) is None:
+            Logging.log(f'resume: unknown token {token}')
+            return
+        self.load_run(run_id)
+
+    def load_run(self, run_id):
+        """
+        Callback function for the Load button in the history box.  Restore the
+        results of a previous run and display them in the Output tab.
+
+        Arguments:
+          run_id:  the ID of the run in the run history
+        """
+        try:
+            self.op = self.history.load(run_id, self.bf)
+        except ValueError as err:
+            self.info.show_load_fail(err)
+            return
+        self.add_output_pane()
+        self.tabs.active = 3
+        self.set_resume_token(self.history.token(run_id))
 
     def add_output_pane(self, op=None):
         """
@@ -1017,13 +1596,14 @@ class TideGatesApp(pn.template.BootstrapTemplate):
         """
         op = op or self.op
 
-        output = OutputPane(op, self.bf)
-        output.make_dots(self.map.graphic())
-        self.region_boxes.add_external_callback(output.hide_dots)
-
-        self.tabs[3] = ('Output', output)
+        with op.timer.span('output_pane'):
+            output = OutputPane(op, self.bf)
+            output.make_dots(self.map)
+            self.region_boxes.add_external_callback(output.hide_dots)
+            self.tabs[3] = ('Output', output)
 
-        self.tabs[4] = ('Download', DownloadPane(output))
+        with op.timer.span('download_pane'):
+            self.tabs[4] = ('Download', DownloadPane(output))
 
     def map_help_cb(self, _):
         """
@@ -1091,4 +1671,69 @@ class TideGatesApp(pn.template.BootstrapTemplate):
         <p>By default the optimizer uses current water levels when computing potential benefits.  Click the button next to <b>Future</b> to have it use water levels expected due to climate change.</p>
         <p>The future scenario uses two projected water levels, both for the period to 2100. For fish habitat targets, the future water level is based on projected sea level rise of 5.0 feet.  For agriculture and infrastructure targets, the future water level is projected to be 7.2 feet, which includes sea level rise and the probabilities of extreme water levels causing flooding events.</p>
         ''')
-        self.tabs[2].append(pn.layout.FloatPanel(msg, name='Targets', contained=False, position='center', width=400))
\ No newline at end of file
+        self.tabs[2].append(pn.layout.FloatPanel(msg, name='Targets', contained=False, position='center', width=400))
+
+
+class AppPool:
+    """
+    A pool of TideGatesApp objects that are made before they are needed, so a
+    new session does not have to wait for the app to be built.  Each time an
+    app is taken from the pool a new one is made to replace it.  If the pool
+    is empty (e.g. when many users connect at the same time) the app is made
+    in the usual way.
+
+    Bokeh documents are not thread safe, so apps are made on the server's
+    event loop, one per callback, so the server can handle other events
+    between them.  Each server process has its own pool, which starts filling
+    when the first session in the process takes an app.
+
+    The number of apps in the pool is set by the environment variable
+    TIDEGATES_APP_POOL (the default is 0, which disables the pool).
+    """
+
+    def __init__(self, factory, size: int = None):
+        """
+        Make an empty pool.
+
+        Arguments:
+          factory:  a function that makes a new app
+          size:  the number of apps to keep in the pool (overrides the default)
+        """
+        self.factory = factory
+        self.size = int(os.environ.get('TIDEGATES_APP_POOL', 0)) if size is None else size
+        self.apps = deque()
+        self.filling = False
+
+    def schedule_fill(self):
+        """
+        If the pool is not full, arrange for the event loop to call fill (unless
+        a call is already scheduled).
+        """
+        if self.size > 0 and not self.filling and len(self.apps) < self.size:
+            self.filling = True
+            IOLoop.current().add_callback(self.fill)
+
+    def fill(self):
+        """
+        Make one app and add it to the pool, then schedule another call if the
+        pool is still not full.  If making an app fails the error is logged and
+        the pool is left as it is (the next call to get will try again).
+        """
+        self.filling = False
+        try:
+            if len(self.apps) < self.size:
+                self.apps.append(self.factory())
+        except Exception as err:
+            Logging.log(f'could not fill app pool: {err}')
+            return
+        self.schedule_fill()
+
+    def get(self):
+        """
+        Return an app from the pool, or a new app if the pool is empty, and
+        schedule a call to fill to replace it.
+        """
+        app = self.apps.popleft() if self.apps else None
+        metrics.record_cache('app_pool', app is not None)
+        self.schedule_fill()
+        return app or self.factory()
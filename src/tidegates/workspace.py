@@ -0,0 +1,331 @@
+#
+# Workspaces
+#
+# OptiPass reads a barrier file and writes one output file for each budget
+# level.  When the app runs OptiPass it puts these files in a new folder
+# (a "workspace") inside the workspace root, which is the tmp folder unless
+# the environment variable TIDEGATES_WORKSPACE names a different location,
+# e.g. a folder on a tmpfs file system:
+#
+#   $ export TIDEGATES_WORKSPACE=/dev/shm/tidegates
+#
+# Workspaces are reference counted:  each one is owned by one or more browser
+# sessions, and a workspace is deleted when the last of its owners releases it
+# (when the session ends, or starts a new optimization run).
+#
+# Reference counts are kept separately in each server process, so each
+# workspace has a file with the ID of the process that made it, and the sweep
+# in one process never removes a workspace made by another process that is
+# still running.  Files that are not in an active workspace (left by the
+# command line API, or by a server that was stopped) are removed by a
+# periodic sweep:  anything older than the maximum age is deleted, and if the
+# total size of the root is over the quota the oldest items are deleted until
+# it is under.  The limits can be set by environment variables:
+#
+#   TIDEGATES_WORKSPACE_MB      quota for the workspace root, in MB (default 1024)
+#   TIDEGATES_WORKSPACE_HOURS   maximum age of a file or folder, in hours (default 24)
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from . import metrics
+from .messages import Logging
+
+ROOT = os.environ.get('TIDEGATES_WORKSPACE') or 'tmp'
+MAX_BYTES = int(os.environ.get('TIDEGATES_WORKSPACE_MB', 1024)) * 1024 * 1024
+MAX_AGE = float(os.environ.get('TIDEGATES_WORKSPACE_HOURS', 24)) * 3600
+
+# The quota sweep will not delete anything modified more recently than this
+# (in seconds), so it never removes a folder being used by another server process
+
+GRACE = 600
+
+# The name of the file in each workspace with the ID of the process that made it
+
+OWNER_FILE = '.owner'
+
+def session_id():
+    '''
+    Return the ID of the current browser session, or None if the app is not
+    running in a server.
+    '''
+    import panel as pn
+
+    doc = pn.state.curdoc
+    if doc is None or doc.session_context is None:
+        return None
+    return doc.session_context.id
+
+class WorkspaceManager:
+    '''
+    Create and delete the folders used for optimization runs.  Workspaces are
+    identified by absolute paths, so the paths passed to acquire and release
+    can be relative to the current folder.
+
+    Attributes:
+      root:  the absolute path of the folder that contains the workspaces
+      max_bytes:  the quota for the root folder
+      max_age:  age (in seconds) of files and folders removed by the sweep
+      owners:  a dictionary that maps the path of each active workspace to the set of its owners
+    '''
+
+    def __init__(self, root: str = ROOT, max_bytes: int = MAX_BYTES, max_age: float = MAX_AGE):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.owners = { }
+        self.lock = threading.Lock()
+
+    def create(self, owner: str = None) -> str:
+        '''
+        Make a new workspace.  If an owner is specified the workspace is
+        deleted when the owner releases it, otherwise it is deleted by a sweep.
+
+        Arguments:
+          owner:  the session ID of the owner
+
+        Returns:
+          the path to the new folder
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix='run_', dir=self.root)
+        with open(os.path.join(path, OWNER_FILE), 'w') as f:
+            f.write(str(os.getpid()))
+        if owner:
+            self.acquire(path, owner)
+        return path
+
+    def acquire(self, path: str, owner: str):
+        '''
+        Add an owner to a workspace.
+        '''
+        path = os.path.abspath(path)
+        with self.lock:
+            self.owners.setdefault(path, set()).add(owner)
+            metrics.WORKSPACES.set(len(self.owners))
+
+    def release(self, path: str, owner: str):
+        '''
+        Remove an owner from a workspace, and delete the workspace if that
+        was the last owner.
+        '''
+        path = os.path.abspath(path)
+        with self.lock:
+            if (owners := self.owners.get(path)) is None:
+                return
+            owners.discard(owner)
+            if owners:
+                return
+            del self.owners[path]
+            metrics.WORKSPACES.set(len(self.owners))
+        self._remove(path, 'released')
+
+    def release_all(self, owner: str):
+        '''
+        Release every workspace held by an owner.
+        '''
+        with self.lock:
+            paths = [p for p, owners in self.owners.items() if owner in owners]
+        for p in paths:
+            self.release(p, owner)
+
+    def session_destroyed(self, session_context):
+        '''
+        Callback function for pn.state.on_session_destroyed:  release the
+        workspaces owned by the session.
+        '''
+        self.release_all(session_context.id)
+
+    def sweep(self, now: float = None) -> list[str]:
+        '''
+        Delete files and folders in the root that are not active workspaces (in
+        this process or another running process) and are older than the
+        maximum age, then delete the oldest remaining items until the size of
+        the root is under the quota.
+
+        Arguments:
+          now:  the current time (used by tests)
+
+        Returns:
+          a list of paths that were deleted
+        '''
+        now = now or time.time()
+        with self.lock:
+            active = set(self.owners)
+        items = []
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return []
+        for entry in entries:
+            if os.path.abspath(entry.path) in active or self._owned_elsewhere(entry.path):
+                continue
+            try:
+                items.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+        items.sort()
+
+        removed = []
+        for mtime, path in items:
+            if now - mtime > self.max_age:
+                self._remove(path, 'age')
+                removed.append(path)
+        total = metrics.folder_size(self.root)
+        for mtime, path in items:
+            if total <= self.max_bytes:
+                break
+            if path in removed or now - mtime < GRACE:
+                continue
+            size = metrics.folder_size(path) if os.path.isdir(path) else os.path.getsize(path)
+            self._remove(path, 'quota')
+            removed.append(path)
+            total -= size
+        return removed
+
+    @staticmethod
+    def _owned_elsewhere(path: str) -> bool:
+        '''
+        Return True if a path is a workspace made by a different process
+        that is still running.
+        '''
+        try:
+            with open(os.path.join(path, OWNER_FILE)) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            return False
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _remove(self, path: str, reason: str):
+        '''
+        Delete a file or folder and count the deletion.
+        '''
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return
+        except OSError as err:
+            Logging.log(f'workspace: could not remove {path}: {err}')
+            return
+        metrics.WORKSPACES_REMOVED.labels(reason=reason).inc()
+
+# The manager used by the app;  the size of its root is reported on the
+# metrics page
+
+workspaces = WorkspaceManager()
+metrics.on_refresh(lambda: metrics.TMP_BYTES.set(metrics.folder_size(workspaces.root)))
+
+sweep_scheduled = False
+
+def schedule_sweep(period: str = '10m'):
+    '''
+    Start the periodic sweep in this process, if it has not been started already.
+    Called when a session starts, so each server process runs its own sweep.
+    '''
+    global sweep_scheduled
+    import panel as pn
+
+    if not sweep_scheduled:
+        pn.state.schedule_task('workspace_sweep', workspaces.sweep, period=period)
+        sweep_scheduled = True
+
+####################
+#
+# Unit tests
+#
+
+class TestWorkspace:
+
+    @staticmethod
+    def test_refcount():
+        '''
+        A workspace should be deleted when the last owner releases it.
+        '''
+        with tempfile.TemporaryDirectory() as d:
+            wm = WorkspaceManager(root=d)
+            p = wm.create('s1')
+            wm.acquire(p, 's2')
+            wm.release(p, 's1')
+            assert os.path.isdir(p)
+            wm.release_all('s2')
+            assert not os.path.exists(p)
+            assert wm.owners == { }
+
+    @staticmethod
+    def test_other_process():
+        '''
+        The sweep should not remove an old workspace made by another process
+        that is still running, but should remove one made by a process that
+        has exited.
+        '''
+        import subprocess
+        import sys
+
+        with tempfile.TemporaryDirectory() as d:
+            wm = WorkspaceManager(root=d, max_age=3600)
+            live = wm.create()
+            dead = wm.create()
+            proc = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+            for path, pid in [(live, os.getppid()), (dead, int(proc.stdout))]:
+                with open(os.path.join(path, OWNER_FILE), 'w') as f:
+                    f.write(str(pid))
+            removed = wm.sweep(time.time() + 7200)
+            assert removed == [dead]
+            assert os.path.isdir(live)
+
+    @staticmethod
+    def test_relative_root():
+        '''
+        With a relative root, a workspace acquired by a relative path should
+        be the same workspace, and the sweep should not remove it.
+        '''
+        with tempfile.TemporaryDirectory() as d:
+            cwd = os.getcwd()
+            os.chdir(d)
+            try:
+                wm = WorkspaceManager(root='tmp', max_age=0)
+                p = wm.create('s1')
+                rel = os.path.relpath(p)
+                wm.acquire(rel, 's2')
+                assert wm.owners == { p: { 's1', 's2' } }
+                assert wm.sweep(time.time() + 60) == []
+                wm.release(rel, 's1')
+                wm.release(rel, 's2')
+                assert not os.path.exists(p)
+            finally:
+                os.chdir(cwd)
+
+    @staticmethod
+    def test_sweep():
+        '''
+        The sweep should remove old items and enforce the quota, but never
+        touch active workspaces or recent items.
+        '''
+        with tempfile.TemporaryDirectory() as d:
+            wm = WorkspaceManager(root=d, max_bytes=1500, max_age=3600)
+            active = wm.create('s1')
+            now = time.time()
+            for name, age in [('old', 7200), ('big1', 1200), ('big2', 900), ('new', 0)]:
+                fn = os.path.join(d, name)
+                with open(fn, 'w') as f:
+                    f.write('x' * 1000)
+                os.utime(fn, (now - age, now - age))
+            os.utime(active, (now - 7200, now - 7200))
+            removed = wm.sweep(now)
+            assert [os.path.basename(p) for p in removed] == ['old', 'big1', 'big2']
+            assert sorted(os.listdir(d)) == sorted(['new', os.path.basename(active)])